@@ -0,0 +1,428 @@
+#!/usr/bin/python3
+
+"""
+asyncio based HTTP front end
+
+Unlike http.server.HTTPServer this serves any number of connections
+at once from a single event loop. Everything that might block, like
+MPD round trips or reading files, is handed to executor threads so
+one slow request doesn't hold up every other phone in the house.
+"""
+
+import os
+import time
+import socket
+import asyncio
+import mimetypes
+import email.utils
+from http import HTTPStatus
+
+from notifier import format_event
+from router import PAGE, ACTION, STREAM
+
+# how long we wait for a client to send its request
+REQUEST_TIMEOUT = 10.0
+# idle keep-alive connections are closed after that many seconds
+KEEPALIVE_TIMEOUT = 15.0
+# connections beyond that are turned away with 503
+MAX_CONNECTIONS = 64
+# chunk size when streaming files
+FILE_CHUNK = 64 * 1024
+# we don't take request headers beyond that
+MAX_HEADER_LINES = 100
+# nor request bodies bigger than that
+MAX_BODY = 64 * 1024
+# a draining server waits that long for open connections at most
+DRAIN_TIMEOUT = KEEPALIVE_TIMEOUT + REQUEST_TIMEOUT
+# event streams send a comment after that many seconds of silence
+# so proxies and browsers don't consider the connection dead
+STREAM_KEEPALIVE = 15.0
+# events queued for one slow stream client before we drop it
+STREAM_BACKLOG = 32
+
+ERROR_PAGE = '<!DOCTYPE html><html><head><title>Error</title></head><body><h1>{0} {1}</h1><p>{2}</p></body></html>'
+
+
+def etag_matches(if_none_match, etag):
+	"""
+	True if the If-None-Match header value covers etag
+	"""
+	if not if_none_match or not etag:
+		return False
+	if if_none_match.strip() == '*':
+		return True
+	return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+
+class AsyncHTTPServer():
+	"""
+	Minimal asyncio HTTP/1.1 server with keep-alive
+
+	:param server_address = (host, port) tuple to bind to
+	:param router = Router resolving request targets. A page is called
+		with the parsed query in an executor thread and returns
+		(code, content_type, body, headers). With an ETag among the headers
+		the page is answered with 304 if the client has it already.
+		Streams are served as Server-Sent Events
+	:param static_cache = StaticCache files are served from, if any
+	:param sock = listening socket to serve instead of binding one,
+		e.g. one handed over by the process we replace
+	"""
+
+	server_version = 'Paradium/0.2'
+
+	# exceptions pages raise when a backend they need is down. Answered with 503
+	unavailable_errors = ()
+
+	def __init__(self, server_address, router, logger, static_cache = None, sock = None):
+		self.server_address = server_address
+		self.router = router
+		self.static_cache = static_cache
+		self.max_connections = MAX_CONNECTIONS
+		self.connections = 0
+		self.logger = logger
+		self.loop = None
+		self.server = None
+		self.draining = False
+		self.drain_deadline = 0.0
+		# queues of the open event streams, only touched in the loop
+		self.streams = set()
+		# bound right away like HTTPServer does, clients connecting
+		# before the loop runs wait in the backlog
+		if sock is None:
+			host, port = server_address
+			sock = socket.create_server((host, port))
+		self.socket = sock
+		return
+
+	def serve_forever(self):
+		"""
+		run the event loop until shutdown() or KeyboardInterrupt
+		"""
+		asyncio.run(self.serve())
+		return
+
+	async def serve(self):
+		self.loop = asyncio.get_running_loop()
+		self.server = await asyncio.start_server(self.handle_connection, sock=self.socket)
+		async with self.server:
+			try:
+				await self.server.serve_forever()
+			except asyncio.CancelledError:
+				pass
+			# after drain() open connections finish their requests
+			while self.connections and time.monotonic() < self.drain_deadline:
+				await asyncio.sleep(0.05)
+		return
+
+	def shutdown(self):
+		"""
+		stop serving. Safe to call from any thread
+		"""
+		if self.loop is not None and self.server is not None and not self.loop.is_closed():
+			try:
+				self.loop.call_soon_threadsafe(self.server.close)
+			except RuntimeError:
+				# loop already gone
+				pass
+		return
+
+	def drain(self, timeout = DRAIN_TIMEOUT):
+		"""
+		stop accepting connections and let serve_forever() return once
+		the open ones are done, after timeout seconds at the latest. Every
+		answer from now on closes its connection and event streams end,
+		their clients reconnect. Safe to call from any thread
+		"""
+		self.drain_deadline = time.monotonic() + timeout
+		self.draining = True
+		if self.loop is not None and not self.loop.is_closed():
+			try:
+				self.loop.call_soon_threadsafe(self.close_streams)
+			except RuntimeError:
+				pass
+		self.shutdown()
+		return
+
+	def close_streams(self):
+		for queue in self.streams:
+			queue.put_nowait(None)
+		return
+
+	def server_close(self):
+		self.shutdown()
+		if self.loop is None:
+			# never served, the socket is still ours
+			self.socket.close()
+		return
+
+	async def handle_connection(self, reader, writer):
+		# asyncio only disables Nagle for sockets made with IPPROTO_TCP,
+		# create_server() makes them with 0. Head and body go out in two
+		# writes, the body would wait for the client's delayed ACK
+		sock = writer.get_extra_info('socket')
+		if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+			try:
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			except OSError:
+				# gone already, reading the request tells
+				pass
+
+		if self.connections >= self.max_connections:
+			await self.send_error(writer, 503, 'Too many connections')
+			writer.close()
+			return
+
+		self.connections += 1
+		try:
+			# HTTP/1.1 keep-alive, pipelined requests are simply
+			# read and answered one after the other
+			keep_alive = True
+			first = True
+			while keep_alive:
+				keep_alive = await self.handle_request(reader, writer, REQUEST_TIMEOUT if first else KEEPALIVE_TIMEOUT)
+				first = False
+		except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+			pass
+		except Exception:
+			self.logger.exception('error while handling request')
+		finally:
+			self.connections -= 1
+			writer.close()
+		return
+
+	async def read_request(self, reader, timeout):
+		"""
+		read request line and headers. Returns (method, target, version, headers)
+		or None if the client went away
+		"""
+		line = await asyncio.wait_for(reader.readline(), timeout)
+		if not line:
+			return None
+		words = line.decode('latin-1').split()
+		if len(words) != 3:
+			raise ValueError('malformed request line')
+
+		headers = {}
+		for i in range(MAX_HEADER_LINES):
+			line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+			if line in (b'\r\n', b'\n', b''):
+				break
+			name, _, value = line.decode('latin-1').partition(':')
+			headers[name.strip().lower()] = value.strip()
+		else:
+			raise ValueError('too many headers')
+
+		return words[0], words[1], words[2], headers
+
+	async def handle_request(self, reader, writer, timeout):
+		"""
+		read and answer one request. Returns True if the
+		connection may be used for another one
+		"""
+		try:
+			request = await self.read_request(reader, timeout)
+		except ValueError:
+			await self.send_error(writer, 400, 'Bad request')
+			return False
+		if request is None:
+			return False
+
+		method, target, version, headers = request
+		if method not in ('GET', 'HEAD', 'POST'):
+			# we don't know how to skip its body, so we close
+			await self.send_error(writer, 501, 'Unsupported method ({})'.format(method))
+			return False
+		head_only = method == 'HEAD'
+
+		connection = headers.get('connection', '').lower()
+		if self.draining:
+			# the client reconnects to whoever took over from us
+			keep_alive = False
+		elif version == 'HTTP/1.1':
+			keep_alive = 'close' not in connection
+		else:
+			keep_alive = 'keep-alive' in connection
+
+		# read the body even if we don't want it, it must not
+		# end up being read as the next request
+		body = b''
+		length = headers.get('content-length') or '0'
+		if not length.isdigit():
+			await self.send_error(writer, 400, 'Bad request')
+			return False
+		length = int(length)
+		if length > MAX_BODY:
+			await self.send_error(writer, 413, 'Request body too large')
+			return False
+		if length:
+			body = await asyncio.wait_for(reader.readexactly(length), REQUEST_TIMEOUT)
+
+		start = time.perf_counter()
+		route = None
+		try:
+			route = self.router.resolve(target)
+			# sampled by table entry, static files and misses by path
+			self.logger.info('{} received: {}'.format(method, target), extra={'sample_key': route.pattern or route.path})
+			if (method == 'POST') != (route.kind == ACTION):
+				status = await self.send_error(writer, 405, 'Method not allowed: {} {}'.format(method, target), keep_alive)
+			elif route.kind == ACTION:
+				code, content_type, body, extra = await self.loop.run_in_executor(None, route.handler, route.query, body)
+				if code >= 400:
+					status = await self.send_error(writer, code, body, keep_alive)
+				else:
+					status = await self.send_page(writer, code, content_type, body, False, extra, keep_alive)
+			elif route.kind == STREAM:
+				# open for as long as the client listens, nothing to time
+				await self.send_stream(writer, route.handler)
+				return False
+			elif route.kind == PAGE:
+				code, content_type, body, extra = await self.loop.run_in_executor(None, route.handler, route.query)
+				if code >= 400:
+					status = await self.send_error(writer, code, body, keep_alive)
+				else:
+					if etag_matches(headers.get('if-none-match'), dict(extra).get('ETag')):
+						code = 304
+					status = await self.send_page(writer, code, content_type, body, head_only, extra, keep_alive)
+			else:
+				status = await self.send_file(writer, route.handler, headers, head_only, keep_alive)
+		except self.unavailable_errors as e:
+			status = await self.send_error(writer, 503, 'Service unavailable: {}'.format(e), keep_alive)
+		except IOError:
+			status = await self.send_error(writer, 404, 'File Not Found: {}'.format(target), keep_alive)
+		except ValueError:
+			status = await self.send_error(writer, 403, 'WTF is this?: {}'.format(target), keep_alive)
+		self.observe(route, method, status, time.perf_counter() - start)
+		return keep_alive
+
+	def observe(self, route, method, status, elapsed):
+		"""
+		called after every answered request with its Route, None if it
+		couldn't be resolved. For subclasses collecting metrics
+		"""
+		return
+
+	def response_head(self, code, headers, keep_alive = False):
+		lines = ['HTTP/1.1 {} {}'.format(code, HTTPStatus(code).phrase)]
+		lines.append('Server: ' + self.server_version)
+		lines.append('Date: ' + email.utils.formatdate(usegmt=True))
+		lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+		for name, value in headers:
+			lines.append('{}: {}'.format(name, value))
+		return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+	async def send_page(self, writer, code, content_type, body, head_only = False, extra = (), keep_alive = False):
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		if code == 304:
+			writer.write(self.response_head(code, list(extra), keep_alive))
+		else:
+			writer.write(self.response_head(code, [('Content-type', content_type), ('Content-Length', len(body))] + list(extra), keep_alive))
+			if not head_only:
+				writer.write(body)
+		await writer.drain()
+		return code
+
+	async def send_error(self, writer, code, message, keep_alive = False):
+		body = ERROR_PAGE.format(code, HTTPStatus(code).phrase, message).encode('utf-8')
+		writer.write(self.response_head(code, [('Content-type', 'text/html;charset=utf-8'), ('Content-Length', len(body))], keep_alive))
+		writer.write(body)
+		await writer.drain()
+		return code
+
+	async def send_stream(self, writer, broadcaster):
+		"""
+		keep the connection open and forward every event the
+		broadcaster publishes as Server-Sent Event
+		"""
+		queue = asyncio.Queue()
+		loop = self.loop
+
+		def enqueue(name, data):
+			if queue.qsize() >= STREAM_BACKLOG:
+				# client doesn't keep up, let it reconnect
+				queue.put_nowait(None)
+			else:
+				queue.put_nowait((name, data))
+
+		def on_event(name, data):
+			loop.call_soon_threadsafe(enqueue, name, data)
+
+		writer.write(self.response_head(200, [
+			('Content-type', 'text/event-stream'),
+			('Cache-Control', 'no-cache')
+		]))
+		current = broadcaster.subscribe(on_event)
+		self.streams.add(queue)
+		try:
+			for name, data in current.items():
+				writer.write(format_event(name, data))
+			await writer.drain()
+			while not self.draining:
+				try:
+					event = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE)
+				except asyncio.TimeoutError:
+					writer.write(b': keepalive\n\n')
+				else:
+					if event is None:
+						return
+					writer.write(format_event(*event))
+				await writer.drain()
+		finally:
+			self.streams.discard(queue)
+			broadcaster.unsubscribe(on_event)
+		return
+
+	async def send_file(self, writer, path, headers, head_only = False, keep_alive = False):
+		"""
+		send a static file from the cache or stream it, reading
+		it in an executor thread. Returns the status code sent
+		"""
+		path, entry, f, fs = await self.loop.run_in_executor(None, self.open_file, path)
+		if entry is not None:
+			code, extra, body = entry.respond(headers.get('if-none-match'), headers.get('if-modified-since'), headers.get('accept-encoding'))
+			writer.write(self.response_head(code, extra, keep_alive))
+			if not head_only:
+				writer.write(body)
+			await writer.drain()
+			return code
+
+		try:
+			content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+			writer.write(self.response_head(200, [
+				('Content-type', content_type),
+				('Content-Length', fs.st_size),
+				('Last-Modified', email.utils.formatdate(fs.st_mtime, usegmt=True))
+			], keep_alive))
+			if head_only:
+				await writer.drain()
+				return 200
+			while True:
+				chunk = await self.loop.run_in_executor(None, f.read, FILE_CHUNK)
+				if not chunk:
+					break
+				writer.write(chunk)
+				await writer.drain()
+		finally:
+			f.close()
+		return 200
+
+	def open_file(self, path):
+		"""
+		(path, cache entry, file, stat) of a static file, the file
+		opened only if the cache doesn't have it. A directory's
+		index.html is served for it. Touches the disk, so it runs in
+		an executor thread
+		"""
+		if os.path.isdir(path):
+			path = os.path.join(path, 'index.html')
+		if self.static_cache is not None:
+			entry = self.static_cache.get(path)
+			if entry is not None:
+				return path, entry, None, None
+		f = open(path, 'rb')
+		try:
+			return path, None, f, os.fstat(f.fileno())
+		except OSError:
+			f.close()
+			raise
@@ -0,0 +1,1279 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks for the Paradium daemon
+
+	benchmark.py poll [options]
+
+has a number of clients poll a running server the way the web
+interface does and reports throughput and latency percentiles.
+With --keep-alive every client reuses one connection.
+
+	benchmark.py lookup [options]
+
+times station lookup and prev/next on generated catalogs of
+growing size, for random stations and for the same few again and
+again like the current one.
+
+	benchmark.py search [options]
+
+times station search queries on a generated catalog.
+
+	benchmark.py persist [options]
+
+taps through stations in bursts and counts how often the data
+model actually writes to disk.
+
+	benchmark.py tune [options]
+
+times switching stations against a fake MPD, one command per round
+trip against a single command list.
+
+	benchmark.py probe [options]
+
+probes a set of stand-in mirrors, fast, slow, broken and dead, and
+shows the order a station's urls would be tried in.
+
+	benchmark.py resolve [options]
+
+taps through stations published as playlists on a stand-in server,
+with and without resolving the next station ahead of time.
+
+	benchmark.py burst [options]
+
+fires bursts of next taps at a fake MPD, once tuning on every tap and
+once through the debouncing tuner, and counts the MPD commands sent.
+
+	benchmark.py logging [options]
+
+times what logging a request costs the thread handling it, with a
+file handler on the root logger and through the log pipeline.
+
+	benchmark.py dispatch [options]
+
+times resolving request targets with the router against the
+if/elif chain it replaced.
+
+	benchmark.py metrics [options]
+
+times what recording a request in the metrics costs and how long
+rendering /metrics takes.
+
+	benchmark.py load [options]
+
+starts paradium.py on a private port against an in-process fake MPD
+and a generated stations.xml, then runs the load scenarios one after
+the other: clients polling, bursts of next taps and fetching the
+static files of the web interface. Throughput, latency percentiles
+and the server's RSS can be written to a JSON file with --output and
+compared to an earlier run with --compare.
+
+	benchmark.py restart [options]
+
+has clients poll paradium.py while it is restarted a few times, either
+gracefully, handing the listening socket to a successor, or by
+stopping it and starting a new process. Exits with 1 if a graceful
+restart failed a single request.
+
+	benchmark.py history [options]
+
+records a few days of songs into the now playing history, counting
+the writes and bytes that reach the disk, and times recording a song
+and history queries. Exits with 1 if the history read back from its
+segments differs from what was recorded.
+
+	benchmark.py catalog [options]
+
+loads generated catalogs of growing size by parsing stations.xml into
+a list of stations, by compiling it and by mapping the compiled
+catalog, and shows time and Python memory of each. Exits with 1 if a
+station read from the compiled catalog differs from the parsed one.
+
+	benchmark.py import [options]
+
+imports a generated JSON directory dump, a share of its entries broken
+the ways community directories break them, and times the importer.
+Exits with 1 if the stations.xml written doesn't load or the broken
+entries aren't the ones skipped.
+
+	benchmark.py rooms [options]
+
+tunes several fake MPDs, one per room and each answering with its own
+latency, to a station one room after the other and as a group command
+sent to all rooms at once. Exits with 1 if a room doesn't end up
+playing the station.
+"""
+
+import sys, os
+import time
+import json
+import shutil
+import signal
+import socket
+import subprocess
+import threading
+import argparse
+import random
+import logging
+import tempfile
+import http.client
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+# the two endpoints every open browser tab polls
+POLL_PATHS = ('/current_station.html', '/current_song.html')
+
+# what a phone loads when it opens the web interface
+STATIC_PATHS = ('/index.html', '/jquery-1.11.0.js', '/jquery.mobile-1.4.2.min.js', '/jquery.mobile-1.4.2.min.css')
+
+# scenarios of benchmark.py load, in the order they run
+LOAD_SCENARIOS = ('poll', 'burst', 'static')
+
+# a mix of what the web interface requests
+DISPATCH_TARGETS = ('/current_station.html', '/current_song.html', '/status.json', '/paradium.html?command=next',
+	'/api/stations/search?q=jazz&offset=20', '/index.html', '/js/jquery.min.js', '/media/cover.png')
+
+# broken directory entries for benchmark.py import, whether they're to be imported anyway
+BROKEN_RECORDS = (
+	({'name': 'Control\u0001Char', 'url': 'http://a.example.com/'}, False),
+	({'name': 'Surrogate \ud800', 'url': 'http://a.example.com/'}, False),
+	({'name': 'Url List', 'urls': ['http://a.example.com/\u0008']}, False),
+	({'name': 'Url Numbers', 'urls': ['http://a.example.com/', 5]}, False),
+	({'name': {'en': 'Nested'}, 'url': 'http://a.example.com/'}, False),
+	({'name': 'Website List', 'url': 'http://a.example.com/', 'website': ['http://a.example.com/']}, False),
+	({'name': True, 'url': 'http://a.example.com/'}, False),
+	({'name': 'No Url', 'url': None}, False),
+	({'name': 7, 'url': 'http://a.example.com/'}, True),
+	({'name': 'Url Number', 'url': 5}, True),
+	({'name': 'Tab\tAnd\nNewline', 'url': 'http://a.example.com/ http://b.example.com/'}, True),
+)
+
+# generated station names are made of these
+NAME_WORDS = ('radio', 'fm', 'jazz', 'rock', 'classic', 'news', 'talk', 'paradise', 'deep', 'house',
+	'ambient', 'chill', 'berlin', 'london', 'paris', 'vienna', 'country', 'folk', 'metal', 'soul',
+	'funk', 'lounge', 'beat', 'hits', 'oldies', 'kids', 'sport', 'latino', 'salsa', 'techno',
+	'trance', 'blues', 'gospel', 'opera', 'public', 'college', 'underground', 'electro', 'indie', 'pop')
+
+
+def percentile(samples, p):
+	"""
+	p-th percentile of an already sorted list
+	"""
+	if not samples:
+		return 0.0
+	k = int(round((len(samples) - 1) * p / 100.0))
+	return samples[k]
+
+
+def summarize(latencies, errors, elapsed):
+	"""
+	throughput and latency percentiles (in ms) of the latencies
+	(in seconds) we collected, as dict
+	"""
+	latencies = sorted(latencies)
+	return {
+		'requests': len(latencies),
+		'errors': errors,
+		'seconds': round(elapsed, 3),
+		'throughput': round(len(latencies) / elapsed if elapsed else 0.0, 1),
+		'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+		'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+		'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+		'max_ms': round(percentile(latencies, 100) * 1000, 3)
+	}
+
+
+def report(name, latencies, errors, elapsed):
+	"""
+	print a summary of the latencies (in seconds) we collected
+	"""
+	print_summary(name, summarize(latencies, errors, elapsed))
+	return
+
+
+def print_summary(name, summary):
+	print('{}: {} requests, {} errors in {:.1f}s ({:.1f} req/s)'.format(
+		name, summary['requests'], summary['errors'], summary['seconds'], summary['throughput']))
+	print('  latency ms  p50 {:.2f}  p95 {:.2f}  p99 {:.2f}  max {:.2f}'.format(
+		summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], summary['max_ms']))
+	return
+
+
+def write_stations_xml(filename, count):
+	"""
+	generate a stations.xml with count stations
+	"""
+	rnd = random.Random(count)
+	with open(filename, 'w') as f:
+		f.write('<?xml version="1.0" ?>\n<stations>\n')
+		for i in range(1, count + 1):
+			name = ' '.join(w.capitalize() for w in rnd.sample(NAME_WORDS, rnd.randint(1, 3)))
+			f.write('\t<station id="{0}">\n\t\t<name>{1}</name>\n'.format(i, escape('{} {}'.format(name, i))))
+			f.write('\t\t<url>http://stream{0}.example.com/live</url>\n'.format(i))
+			f.write('\t\t<url>http://mirror{0}.example.com/live</url>\n'.format(i))
+			f.write('\t\t<website>http://www{0}.example.com/</website>\n\t</station>\n'.format(i))
+		f.write('</stations>\n')
+	return
+
+
+class PollingClient(threading.Thread):
+	"""
+	fetches the poll endpoints over and over until told to stop
+	"""
+
+	def __init__(self, host, port, paths, interval, stop, keep_alive = False):
+		threading.Thread.__init__(self, daemon=True)
+		self.host = host
+		self.port = port
+		self.paths = paths
+		self.interval = interval
+		self.stop = stop
+		self.keep_alive = keep_alive
+		self.conn = None
+		self.connects = 0
+		self.latencies = []
+		self.errors = 0
+
+	def fetch(self, path):
+		if self.conn is None:
+			self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+			self.connects += 1
+		try:
+			self.conn.request('GET', path)
+			response = self.conn.getresponse()
+			response.read()
+		except (OSError, http.client.HTTPException):
+			self.conn.close()
+			self.conn = None
+			raise
+		if not self.keep_alive or response.will_close:
+			self.conn.close()
+			self.conn = None
+		return response.status
+
+	def run(self):
+		while not self.stop.is_set():
+			for path in self.paths:
+				start = time.perf_counter()
+				try:
+					status = self.fetch(path)
+					if status >= 400:
+						self.errors += 1
+				except (OSError, http.client.HTTPException):
+					self.errors += 1
+					continue
+				self.latencies.append(time.perf_counter() - start)
+			if self.interval:
+				self.stop.wait(self.interval)
+
+
+def bench_poll(args):
+	url = urlparse(args.url)
+	stop = threading.Event()
+	clients = [PollingClient(url.hostname, url.port or 80, POLL_PATHS, args.interval, stop, args.keep_alive) for i in range(args.clients)]
+
+	start = time.perf_counter()
+	for c in clients:
+		c.start()
+	time.sleep(args.duration)
+	stop.set()
+	for c in clients:
+		c.join()
+	elapsed = time.perf_counter() - start
+
+	latencies = []
+	for c in clients:
+		latencies.extend(c.latencies)
+	report('poll {} clients{}'.format(args.clients, ' keep-alive' if args.keep_alive else ''), latencies, sum(c.errors for c in clients), elapsed)
+	print('  {} connections opened'.format(sum(c.connects for c in clients)))
+	return
+
+
+def bench_lookup(args):
+	from stations import Stations
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	tmpdir = tempfile.mkdtemp()
+	filename = os.path.join(tmpdir, 'stations.xml')
+	try:
+		for count in args.sizes:
+			write_stations_xml(filename, count)
+			start = time.perf_counter()
+			stations = Stations(logger, filename)
+			load = time.perf_counter() - start
+
+			ids = [random.randint(1, count) for i in range(args.lookups)]
+			hot = [random.randint(1, min(count, 5)) for i in range(args.lookups)]
+			results = []
+			for name, lookup, ids in (('get_station', stations.get_station, ids), ('get_station hot', stations.get_station, hot),
+					('get_next', stations.get_next, ids), ('get_prev', stations.get_prev, ids)):
+				start = time.perf_counter()
+				for id in ids:
+					lookup(id)
+				results.append('{} {:.0f}ns'.format(name, (time.perf_counter() - start) / len(ids) * 1e9))
+			print('{:>7} stations: load {:.3f}s  {}'.format(count, load, '  '.join(results)))
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	return
+
+
+def bench_search(args):
+	from stations import Stations
+	from search import StationIndex
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	tmpdir = tempfile.mkdtemp()
+	filename = os.path.join(tmpdir, 'stations.xml')
+	try:
+		write_stations_xml(filename, args.size)
+		stations = Stations(logger, filename)
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+
+	start = time.perf_counter()
+	index = StationIndex(stations.stations)
+	print('{} stations, index built in {:.3f}s, {} words'.format(args.size, time.perf_counter() - start, len(index.words)))
+
+	rnd = random.Random(0)
+	queries = []
+	for i in range(args.queries):
+		words = rnd.sample(NAME_WORDS, rnd.randint(1, 2))
+		# typing in progress, last word cut off
+		words[-1] = words[-1][:rnd.randint(2, len(words[-1]))]
+		queries.append(' '.join(words))
+
+	for cached in (False, True):
+		latencies = []
+		for q in queries:
+			if not cached:
+				index.cache.clear()
+			start = time.perf_counter()
+			index.page(q, 0, 20)
+			latencies.append(time.perf_counter() - start)
+		latencies.sort()
+		print('{:>8}: p50 {:.3f}ms  p95 {:.3f}ms  p99 {:.3f}ms  max {:.3f}ms'.format(
+			'cached' if cached else 'uncached',
+			percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+			percentile(latencies, 99) * 1000, percentile(latencies, 100) * 1000))
+	return
+
+
+def bench_persist(args):
+	import datamodel
+
+	datamodel.FLUSH_DELAY = args.delay
+	datamodel.FLUSH_MAX_DELAY = args.max_delay
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	tmpdir = tempfile.mkdtemp()
+	try:
+		dm = datamodel.DataModel(logger, tmpdir)
+		dm.persist()
+		writes = dm.writes
+
+		# bursts of next/prev taps with pauses in between
+		rnd = random.Random(0)
+		start = time.perf_counter()
+		while time.perf_counter() - start < args.duration:
+			for i in range(rnd.randint(1, 8)):
+				dm.set_current_station(rnd.randint(1, 100))
+				time.sleep(args.tap_interval)
+			time.sleep(rnd.uniform(0.5, 3.0))
+		elapsed = time.perf_counter() - start
+		# let the last change get written
+		time.sleep(args.delay + 0.5)
+
+		writes = dm.writes - writes
+		print('{} changes, {} writes in {:.1f}s (quiet {}s, max {}s)'.format(dm.changes, writes, elapsed, args.delay, args.max_delay))
+		print('  per hour: {:.0f} writes instead of {:.0f}'.format(writes * 3600 / elapsed, dm.changes * 3600 / elapsed))
+	finally:
+		for name in os.listdir(tmpdir):
+			os.remove(os.path.join(tmpdir, name))
+		os.rmdir(tmpdir)
+	return
+
+
+def bench_tune(args):
+	from fakempd import FakeMPDServer
+	from mpdconnection import MPDConnection
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	server = FakeMPDServer(latency=args.latency).start()
+	conn = MPDConnection('127.0.0.1', server.port, logger)
+	conn.ping()
+	urls = ['http://stream{}.example.com/live'.format(i) for i in range(args.urls)]
+
+	def one_by_one():
+		conn.stop()
+		conn.clear()
+		for url in urls:
+			conn.add(url)
+		conn.play()
+
+	def command_list():
+		conn.command_list([('stop',), ('clear',)] + [('add', url) for url in urls] + [('play',)])
+
+	for name, switch in (('one by one', one_by_one), ('command list', command_list)):
+		server.mpd.reset_counters()
+		latencies = []
+		for i in range(args.switches):
+			start = time.perf_counter()
+			switch()
+			latencies.append(time.perf_counter() - start)
+		latencies.sort()
+		print('{:>12}: tap to play p50 {:.1f}ms  p95 {:.1f}ms  max {:.1f}ms, {:.0f} round trips per switch'.format(
+			name, percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+			percentile(latencies, 100) * 1000, server.mpd.round_trips / args.switches))
+	conn.close()
+	server.shutdown()
+	return
+
+
+def bench_probe(args):
+	import asyncio
+	from fakestream import FakeStreamServer
+	from prober import StreamProber
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	servers = [FakeStreamServer(dead=True).start(), FakeStreamServer(status=404).start()]
+	servers.extend(FakeStreamServer(delay=delay).start() for delay in args.delays)
+	urls = [server.url() for server in servers]
+	urls.append('http://127.0.0.1:1/refused')
+
+	prober = StreamProber(logger, lambda: urls, concurrency=args.concurrency, timeout=args.timeout)
+	for i in range(args.rounds):
+		asyncio.run(prober.probe_all(urls))
+		print('round {}: {urls} urls, {healthy} healthy in {seconds}s'.format(i + 1, **prober.last_round))
+	for url in prober.order(urls):
+		h = prober.health[url].as_dict()
+		if h['healthy']:
+			print('  {:<32} connect {:>6.1f}ms  first byte {:>6.1f}ms'.format(url, h['connect_ms'], h['first_byte_ms']))
+		else:
+			print('  {:<32} failing: {}'.format(url, h['error']))
+	for server in servers:
+		server.stop()
+	return
+
+
+def bench_resolve(args):
+	from fakestream import FakeStreamServer
+	from resolver import StreamResolver
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	server = FakeStreamServer(delay=args.latency).start()
+	playlists = []
+	for i in range(args.stations):
+		playlist = '[playlist]\nNumberOfEntries=1\nFile1={}\n'.format(server.url('/live{}'.format(i)))
+		playlists.append(server.add_file('/station{}.pls'.format(i), playlist, 'audio/x-scpls'))
+	# every other station redirects to its playlist
+	for i in range(0, args.stations, 2):
+		playlists[i] = server.redirect('/old{}'.format(i), playlists[i])
+
+	for prefetch in (False, True):
+		resolver = StreamResolver(logger)
+		resolver.start()
+		latencies = []
+		current = 0
+		for tap in range(args.taps):
+			if prefetch:
+				resolver.prefetch([playlists[(current + 1) % args.stations], playlists[current - 1]])
+			time.sleep(args.tap_interval)
+			current = (current + 1) % args.stations
+			start = time.perf_counter()
+			resolver.resolve([playlists[current]])
+			latencies.append(time.perf_counter() - start)
+		latencies.sort()
+		stats = resolver.stats()
+		print('{:>11}: resolve per tap p50 {:.1f}ms  p95 {:.1f}ms, hit rate {}, {}ms saved'.format(
+			'prefetch' if prefetch else 'on demand', percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+			stats['hit_rate'], stats['saved_ms']))
+	server.stop()
+	return
+
+
+def bench_burst(args):
+	from fakempd import FakeMPDServer
+	from mpdconnection import MPDConnection
+	from tuner import TuneScheduler
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	server = FakeMPDServer(latency=args.latency).start()
+	conn = MPDConnection('127.0.0.1', server.port, logger)
+	conn.ping()
+
+	def play(id):
+		urls = ['http://stream{}.example.com/live'.format(id), 'http://mirror{}.example.com/live'.format(id)]
+		conn.command_list([('stop',), ('clear',)] + [('add', url) for url in urls] + [('play',)])
+
+	tuner = TuneScheduler(play, logger, args.delay)
+	failed = False
+	for name, tap in (('every tap', play), ('debounced', tuner.request)):
+		server.mpd.reset_counters()
+		id = 0
+		start = time.perf_counter()
+		for burst in range(args.bursts):
+			for i in range(args.taps):
+				id += 1
+				tap(id)
+				time.sleep(args.tap_interval)
+			tuner.wait_idle()
+			time.sleep(args.pause)
+		elapsed = time.perf_counter() - start
+		adds = server.mpd.commands.get('add', 0)
+		print('{:>10}: {} bursts of {} taps, {} MPD commands in {} round trips, {} streams added ({:.1f}s)'.format(
+			name, args.bursts, args.taps, server.mpd.total_commands(), server.mpd.round_trips, adds, elapsed))
+		# the last station of every burst, nothing else
+		if tap is not play:
+			failed = adds != args.bursts * 2 or server.mpd.playlist != ['http://stream{}.example.com/live'.format(id), 'http://mirror{}.example.com/live'.format(id)]
+	print('  tuner: {}'.format(tuner.stats()))
+	conn.close()
+	server.shutdown()
+	if failed:
+		print('FAILED: expected one tune per burst, to its last station')
+		sys.exit(1)
+	return
+
+
+def bench_logging(args):
+	import logging.handlers
+	from logpipe import LogPipeline, SamplingFilter, LOG_FORMAT, LOG_DATEFMT
+
+	tmpdir = tempfile.mkdtemp()
+	try:
+		# what paradium.py and daemon.py used to set up between them
+		direct = logging.getLogger('benchmark.direct')
+		direct.propagate = False
+		direct.setLevel(logging.DEBUG)
+		handlers = []
+		for name in ('direct.log', 'daemon.log'):
+			handler = logging.handlers.TimedRotatingFileHandler(os.path.join(tmpdir, name), when='midnight', backupCount=1)
+			handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATEFMT))
+			direct.addHandler(handler)
+			handlers.append(handler)
+
+		sampling = SamplingFilter(limits={'/status.json': 1})
+		pipeline = LogPipeline(os.path.join(tmpdir, 'pipeline.log'), logging.DEBUG, sampling)
+		pipeline.start()
+		root = logging.getLogger()
+
+		runs = (
+			('two file handlers', lambda: direct.info('GET received: {}'.format('/current_song.html'))),
+			('pipeline', lambda: root.info('GET received: {}'.format('/api/stations'))),
+			('pipeline, sampled', lambda: root.info('GET received: {}'.format('/status.json'), extra={'sample_key': '/status.json'}))
+		)
+		for name, log in runs:
+			start = time.perf_counter()
+			for i in range(args.records):
+				log()
+			elapsed = time.perf_counter() - start
+			print('{:>18}: {:.2f}us per request on the handler thread'.format(name, elapsed / args.records * 1e6))
+			# don't let the backlog of one run slow down the next
+			while pipeline.queue.qsize():
+				time.sleep(0.01)
+
+		pipeline.stop()
+		print('  lines written: {} by the file handlers, {} through the pipeline'.format(
+			sum(1 for name in ('direct.log', 'daemon.log') for line in open(os.path.join(tmpdir, name))),
+			sum(1 for line in open(os.path.join(tmpdir, 'pipeline.log')))))
+		print('  {}'.format(pipeline.stats()))
+		for handler in handlers:
+			handler.close()
+		pipeline.filehandler.close()
+	finally:
+		for name in os.listdir(tmpdir):
+			os.remove(os.path.join(tmpdir, name))
+		os.rmdir(tmpdir)
+	return
+
+
+def legacy_dispatch(target, pages, mounts):
+	"""
+	what do_GET did before the router: parse, walk the paths,
+	parse again in translate_path
+	"""
+	path = urlparse(target)[2]
+	for name in pages:
+		if path == name:
+			return parse_qs(urlparse(target)[4])
+	for prefix, root in mounts:
+		if target.startswith(prefix):
+			break
+	words = filter(None, os.path.normpath(unquote(urlparse(target)[2])).split('/'))
+	for word in words:
+		root = os.path.join(root, os.path.split(os.path.splitdrive(word)[1])[1])
+	return root
+
+
+def bench_dispatch(args):
+	from router import Router
+
+	page = lambda query: None
+	pages = dict((path, page) for path in ('/paradium.html', '/current_song.html', '/current_station.html', '/status.json',
+		'/api/mpd', '/api/catalog', '/api/state', '/api/static', '/api/stations', '/api/stations/search'))
+	mounts = (('/media', '/var/www/media'), ('', '/opt/paradium/htdocs'))
+	router = Router(pages, {'/events': object()}, mounts)
+
+	targets = [DISPATCH_TARGETS[i % len(DISPATCH_TARGETS)] for i in range(args.requests)]
+	for name, dispatch in (('if/elif chain', lambda t: legacy_dispatch(t, pages, mounts)), ('router', router.resolve)):
+		start = time.perf_counter()
+		for target in targets:
+			dispatch(target)
+		elapsed = time.perf_counter() - start
+		print('{:>14}: {:.2f}us per request'.format(name, elapsed / len(targets) * 1e6))
+	return
+
+
+def bench_metrics(args):
+	import metrics
+
+	registry = metrics.Registry()
+	duration = registry.histogram('requests', 'request latency', ('route', 'method', 'status'))
+	errors = registry.counter('errors', 'errors', ('route',))
+	registry.add_process_metrics()
+	routes = ['/status.json', '/current_song.html', '/api/stations', 'static']
+
+	start = time.perf_counter()
+	for i in range(args.observations):
+		duration.labels(routes[i % len(routes)], 'GET', '200').observe(random.random() / 10)
+	elapsed = time.perf_counter() - start
+	print('{:>14}: {:.2f}us'.format('observe', elapsed / args.observations * 1e6))
+
+	start = time.perf_counter()
+	for i in range(args.observations):
+		errors.labels(routes[i % len(routes)]).inc()
+	elapsed = time.perf_counter() - start
+	print('{:>14}: {:.2f}us'.format('count', elapsed / args.observations * 1e6))
+
+	start = time.perf_counter()
+	for i in range(100):
+		text = registry.render()
+	elapsed = time.perf_counter() - start
+	print('{:>14}: {:.2f}ms, {} lines'.format('render', elapsed / 100 * 1e3, text.count('\n')))
+	return
+
+
+class LoadTarget():
+	"""
+	paradium.py foreground on a free port, with an in-process fake MPD
+	and a catalog of generated stations in a scratch PARADIUM_HOME
+	"""
+
+	def __init__(self, stations, latency, server = 'async'):
+		self.stations = stations
+		self.latency = latency
+		self.server = server
+		self.process = None
+		self.mpd = None
+		self.tmpdir = None
+		self.port = None
+		self.pidfile = None
+
+	def start(self, timeout = 30.0):
+		from fakempd import FakeMPDServer
+
+		self.tmpdir = tempfile.mkdtemp(prefix='paradium-load-')
+		htdocs = os.path.join(self.tmpdir, 'home', 'htdocs')
+		vhome = os.path.join(self.tmpdir, 'var')
+		os.makedirs(htdocs)
+		os.makedirs(vhome)
+		# the real web interface, but our own catalog
+		source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'htdocs')
+		for name in os.listdir(source):
+			if name != 'stations.xml':
+				os.symlink(os.path.join(source, name), os.path.join(htdocs, name))
+		write_stations_xml(os.path.join(htdocs, 'stations.xml'), self.stations)
+
+		self.mpd = FakeMPDServer(latency=self.latency).start()
+		with socket.socket() as s:
+			s.bind(('127.0.0.1', 0))
+			self.port = s.getsockname()[1]
+
+		self.pidfile = os.path.join(self.tmpdir, 'paradium.pid')
+		self.env = dict(os.environ,
+			PARADIUM_HOME=os.path.join(self.tmpdir, 'home'),
+			PARADIUM_VHOME=vhome + '/',
+			PARADIUM_MPDHOST='127.0.0.1',
+			PARADIUM_MPDPORT=str(self.mpd.port),
+			PARADIUM_PORT=str(self.port),
+			PARADIUM_PIDFILE=self.pidfile,
+			PARADIUM_SERVER=self.server)
+		self.log = open(os.path.join(self.tmpdir, 'server.log'), 'wb')
+		return self.spawn(timeout)
+
+	def spawn(self, timeout = 30.0):
+		"""
+		start paradium.py and wait until it answers
+		"""
+		self.process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'paradium.py'), 'foreground'],
+			env=self.env, stdout=self.log, stderr=subprocess.STDOUT)
+
+		deadline = time.monotonic() + timeout
+		while time.monotonic() < deadline:
+			if self.process.poll() is not None:
+				raise RuntimeError('paradium.py exited with {}, see {}'.format(self.process.returncode, self.log.name))
+			try:
+				conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+				conn.request('GET', '/status.json')
+				conn.getresponse().read()
+				conn.close()
+				return self
+			except (OSError, http.client.HTTPException):
+				time.sleep(0.1)
+		raise RuntimeError('paradium.py did not answer within {:.0f}s'.format(timeout))
+
+	def pid(self):
+		"""
+		the serving process, a successor writes its pid to the pidfile
+		"""
+		try:
+			with open(self.pidfile) as f:
+				return int(f.read())
+		except (OSError, ValueError):
+			return self.process.pid
+
+	def rss(self):
+		"""
+		resident set size of the server in bytes
+		"""
+		with open('/proc/{}/statm'.format(self.pid())) as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+	def graceful_restart(self, timeout = 30.0):
+		"""
+		have the server hand over to a successor, returns the seconds until it took over
+		"""
+		old = self.pid()
+		start = time.perf_counter()
+		os.kill(old, signal.SIGUSR2)
+		deadline = time.monotonic() + timeout
+		while self.pid() == old:
+			if time.monotonic() > deadline:
+				raise RuntimeError('no successor took over from {}'.format(old))
+			time.sleep(0.01)
+		return time.perf_counter() - start
+
+	def cold_restart(self, timeout = 30.0):
+		"""
+		stop the server and start a new one, returns the seconds it took
+		"""
+		start = time.perf_counter()
+		self.kill()
+		self.spawn(timeout)
+		return time.perf_counter() - start
+
+	def kill(self):
+		pid = self.pid()
+		if self.process.poll() is None:
+			self.process.send_signal(signal.SIGINT)
+			try:
+				self.process.wait(5)
+			except subprocess.TimeoutExpired:
+				self.process.kill()
+				self.process.wait()
+		if pid != self.process.pid:
+			# a successor, not our child
+			try:
+				os.kill(pid, signal.SIGINT)
+				for i in range(50):
+					os.kill(pid, 0)
+					time.sleep(0.1)
+				os.kill(pid, signal.SIGKILL)
+			except ProcessLookupError:
+				pass
+		if os.path.exists(self.pidfile):
+			os.remove(self.pidfile)
+		return
+
+	def stop(self):
+		if self.process is not None:
+			self.kill()
+		if self.mpd is not None:
+			self.mpd.shutdown()
+			self.mpd.server_close()
+		if self.tmpdir is not None:
+			self.log.close()
+			shutil.rmtree(self.tmpdir, ignore_errors=True)
+		return
+
+
+def run_scenario(target, name, args):
+	"""
+	run one load scenario for args.duration seconds, returns its summary
+	"""
+	stop = threading.Event()
+	host, port = '127.0.0.1', target.port
+	if name == 'poll':
+		clients = [PollingClient(host, port, POLL_PATHS, args.interval, stop, args.keep_alive) for i in range(args.clients)]
+	elif name == 'burst':
+		taps = ['/paradium.html?command=next'] * args.taps
+		clients = [PollingClient(host, port, taps, args.pause, stop, args.keep_alive) for i in range(args.pressers)]
+	else:
+		clients = [PollingClient(host, port, STATIC_PATHS, 0.0, stop, args.keep_alive) for i in range(args.clients)]
+
+	target.mpd.mpd.reset_counters()
+	rss_start = rss_peak = target.rss()
+	start = time.perf_counter()
+	for c in clients:
+		c.start()
+	while time.perf_counter() - start < args.duration:
+		time.sleep(0.1)
+		rss_peak = max(rss_peak, target.rss())
+	stop.set()
+	for c in clients:
+		c.join()
+	elapsed = time.perf_counter() - start
+
+	latencies = []
+	for c in clients:
+		latencies.extend(c.latencies)
+	summary = summarize(latencies, sum(c.errors for c in clients), elapsed)
+	summary.update({
+		'clients': len(clients),
+		'connections': sum(c.connects for c in clients),
+		'mpd_commands': target.mpd.mpd.total_commands(),
+		'mpd_round_trips': target.mpd.mpd.round_trips,
+		'rss_start_mb': round(rss_start / 2**20, 1),
+		'rss_peak_mb': round(rss_peak / 2**20, 1),
+		'rss_end_mb': round(target.rss() / 2**20, 1)
+	})
+	return summary
+
+
+def compare_runs(old, new):
+	"""
+	print throughput and latency of two load reports side by side
+	"""
+	print('compared to {} ({})'.format(old.get('commit') or '?', old.get('date')))
+	for name, summary in new['scenarios'].items():
+		before = old.get('scenarios', {}).get(name)
+		if before is None:
+			continue
+		for key in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'rss_peak_mb'):
+			a, b = before[key], summary[key]
+			change = '{:+.1f}%'.format((b - a) / a * 100) if a else 'n/a'
+			print('  {:>7} {:>12}: {:>10} -> {:>10}  {}'.format(name, key, a, b, change))
+	return
+
+
+def bench_load(args):
+	try:
+		commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+			cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+	except OSError:
+		commit = None
+	results = {
+		'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'commit': commit,
+		'settings': {
+			'server': args.server,
+			'stations': args.stations,
+			'mpd_latency': args.latency,
+			'duration': args.duration,
+			'clients': args.clients,
+			'pressers': args.pressers,
+			'keep_alive': args.keep_alive
+		},
+		'scenarios': {}
+	}
+
+	target = LoadTarget(args.stations, args.latency, args.server)
+	try:
+		target.start()
+		results['rss_idle_mb'] = round(target.rss() / 2**20, 1)
+		for name in args.scenarios:
+			summary = results['scenarios'][name] = run_scenario(target, name, args)
+			print_summary('{} ({} clients)'.format(name, summary['clients']), summary)
+			print('  {} connections, {} MPD commands in {} round trips, RSS {} -> {} MB (peak {})'.format(
+				summary['connections'], summary['mpd_commands'], summary['mpd_round_trips'],
+				summary['rss_start_mb'], summary['rss_end_mb'], summary['rss_peak_mb']))
+	finally:
+		target.stop()
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+	if args.compare:
+		with open(args.compare) as f:
+			compare_runs(json.load(f), results)
+	return
+
+
+def bench_restart(args):
+	target = LoadTarget(args.stations, args.latency, args.server)
+	stop = threading.Event()
+	try:
+		target.start()
+		clients = [PollingClient('127.0.0.1', target.port, POLL_PATHS + STATIC_PATHS[:1], args.interval, stop, args.keep_alive) for i in range(args.clients)]
+		start = time.perf_counter()
+		for c in clients:
+			c.start()
+		pids = [target.pid()]
+		took = []
+		for i in range(args.restarts):
+			time.sleep(args.every)
+			if args.mode == 'graceful':
+				took.append(target.graceful_restart())
+			else:
+				took.append(target.cold_restart())
+			pids.append(target.pid())
+		time.sleep(args.every)
+		stop.set()
+		for c in clients:
+			c.join()
+		elapsed = time.perf_counter() - start
+	finally:
+		stop.set()
+		target.stop()
+
+	latencies = []
+	for c in clients:
+		latencies.extend(c.latencies)
+	errors = sum(c.errors for c in clients)
+	report('{} restarts ({}, {} clients{})'.format(args.restarts, args.mode, args.clients, ' keep-alive' if args.keep_alive else ''),
+		latencies, errors, elapsed)
+	print('  pids {}, restarts took {}'.format(' -> '.join(str(pid) for pid in pids),
+		', '.join('{:.2f}s'.format(t) for t in took)))
+	if args.mode == 'graceful' and (errors or len(set(pids)) != len(pids)):
+		print('FAILED: expected every restart to hand over without a failed request')
+		sys.exit(1)
+	return
+
+
+def bench_rooms(args):
+	from fakempd import FakeMPDServer
+	from mpdconnection import MPDConnection, COMMAND_LIST
+	from datamodel import DataModel
+	from rooms import Room, Rooms
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	vhome = tempfile.mkdtemp(prefix='paradium-rooms-')
+	servers = [FakeMPDServer(latency=latency).start() for latency in args.latencies]
+	all_rooms = []
+	for i, server in enumerate(servers):
+		name = 'room{}'.format(i)
+		os.makedirs(os.path.join(vhome, name))
+		conn = MPDConnection('127.0.0.1', server.port, logger, name='mpd-' + name)
+		conn.ping()
+		all_rooms.append(Room(name, conn, DataModel(logger, os.path.join(vhome, name))))
+	rooms = Rooms(all_rooms)
+
+	def switch(station):
+		urls = ['http://stream{}.example.com/{}'.format(station, i) for i in range(args.urls)]
+		return [('stop',), ('clear',)] + [('add', url) for url in urls] + [('play',)]
+
+	def one_by_one(station):
+		for room in rooms:
+			room.client.command_list(switch(station))
+
+	def group(station):
+		rooms.run([(room, COMMAND_LIST, switch(station)) for room in rooms])
+
+	failed = False
+	try:
+		for name, tune in (('one by one', one_by_one), ('group', group)):
+			latencies = []
+			for i in range(args.switches):
+				start = time.perf_counter()
+				tune(i)
+				latencies.append(time.perf_counter() - start)
+				expected = [command[1] for command in switch(i) if command[0] == 'add']
+				for server in servers:
+					if server.mpd.playlist != expected or server.mpd.state != 'play':
+						failed = True
+			latencies.sort()
+			print('{:>12}: {} rooms, p50 {:.1f}ms  p95 {:.1f}ms  max {:.1f}ms'.format(name, len(rooms),
+				percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 100) * 1000))
+		print('  slowest room answers in {:.1f}ms, all of them together in {:.1f}ms'.format(
+			max(args.latencies) * 1000, sum(args.latencies) * 1000))
+	finally:
+		for room, server in zip(rooms, servers):
+			room.client.close()
+			server.shutdown()
+		shutil.rmtree(vhome, ignore_errors=True)
+	if failed:
+		print('FAILED: a room did not end up playing the station it was tuned to')
+		sys.exit(1)
+	return
+
+
+def bench_history(args):
+	import history
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	tmpdir = tempfile.mkdtemp(prefix='paradium-history-')
+	try:
+		log = history.History(logger, tmpdir)
+		# a song every few minutes, hopping between stations now and then
+		rnd = random.Random(0)
+		now = time.time() - args.days * 86400
+		songs = []
+		while now < time.time():
+			now += rnd.uniform(120, 360)
+			station = rnd.randint(1, 50) if rnd.random() < 0.1 or not songs else songs[-1][0]
+			songs.append((station, 'Artist {} - Song {}'.format(rnd.randint(1, 5000), rnd.randint(1, 20)), now))
+
+		start = time.perf_counter()
+		for station, title, when in songs:
+			log.record(station, title, when)
+		took = time.perf_counter() - start
+		log.persist()
+		stats = log.stats()
+		size = sum(os.path.getsize(path) for number, path in log.segments())
+		print('{} songs in {} days: {:.1f}us per song, {:.1f} bytes per song on disk, {} segments with {} bytes'.format(
+			len(songs), args.days, took / len(songs) * 1e6, size / stats['songs'], stats['segments'], size))
+		print('  {:.0f} songs an hour are written at most {:.0f} times an hour instead of {:.0f}'.format(
+			len(songs) / (args.days * 24), 3600 / history.FLUSH_INTERVAL, len(songs) / (args.days * 24)))
+
+		for name, query in (('last hour', {'since': time.time() - 3600}),
+				('since yesterday', {'since': time.time() - 86400, 'limit': history.HISTORY_LIMIT_MAX}),
+				('one station', {'station': songs[-1][0]})):
+			start = time.perf_counter()
+			for i in range(args.queries):
+				found = log.query(**query)
+			print('{:>16}: {:.1f}us per query, {} songs'.format(name, (time.perf_counter() - start) / args.queries * 1e6, len(found)))
+
+		restored = history.History(logger, tmpdir)
+		expected = [e.as_dict() for e in log.query(limit=log.size)]
+		if [e.as_dict() for e in restored.query(limit=log.size)] != expected:
+			print('FAILED: the history read back from disk differs')
+			sys.exit(1)
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	return
+
+
+def bench_catalog(args):
+	import tracemalloc
+	from stations import Stations, iter_stations
+	from catalog import CACHE_SUFFIX
+
+	logger = logging.getLogger('benchmark')
+	logger.setLevel(logging.WARNING)
+	tmpdir = tempfile.mkdtemp(prefix='paradium-catalog-')
+	filename = os.path.join(tmpdir, 'stations.xml')
+	failed = False
+
+	def measure(load, before = lambda: None):
+		"""
+		time load, then run it again to see the memory it holds,
+		tracing would slow it down
+		"""
+		before()
+		start = time.perf_counter()
+		load()
+		elapsed = time.perf_counter() - start
+		before()
+		tracemalloc.start()
+		loaded = load()
+		memory = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		return loaded, elapsed, memory
+
+	def remove_compiled():
+		if os.path.exists(filename + CACHE_SUFFIX):
+			os.remove(filename + CACHE_SUFFIX)
+
+	try:
+		for count in args.sizes:
+			write_stations_xml(filename, count)
+
+			def parse():
+				parsed = list(iter_stations(filename))
+				return parsed, {s.id: i for i, s in enumerate(parsed)}
+
+			(parsed, index), parse_time, parse_memory = measure(parse)
+			compiled, compile_time, compile_memory = measure(lambda: Stations(logger, filename), remove_compiled)
+			mapped, map_time, map_memory = measure(lambda: Stations(logger, filename))
+			# a station view costs this much while somebody holds it
+			views, view_time, view_memory = measure(lambda: [mapped.get_station(s.id) for s in parsed[:args.touch]])
+
+			for s, view in zip(parsed, views):
+				if s.as_dict() != view.as_dict():
+					failed = True
+			rnd = random.Random(count)
+			ids = [rnd.randint(1, count) for i in range(args.lookups)]
+			start = time.perf_counter()
+			for id in ids:
+				mapped.get_station(id)
+			lookup = (time.perf_counter() - start) / len(ids)
+
+			print('{:>7} stations, {:.1f}MB compiled'.format(count, os.path.getsize(filename + CACHE_SUFFIX) / 1e6))
+			print('    parse: {:8.3f}s  {:8.1f}MB'.format(parse_time, parse_memory / 1e6))
+			print('  compile: {:8.3f}s  {:8.1f}MB'.format(compile_time, compile_memory / 1e6))
+			print('      map: {:8.4f}s  {:8.1f}MB, get_station {:.1f}us, {} stations touched {:.2f}MB'.format(
+				map_time, map_memory / 1e6, lookup * 1e6, len(views), view_memory / 1e6))
+			del parsed, index, compiled, mapped, views
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	if failed:
+		print('FAILED: stations read from the compiled catalog differ from stations.xml')
+		sys.exit(1)
+	return
+
+
+def bench_import(args):
+	import io
+	from importer import import_stations
+	from stations import iter_stations
+
+	rnd = random.Random(args.count)
+	records = []
+	expected = 0
+	for i in range(args.count):
+		if rnd.random() < args.broken:
+			record, valid = rnd.choice(BROKEN_RECORDS)
+		else:
+			name = ' '.join(w.capitalize() for w in rnd.sample(NAME_WORDS, rnd.randint(1, 3)))
+			record, valid = {'name': name, 'url_resolved': 'http://stream{}.example.com/live'.format(i), 'homepage': 'http://www{}.example.com/'.format(i)}, True
+		records.append(json.dumps(record))
+		expected += valid
+	dump = io.StringIO('\n'.join(records))
+
+	output = io.StringIO()
+	result = import_stations(dump, output, 'json')
+	print('{imported} stations imported, {skipped} skipped in {seconds}s ({per_second}/s)'.format(**result))
+
+	errors = []
+	try:
+		loaded = sum(1 for s in iter_stations(io.BytesIO(output.getvalue().encode('utf-8')), errors))
+	except SyntaxError as e:
+		print('FAILED: the stations.xml written doesn\'t load: {}'.format(e))
+		sys.exit(1)
+	print('{} stations loaded back, {} invalid'.format(loaded, len(errors)))
+	if errors or loaded != expected or result['imported'] != expected:
+		print('FAILED: expected {} stations to be imported and loaded'.format(expected))
+		sys.exit(1)
+	return
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Paradium benchmarks')
+	sub = parser.add_subparsers(dest='benchmark')
+	sub.required = True
+
+	p = sub.add_parser('poll', help='N clients polling now playing info')
+	p.add_argument('--url', default='http://127.0.0.1:80', help='server to test')
+	p.add_argument('--clients', type=int, default=20)
+	p.add_argument('--duration', type=float, default=10.0, help='seconds')
+	p.add_argument('--interval', type=float, default=0.0, help='pause between polls of one client')
+	p.add_argument('--keep-alive', action='store_true', help='reuse one connection per client')
+	p.set_defaults(func=bench_poll)
+
+	p = sub.add_parser('lookup', help='station lookup cost by catalog size')
+	p.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+	p.add_argument('--lookups', type=int, default=100000, help='lookups per operation and size')
+	p.set_defaults(func=bench_lookup)
+
+	p = sub.add_parser('search', help='station search query latency')
+	p.add_argument('--size', type=int, default=50000, help='stations in the catalog')
+	p.add_argument('--queries', type=int, default=1000)
+	p.set_defaults(func=bench_search)
+
+	p = sub.add_parser('persist', help='disk writes under rapid station changes')
+	p.add_argument('--duration', type=float, default=30.0, help='seconds of tapping')
+	p.add_argument('--tap-interval', type=float, default=0.2, help='seconds between taps of a burst')
+	p.add_argument('--delay', type=float, default=5.0, help='quiet seconds before a write')
+	p.add_argument('--max-delay', type=float, default=30.0, help='longest a change may wait')
+	p.set_defaults(func=bench_persist)
+
+	p = sub.add_parser('tune', help='station switch latency against a fake MPD')
+	p.add_argument('--latency', type=float, default=0.005, help='seconds MPD takes per answer')
+	p.add_argument('--urls', type=int, default=2, help='stream urls per station')
+	p.add_argument('--switches', type=int, default=200)
+	p.set_defaults(func=bench_tune)
+
+	p = sub.add_parser('probe', help='mirror probing against stand-in stream servers')
+	p.add_argument('--delays', type=float, nargs='+', default=[0.3, 0.0, 0.1], help='answer delay of each healthy mirror')
+	p.add_argument('--rounds', type=int, default=2)
+	p.add_argument('--concurrency', type=int, default=8)
+	p.add_argument('--timeout', type=float, default=1.0)
+	p.set_defaults(func=bench_probe)
+
+	p = sub.add_parser('resolve', help='playlist resolution on next taps')
+	p.add_argument('--stations', type=int, default=50)
+	p.add_argument('--taps', type=int, default=100, help='next taps, wrapping around the catalog')
+	p.add_argument('--tap-interval', type=float, default=0.3, help='seconds between taps')
+	p.add_argument('--latency', type=float, default=0.05, help='seconds the playlist server takes to answer')
+	p.set_defaults(func=bench_resolve)
+
+	p = sub.add_parser('burst', help='MPD commands sent for bursts of next taps')
+	p.add_argument('--bursts', type=int, default=5)
+	p.add_argument('--taps', type=int, default=5, help='taps per burst')
+	p.add_argument('--tap-interval', type=float, default=0.1, help='seconds between taps of a burst')
+	p.add_argument('--pause', type=float, default=0.5, help='seconds between bursts')
+	p.add_argument('--delay', type=float, default=0.4, help='quiet window of the tuner')
+	p.add_argument('--latency', type=float, default=0.005, help='seconds MPD takes per answer')
+	p.set_defaults(func=bench_burst)
+
+	p = sub.add_parser('logging', help='per request logging overhead')
+	p.add_argument('--records', type=int, default=5000, help='records logged per variant')
+	p.set_defaults(func=bench_logging)
+
+	p = sub.add_parser('dispatch', help='request routing overhead')
+	p.add_argument('--requests', type=int, default=200000)
+	p.set_defaults(func=bench_dispatch)
+
+	p = sub.add_parser('metrics', help='metrics recording and rendering overhead')
+	p.add_argument('--observations', type=int, default=200000)
+	p.set_defaults(func=bench_metrics)
+
+	p = sub.add_parser('load', help='load scenarios against paradium.py with a fake MPD')
+	p.add_argument('--server', choices=('async', 'blocking'), default='async', help='front end to start')
+	p.add_argument('--stations', type=int, default=1000, help='stations in the generated catalog')
+	p.add_argument('--latency', type=float, default=0.002, help='seconds the fake MPD takes per command')
+	p.add_argument('--scenarios', nargs='+', choices=LOAD_SCENARIOS, default=list(LOAD_SCENARIOS))
+	p.add_argument('--duration', type=float, default=10.0, help='seconds per scenario')
+	p.add_argument('--clients', type=int, default=20, help='polling and static clients')
+	p.add_argument('--interval', type=float, default=0.0, help='pause between polls of one client')
+	p.add_argument('--pressers', type=int, default=3, help='clients tapping next')
+	p.add_argument('--taps', type=int, default=5, help='taps per burst')
+	p.add_argument('--pause', type=float, default=1.0, help='seconds between bursts')
+	p.add_argument('--keep-alive', action='store_true', help='reuse one connection per client')
+	p.add_argument('--output', help='write the results to this JSON file')
+	p.add_argument('--compare', help='JSON file of an earlier run to compare with')
+	p.set_defaults(func=bench_load)
+
+	p = sub.add_parser('restart', help='failed requests while paradium.py restarts')
+	p.add_argument('--mode', choices=('graceful', 'cold'), default='graceful')
+	p.add_argument('--server', choices=('async', 'blocking'), default='async', help='front end to start')
+	p.add_argument('--stations', type=int, default=1000, help='stations in the generated catalog')
+	p.add_argument('--latency', type=float, default=0.002, help='seconds the fake MPD takes per command')
+	p.add_argument('--clients', type=int, default=10)
+	p.add_argument('--interval', type=float, default=0.05, help='pause between polls of one client')
+	p.add_argument('--restarts', type=int, default=3)
+	p.add_argument('--every', type=float, default=2.0, help='seconds between restarts')
+	p.add_argument('--keep-alive', action='store_true', help='reuse one connection per client')
+	p.set_defaults(func=bench_restart)
+
+	p = sub.add_parser('history', help='now playing history writes and queries')
+	p.add_argument('--days', type=int, default=7, help='days of songs to record')
+	p.add_argument('--queries', type=int, default=10000)
+	p.set_defaults(func=bench_history)
+
+	p = sub.add_parser('catalog', help='parsed against compiled and mapped station catalog')
+	p.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+	p.add_argument('--touch', type=int, default=100, help='stations held at once')
+	p.add_argument('--lookups', type=int, default=100000)
+	p.set_defaults(func=bench_catalog)
+
+	p = sub.add_parser('import', help='importing a directory dump with broken entries')
+	p.add_argument('--count', type=int, default=100000, help='entries in the dump')
+	p.add_argument('--broken', type=float, default=0.05, help='share of broken entries')
+	p.set_defaults(func=bench_import)
+
+	p = sub.add_parser('rooms', help='group commands to several rooms against fake MPDs')
+	p.add_argument('--latencies', type=float, nargs='+', default=[0.02, 0.01, 0.05], help='seconds each room\'s MPD takes per answer')
+	p.add_argument('--urls', type=int, default=2, help='stream urls per station')
+	p.add_argument('--switches', type=int, default=50)
+	p.set_defaults(func=bench_rooms)
+
+	args = parser.parse_args()
+	args.func(args)
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+
+"""
+Compiled station catalog
+
+Parsing stations.xml and keeping every station as Python objects took
+seconds and tens of MB on a Pi for a big catalog, on every start. The
+catalog is now compiled into a binary file once and memory-mapped
+afterwards. The daemon keeps it under PARADIUM_VHOME, out of the
+htdocs we serve. Stations are only decoded when somebody
+asks for one, so what stays resident are the pages of the stations
+actually used.
+
+The file is keyed by mtime, size and SHA-1 of the stations.xml it was
+compiled from. A matching mtime and size is trusted, otherwise the
+hash decides whether the source really changed or was just copied
+around, e.g. by deploy.sh.
+
+Layout, all little endian:
+
+	header       HEADER, padded to HEADER_SIZE
+	ids          int32 station ids, sorted
+	positions    uint32 catalog position of each sorted id
+	offsets      uint32 offset of each station's record, in catalog order,
+	             and where the last one ends
+	dense        uint32 catalog position of every id from the lowest one
+	             up, MISSING for ids without a station. Left out when
+	             the ids are too sparse, lookups search the sorted ids then
+	records      int32 id, then name, website and urls in UTF-8, each
+	             followed by a NUL which XML text can't contain. An
+	             empty website is none
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+from bisect import bisect_left
+
+MAGIC = b'PRDMCAT\0'
+VERSION = 2
+# magic, version, source mtime_ns, size and SHA-1, stations, invalid stations skipped,
+# lowest id and entries of the dense table
+HEADER = struct.Struct('<8sIqQ20sIIiI')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<i')
+# dense table entry of an id without a station
+MISSING = 0xffffffff
+# the dense table is left out if it would have more than DENSE_SLACK entries per
+# station plus DENSE_MIN. Every entry is 4 bytes on disk
+DENSE_SLACK = 4
+DENSE_MIN = 1024
+# most stations kept decoded, the current one and its neighbours are asked for
+# all the time. The cache starts over when it's full
+STATION_CACHE = 64
+# the compiled file is called after its stations.xml with this appended
+CACHE_SUFFIX = '.cache'
+
+
+def source_key(filename):
+	"""
+	(mtime_ns, size, sha1) of the source file
+	"""
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		st = os.fstat(f.fileno())
+		for chunk in iter(lambda: f.read(1 << 16), b''):
+			sha1.update(chunk)
+	return (st.st_mtime_ns, st.st_size, sha1.digest())
+
+
+def compile_catalog(stations, key, skipped = 0):
+	"""
+	the compiled catalog of a list of stations as bytes
+	"""
+	records = []
+	offsets = []
+	length = 0
+	for s in stations:
+		text = ''.join(t + '\0' for t in [s.name, s.website or ''] + s.urls)
+		record = RECORD.pack(s.id) + text.encode('utf-8')
+		offsets.append(length)
+		records.append(record)
+		length += len(record)
+	count = len(offsets)
+	offsets.append(length)
+	# sorted by id, then position so the first of duplicate ids wins
+	order = sorted(range(count), key=lambda i: (stations[i].id, i))
+
+	min_id = stations[order[0]].id if count else 0
+	span = stations[order[-1]].id - min_id + 1 if count else 0
+	dense = []
+	if span <= DENSE_SLACK * count + DENSE_MIN:
+		dense = [MISSING] * span
+		# backwards, so again the first of duplicate ids wins
+		for i in reversed(order):
+			dense[stations[i].id - min_id] = i
+
+	header = HEADER.pack(MAGIC, VERSION, key[0], key[1], key[2], count, skipped, min_id, len(dense))
+	return b''.join([header.ljust(HEADER_SIZE, b'\0'),
+		struct.pack('<{}i'.format(count), *[stations[i].id for i in order]),
+		struct.pack('<{}I'.format(count), *order),
+		struct.pack('<{}I'.format(count + 1), *offsets),
+		struct.pack('<{}I'.format(len(dense)), *dense)] + records)
+
+
+def read_header(buf):
+	"""
+	(mtime_ns, size, sha1, count, skipped, min_id, dense) of a compiled
+	catalog, raises ValueError if it isn't one we can read
+	"""
+	if len(buf) < HEADER_SIZE:
+		raise ValueError('compiled catalog too short')
+	magic, version, mtime, size, sha1, count, skipped, min_id, dense = HEADER.unpack_from(buf)
+	if magic != MAGIC or version != VERSION:
+		raise ValueError('not a compiled catalog of version {}'.format(VERSION))
+	if len(buf) < HEADER_SIZE + 12 * count + 4 + 4 * dense:
+		raise ValueError('compiled catalog truncated')
+	return (mtime, size, sha1, count, skipped, min_id, dense)
+
+
+class IdIndex():
+	"""
+	maps station ids to catalog positions like a dict would, by binary
+	search over the sorted ids of a compiled catalog. For catalogs
+	without a dense table
+	"""
+
+	def __init__(self, ids, positions):
+		self.ids = ids
+		self.positions = positions
+		return
+
+	def get(self, id, default = None):
+		i = bisect_left(self.ids, id)
+		if i < len(self.ids) and self.ids[i] == id:
+			return self.positions[i]
+		return default
+
+	def __len__(self):
+		return len(self.ids)
+
+
+class DenseIndex():
+	"""
+	maps station ids to catalog positions like a dict would, straight
+	from the dense table of a compiled catalog
+	"""
+
+	def __init__(self, dense, min_id, count):
+		self.dense = dense
+		self.min_id = min_id
+		self.count = count
+		return
+
+	def get(self, id, default = None):
+		i = id - self.min_id
+		if 0 <= i < len(self.dense):
+			position = self.dense[i]
+			if position != MISSING:
+				return position
+		return default
+
+	def __len__(self):
+		return self.count
+
+
+class CompiledCatalog():
+	"""
+	the stations of a compiled catalog as a read-only sequence. Stations
+	are decoded when they're asked for, only a few of the last ones
+	are kept. Iterating doesn't touch those
+
+	:param buf = the compiled catalog, bytes or an mmap
+	:param factory = called with id, name, urls and website to make a station
+	"""
+
+	def __init__(self, buf, factory):
+		mtime, size, sha1, count, skipped, min_id, dense = read_header(buf)
+		self.buf = buf
+		self.factory = factory
+		self.count = count
+		self.skipped = skipped
+		view = memoryview(buf)
+		tables = HEADER_SIZE + 4 * count
+		dense_start = tables + 8 * count + 4
+		if dense:
+			self.index = DenseIndex(view[dense_start:dense_start + 4 * dense].cast('I'), min_id, count)
+		else:
+			self.index = IdIndex(view[HEADER_SIZE:tables].cast('i'), view[tables:tables + 4 * count].cast('I'))
+		self.offsets = view[tables + 4 * count:dense_start].cast('I')
+		self.records = dense_start + 4 * dense
+		# position -> station. Without a lock, a station decoded twice is no harm
+		self.cache = {}
+		return
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self.decode(j) for j in range(*i.indices(self.count))]
+		if i < 0:
+			i += self.count
+		if not 0 <= i < self.count:
+			raise IndexError('station position out of range')
+		return self.station(i)
+
+	def __iter__(self):
+		for i in range(self.count):
+			yield self.decode(i)
+
+	def station(self, i):
+		"""
+		the station at position i, from the cache if it was asked for lately
+		"""
+		station = self.cache.get(i)
+		if station is None:
+			station = self.decode(i)
+			if len(self.cache) >= STATION_CACHE:
+				self.cache.clear()
+			self.cache[i] = station
+		return station
+
+	def decode(self, i):
+		# one copy out of the buffer, everything else works on that
+		record = self.buf[self.records + self.offsets[i]:self.records + self.offsets[i + 1] - 1]
+		(id,) = RECORD.unpack_from(record)
+		texts = record[RECORD.size:].decode('utf-8').split('\0')
+		return self.factory(id, texts[0], texts[2:], texts[1] or None)
+
+
+def open_catalog(filename, cache, factory, stat = None):
+	"""
+	memory-map cache, the compiled catalog of stations.xml filename,
+	if it is up to date. Returns None if it has to be compiled (again)
+
+	:param stat = (mtime_ns, size) of the source if known already
+	"""
+	try:
+		with open(cache, 'rb') as f:
+			buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		header = read_header(buf)
+	except (OSError, ValueError):
+		return None
+
+	if stat is None:
+		st = os.stat(filename)
+		stat = (st.st_mtime_ns, st.st_size)
+	if stat != header[:2]:
+		key = source_key(filename)
+		if key[2] != header[2]:
+			return None
+		# same content, a new mtime. Remember it so we don't hash again
+		try:
+			with open(cache, 'r+b') as f:
+				f.write(HEADER.pack(MAGIC, VERSION, key[0], key[1], key[2], *header[3:]))
+		except OSError:
+			pass
+	return CompiledCatalog(buf, factory)
+
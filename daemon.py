@@ -4,15 +4,15 @@
 # published without license but I guess it should be OK
 #
 import sys, os, time, atexit
-from signal import SIGTERM, SIGINT
+from signal import SIGTERM, SIGINT, SIGHUP, SIGUSR2
 import logging
-import logging.handlers
  
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-filehandler = logging.handlers.TimedRotatingFileHandler('/tmp/daemon.log',when='midnight',interval=1,backupCount=10)
-filehandler.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
-logger.addHandler(filehandler)
+# goes wherever the application sends the root logger
+logger = logging.getLogger('daemon')
+
+# seconds we wait for the daemon to exit, or for a successor to take over
+STOP_TIMEOUT = 10
+TAKEOVER_TIMEOUT = 30
  
 class Daemon(object):
     """
@@ -56,6 +56,17 @@ class Daemon(object):
  
         logger.info('deamon going to background, PID: {}'.format(os.getpid()))
  
+        # Write pidfile, unless another start beat us to it. Still
+        # with stderr to complain to.
+        try:
+            self.writepid(exclusive=True)
+        except FileExistsError:
+            sys.stderr.write("Pidfile {} already exist. Daemon already running?\n".format(self.pidfile))
+            os._exit(1)
+ 
+        # Register a function to clean up.
+        atexit.register(self.delpid)
+ 
         # Redirect standard file descriptors.
         sys.stdout.flush()
         sys.stderr.flush()
@@ -66,37 +77,71 @@ class Daemon(object):
         os.dup2(so.fileno(), sys.stdout.fileno())
         os.dup2(se.fileno(), sys.stderr.fileno())
  
-        # Write pidfile.
-        pid = str(os.getpid())
-        open(self.pidfile,'w+').write("{}\n".format(pid))
+    def readpid(self):
+        """
+        PID in the pidfile, None if there is none
+        """
+        try:
+            with open(self.pidfile, 'r') as pf:
+                return int(pf.read().strip())
+        except (IOError, ValueError):
+            return None
  
-        # Register a function to clean up.
-        atexit.register(self.delpid)
+    def writepid(self, exclusive = False):
+        """
+        Write our PID to the pidfile. With exclusive only if there is none.
+        """
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC)
+        fd = os.open(self.pidfile, flags, 0o644)
+        with os.fdopen(fd, 'w') as pf:
+            pf.write("{}\n".format(os.getpid()))
+ 
+    def running(self, pid):
+        """
+        True if there is a process with that PID.
+        """
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
  
     def delpid(self):
-        os.remove(self.pidfile)
+        # a successor may have put its own PID there already
+        if self.readpid() == os.getpid():
+            os.remove(self.pidfile)
  
     def start(self):
         """
         Start daemon.
         """
         # Check pidfile to see if the daemon already runs.
-        try:
-            pf = open(self.pidfile,'r')
-            pid = int(pf.read().strip())
-            pf.close()
-        except IOError:
-            pid = None
+        pid = self.readpid()
  
-        if pid:
+        if pid and self.running(pid):
             message = "Pidfile {} already exist. Daemon already running?\n".format(self.pidfile)
             sys.stderr.write(message)
             sys.exit(1)
+        if pid:
+            # left behind by a daemon that didn't exit cleanly
+            logger.warning('removing stale pidfile of PID {}'.format(pid))
+            os.remove(self.pidfile)
  
         # Start daemon.
         self.daemonize()
         self.run()
  
+    def take_over(self):
+        """
+        Run as the successor a daemon started on a graceful restart. We
+        are in the background already, run() writes the pidfile once
+        we took over.
+        """
+        atexit.register(self.delpid)
+        self.run()
+ 
     def status(self):
         """
         Get status of daemon.
@@ -133,13 +178,15 @@ class Daemon(object):
             sys.stderr.write(message)
             sys.exit(1)
  
-        # Try killing daemon process.
+        # Try killing daemon process and wait until it's gone.
         try:
             os.kill(pid, SIGINT)
-            time.sleep(1)
         except OSError as e:
             print(str(e))
             sys.exit(1)
+        deadline = time.time() + STOP_TIMEOUT
+        while self.running(pid) and time.time() < deadline:
+            time.sleep(0.1)
  
         try:
             if os.path.exists(self.pidfile):
@@ -154,9 +201,49 @@ class Daemon(object):
         Restart daemon.
         """
         self.stop()
-        time.sleep(1)
         self.start()
  
+    def graceful(self):
+        """
+        Restart without ever closing the listening socket: the running
+        daemon starts its successor, see take_over(). Waits until the
+        successor put its PID in the pidfile.
+        """
+        pid = self.readpid()
+        if pid is None or not self.running(pid):
+            sys.stderr.write("Daemon not running?\n")
+            sys.exit(1)
+ 
+        os.kill(pid, SIGUSR2)
+        deadline = time.time() + TAKEOVER_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(0.1)
+            new = self.readpid()
+            if new and new != pid:
+                sys.stdout.write("Daemon restarted, PID {}\n".format(new))
+                return
+        sys.stderr.write("No successor took over from PID {}, it is still running\n".format(pid))
+        sys.exit(1)
+ 
+    def reload(self):
+        """
+        Ask the running daemon to reload its configuration.
+        """
+        try:
+            pf = open(self.pidfile,'r')
+            pid = int(pf.read().strip())
+            pf.close()
+        except IOError as e:
+            message = str(e) + "\nDaemon not running?\n"
+            sys.stderr.write(message)
+            sys.exit(1)
+ 
+        try:
+            os.kill(pid, SIGHUP)
+        except OSError as e:
+            print(str(e))
+            sys.exit(1)
+ 
     def run(self):
         """
         You should override this method when you subclass Daemon.
@@ -1,7 +1,10 @@
 #!/usr/bin/python3
 
-from xml.etree.ElementTree import Element, SubElement, ElementTree, ParseError
+from xml.etree.ElementTree import ElementTree, ParseError
 import os
+import time
+import json
+import threading
 import logging
 import logging.handlers
 
@@ -18,9 +21,48 @@ if 'PARADIUM_VHOME' in os.environ:
 if 'PARADIUM_MPDHOST' in os.environ:
 	PARADIUM_MPDHOST = os.environ['PARADIUM_MPDHOST']
 
+# seconds of quiet after the last change before we write it out
+FLUSH_DELAY = 5.0
+# but changes never wait longer than that, even if they keep coming
+FLUSH_MAX_DELAY = 30.0
+
+
+def write_atomic(filename, data):
+	"""
+	replace filename with data so that after a power cut we find
+	either the old or the new content but never a torn file
+	"""
+	tmp = filename + '.tmp'
+	fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+	try:
+		os.write(fd, data)
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+	os.replace(tmp, filename)
+
+	# make the rename itself durable
+	dirfd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
+	try:
+		os.fsync(dirfd)
+	finally:
+		os.close(dirfd)
+	return
+
+
 class DataModel():
 	"""
 	Dynamic data model for Paradium
+
+	State lives in state.json under PARADIUM_VHOME. Changes are not
+	written right away, that would wear out the SD card when somebody
+	taps through the stations. A flusher thread writes them once things
+	have been quiet for FLUSH_DELAY seconds, or after FLUSH_MAX_DELAY at
+	the latest. Writes are atomic so a power cut can't corrupt the file.
+	They happen outside of the lock guarding the state, a slow SD card
+	doesn't hold up changing stations. A failed write is tried again.
+
+	A data.xml from older versions is read if there's no state.json yet.
 	"""
 	
 	m_current_station = 1
@@ -31,44 +73,98 @@ class DataModel():
 		case we couldn't read/parse/use our data
 		"""
 		print('setting defaults')
-		self.dom = ElementTree()
-		root = Element('paradium')
-		se = SubElement(root, 'current_station')
-		se.text = str(self.m_current_station)
-		self.dom._setroot(root)
+		self.m_current_station = DataModel.m_current_station
 		
-	def __init__(self, logger):
+	def __init__(self, logger, vhome = None, restore = True):
 		
 		"""
 
 		:type self: object
+		:param restore = read the saved state right away. Otherwise
+			call restore() before anybody asks for it
+		"""
+		self.logger = logger
+		if vhome is None:
+			vhome = PARADIUM_VHOME
+		self.filename = os.path.join(vhome, 'state.json')
+		self.legacy_filename = os.path.join(vhome, 'data.xml')
+
+		# called with the new id whenever the current station changes
+		self.listeners = []
+
+		# write coalescing. write_lock is held while writing, it's
+		# never taken while holding lock
+		self.lock = threading.Condition()
+		self.write_lock = threading.Lock()
+		self.dirty_since = None
+		self.changed_at = None
+		self.flusher = None
+		# set by stop(), changes are kept in memory only
+		self.stopped = False
+		self.changes = 0
+		self.writes = 0
+		self.last_write = None
+
+		if restore:
+			self.restore()
+		return
+
+	def restore(self):
 		"""
+		read the saved state, from data.xml of older versions
+		if there's no state.json yet
+		"""
+		if os.path.exists(self.filename):
+			self.load()
+		else:
+			self.load_legacy()
+			# carry it over to the new format right away
+			self.dirty_since = self.changed_at = time.monotonic()
+
+		print ('current station: {}'.format(self.m_current_station))
+		return
+
+	def load(self):
 		try:
-			logger.info('parsing data.xml')
+			self.logger.info('reading state.json')
+			with open(self.filename, 'rb') as f:
+				state = json.loads(f.read().decode('utf-8'))
+			self.m_current_station = int(state['current_station'])
+		except IOError:
+			self.logger.warning('couldn\'t read state.json. Using default values.')
+			self.set_defaults()
+		except (ValueError, KeyError, TypeError):
+			self.logger.warning('couldn\'t parse state.json. Using default values.')
+			self.set_defaults()
+		return
+
+	def load_legacy(self):
+		"""
+		read data.xml as written by older versions
+		"""
+		try:
+			self.logger.info('parsing data.xml')
 			# get the DOM	
-			self.dom = ElementTree()
-			self.dom.parse(PARADIUM_VHOME + 'data.xml')
+			dom = ElementTree()
+			dom.parse(self.legacy_filename)
 
-			root = self.dom.getroot()
+			root = dom.getroot()
 			if root is None:
 				self.set_defaults()
 				return
 
-			# and traverse all stations in the root node
-			cs = self.dom.getroot().find('current_station')
+			cs = root.find('current_station')
 			if cs is not None:
 				self.m_current_station = int(cs.text)
-
-			print ('current station: {}'.format(self.m_current_station))
 			return
 			
 		except IOError:
-			logger.warning('couldn\'t read data.xml. Using default values.')
+			self.logger.warning('couldn\'t read data.xml. Using default values.')
 			self.set_defaults()
 			return
 		
-		except ParseError:
-			logger.warning('couldn\'t parse data.xml. Using default values.')
+		except (ParseError, ValueError):
+			self.logger.warning('couldn\'t parse data.xml. Using default values.')
 			self.set_defaults()
 			return
 
@@ -78,24 +174,129 @@ class DataModel():
 		:type self: int
 		"""
 		if isinstance(current_id, str):
-			self.m_current_station = int(current_id)
-		elif isinstance(current_id, int):
-			self.m_current_station = current_id
-		else:
+			current_id = int(current_id)
+		elif not isinstance(current_id, int):
 			raise ValueError("current_id should be integer type")
-		self.dom.find('current_station').text = str(self.m_current_station)
+
+		with self.lock:
+			self.m_current_station = current_id
+			self.mark_dirty()
+
+		for listener in self.listeners:
+			listener(self.m_current_station)
 		return self.m_current_station
 
+	def add_listener(self, listener):
+		"""
+		have listener(id) called whenever the current station is set
+		"""
+		self.listeners.append(listener)
+		return
+
 	def current_station(self):
 		"""
 		get the id of the currently selected station
 		"""
 		return self.m_current_station
-	
+
+	def mark_dirty(self):
+		"""
+		note a change and wake the flusher. Call with self.lock held
+		"""
+		now = time.monotonic()
+		self.changes += 1
+		self.changed_at = now
+		if self.dirty_since is None:
+			self.dirty_since = now
+		if not self.stopped:
+			self.start()
+		self.lock.notify()
+		return
+
+	def start(self):
+		"""
+		start the flusher thread unless it's running. Done lazily
+		so we don't lose it when the daemon forks
+		"""
+		with self.lock:
+			self.stopped = False
+			if self.flusher is None or not self.flusher.is_alive():
+				self.flusher = threading.Thread(target=self.flush_loop, name='datamodel-flush', daemon=True)
+				self.flusher.start()
+			self.lock.notify()
+		return
+
+	def stop(self):
+		"""
+		write out pending changes and stop the flusher, e.g. before a
+		successor takes over state.json. Later changes aren't written
+		until start() is called again
+		"""
+		with self.write_lock:
+			if self.dirty_since is not None:
+				self.write()
+			with self.lock:
+				self.stopped = True
+				self.lock.notify()
+		return
+
+	def flush_loop(self):
+		while True:
+			with self.lock:
+				if self.stopped:
+					return
+				if self.dirty_since is None:
+					self.lock.wait()
+					continue
+				now = time.monotonic()
+				due = min(self.changed_at + FLUSH_DELAY, self.dirty_since + FLUSH_MAX_DELAY)
+				if now < due:
+					self.lock.wait(due - now)
+					continue
+			with self.write_lock:
+				# stop() may have written it all while we waited
+				if not self.stopped and self.dirty_since is not None:
+					self.write()
+
+	def write(self):
+		"""
+		write the current state. Call with self.write_lock held but not
+		self.lock, that's only taken for a copy of the state
+		"""
+		with self.lock:
+			state = {'version': 1, 'current_station': self.m_current_station}
+			self.dirty_since = None
+		try:
+			write_atomic(self.filename, json.dumps(state).encode('utf-8'))
+		except OSError as e:
+			self.logger.error('couldn\'t write state.json: {}'.format(e))
+			with self.lock:
+				# still dirty, the flusher tries again after FLUSH_DELAY or persist() does
+				if self.dirty_since is None:
+					self.dirty_since = self.changed_at = time.monotonic()
+				self.lock.notify()
+			return False
+		self.writes += 1
+		self.last_write = time.time()
+		return True
+
 	def persist(self):
+		"""
+		write out pending changes now, e.g. before we exit
+		"""
 		print ('persisting data model')
-		self.dom.write(PARADIUM_VHOME + 'data.xml')
+		with self.write_lock:
+			if self.dirty_since is not None or not os.path.exists(self.filename):
+				self.write()
 		return
+
+	def stats(self):
+		return {
+			'changes': self.changes,
+			'writes': self.writes,
+			'pending': self.dirty_since is not None,
+			'last_write': self.last_write
+		}
 	
 	
 
@@ -2,10 +2,29 @@
 
 
 EXEC_FILES=(
+	aioserver.py
+	catalog.py
 	daemon.py
 	datamodel.py
+	handoff.py
+	history.py
+	importer.py
+	jobs.py
+	logpipe.py
+	metrics.py
+	mpdconnection.py
+	notifier.py
 	paradium.py
+	prober.py
+	resolver.py
+	rooms.py
+	router.py
+	search.py
+	startup.py
+	staticcache.py
 	stations.py
+	status.py
+	tuner.py
 	)
 
 # make sure directory structure exists
@@ -24,6 +43,8 @@ for i in "${EXEC_FILES[@]}"
 
 echo "sync htdocs ..."
 rsync -av -- htdocs /opt/paradium/
+# the compiled catalog lives in /var/paradium now, older versions left it here
+rm -f /opt/paradium/htdocs/stations.xml.cache
 
 echo "copy udev start rule ..."
 sudo cp -a -- ./udev/98-bluez-pulse.rules /etc/udev/rules.d/98-bluez-pulse.rules
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+"""
+Minimal fake MPD protocol server
+
+Speaks just enough of the MPD text protocol for Paradium to run
+against it on a development box or in the benchmark harness. Nothing
+is actually played, the server only keeps track of the playlist and
+the player state and answers idle requests when they change.
+"""
+
+import sys
+import socketserver
+import threading
+import time
+
+MPD_GREETING = b'OK MPD 0.23.5\n'
+
+
+class FakeMPDState():
+	"""
+	player state shared by all connections to one fake server
+	"""
+
+	def __init__(self, latency = 0.0, drop_after = None):
+		# artificial delay added to every command in seconds
+		self.latency = latency
+		# close the connection after that many commands to simulate
+		# MPD dropping us. None means never
+		self.drop_after = drop_after
+		self.playlist = []
+		self.state = 'stop'
+		self.song = 0
+		self.commands = {}
+		# answers sent, a command list is one
+		self.round_trips = 0
+		self.connections = 0
+		self.changed = threading.Condition()
+		self.version = 0
+		self.lock = threading.Lock()
+
+	def count(self, command):
+		with self.lock:
+			self.commands[command] = self.commands.get(command, 0) + 1
+
+	def total_commands(self):
+		with self.lock:
+			return sum(self.commands.values())
+
+	def reset_counters(self):
+		with self.lock:
+			self.commands = {}
+			self.round_trips = 0
+
+	def player_changed(self):
+		with self.changed:
+			self.version += 1
+			self.changed.notify_all()
+
+
+class FakeMPDHandler(socketserver.StreamRequestHandler):
+	"""
+	one client connection
+	"""
+
+	def setup(self):
+		socketserver.StreamRequestHandler.setup(self)
+		self.mpd = self.server.mpd
+		self.handled = 0
+		with self.mpd.lock:
+			self.mpd.connections += 1
+
+	def finish(self):
+		with self.mpd.lock:
+			self.mpd.connections -= 1
+		try:
+			socketserver.StreamRequestHandler.finish(self)
+		except OSError:
+			pass
+
+	def send(self, lines):
+		data = ''.join(line + '\n' for line in lines)
+		self.wfile.write(data.encode('utf-8'))
+
+	def handle(self):
+		self.wfile.write(MPD_GREETING)
+		command_list = None
+		list_ok = False
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				return
+			line = line.decode('utf-8').rstrip('\n')
+			if line in ('command_list_begin', 'command_list_ok_begin'):
+				command_list = []
+				list_ok = line == 'command_list_ok_begin'
+				continue
+			if command_list is not None and line != 'command_list_end':
+				command_list.append(line)
+				continue
+
+			if line == 'command_list_end':
+				lines = command_list
+				command_list = None
+			else:
+				lines = [line]
+				list_ok = False
+
+			if self.mpd.latency:
+				time.sleep(self.mpd.latency)
+
+			out = []
+			for i, cmd in enumerate(lines):
+				try:
+					out.extend(self.execute(cmd))
+				except ValueError as e:
+					out.append('ACK [5@{}] {{{}}} {}'.format(i, cmd.split(' ')[0], e))
+					break
+				if list_ok:
+					out.append('list_OK')
+			else:
+				out.append('OK')
+			self.send(out)
+			with self.mpd.lock:
+				self.mpd.round_trips += 1
+
+			self.handled += 1
+			if self.mpd.drop_after and self.handled >= self.mpd.drop_after:
+				return
+
+	def execute(self, line):
+		command, _, arg = line.partition(' ')
+		arg = arg.strip('"')
+		self.mpd.count(command)
+		mpd = self.mpd
+
+		if command == 'ping':
+			return []
+		elif command == 'close':
+			raise EOFError()
+		elif command == 'currentsong':
+			if mpd.state == 'stop' or not mpd.playlist:
+				return []
+			url = mpd.playlist[mpd.song]
+			return ['file: ' + url, 'Title: Fake song on ' + url, 'Pos: {}'.format(mpd.song), 'Id: {}'.format(mpd.song + 1)]
+		elif command == 'status':
+			return ['volume: 100', 'playlistlength: {}'.format(len(mpd.playlist)), 'state: ' + mpd.state]
+		elif command == 'clear':
+			mpd.playlist = []
+			mpd.state = 'stop'
+			return []
+		elif command == 'add':
+			if not arg:
+				raise ValueError('wrong number of arguments')
+			mpd.playlist.append(arg)
+			return []
+		elif command == 'play':
+			if not mpd.playlist:
+				mpd.state = 'stop'
+			else:
+				mpd.song = 0
+				mpd.state = 'play'
+			mpd.player_changed()
+			return []
+		elif command in ('stop', 'pause'):
+			mpd.state = 'stop' if command == 'stop' else 'pause'
+			mpd.player_changed()
+			return []
+		elif command == 'idle':
+			with mpd.changed:
+				version = mpd.version
+				while mpd.version == version:
+					mpd.changed.wait(1.0)
+			return ['changed: player']
+		elif command == 'noidle':
+			return []
+		raise ValueError('unknown command "{}"'.format(command))
+
+
+class FakeMPDServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	"""
+	the fake server itself. Bind to port 0 to get a free one
+	"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, bind_address = '127.0.0.1', port = 0, latency = 0.0, drop_after = None):
+		self.mpd = FakeMPDState(latency, drop_after)
+		socketserver.TCPServer.__init__(self, (bind_address, port), FakeMPDHandler)
+		return
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	def start(self):
+		"""
+		serve from a background thread
+		"""
+		self.thread = threading.Thread(target=self.serve_forever, name='fakempd', daemon=True)
+		self.thread.start()
+		return self
+
+
+if __name__ == '__main__':
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 6600
+	latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+	server = FakeMPDServer('127.0.0.1', port, latency)
+	print('fake MPD listening on port {}'.format(server.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
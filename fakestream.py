@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+"""
+Stand-in stream server
+
+Answers every request like an internet radio mirror would: headers,
+then an endless trickle of bytes. The delay before answering and the
+status code are configurable, and a dead mirror accepts connections
+but never says a word. Playlists and redirects can be put at paths of
+their own with add_file(). Used to try out the mirror prober and the
+playlist resolver without hammering real stations.
+
+	fakestream.py [port] [delay] [status|dead]
+"""
+
+import sys
+import time
+import socketserver
+import threading
+
+# bytes sent per chunk, and seconds between chunks
+CHUNK = b'\xff\xfb' * 512
+CHUNK_INTERVAL = 0.1
+
+
+class FakeStreamHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		server = self.server
+		with server.lock:
+			server.requests += 1
+		if server.dead:
+			# hold the connection until the client gives up
+			self.rfile.read()
+			return
+
+		words = self.rfile.readline().decode('latin-1').split()
+		while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+			pass
+		if server.delay:
+			time.sleep(server.delay)
+
+		path = words[1] if len(words) > 1 else '/'
+		if path in server.files:
+			status, headers, body = server.files[path]
+			head = ['HTTP/1.0 {} Fake'.format(status), 'Content-Length: {}'.format(len(body))]
+			head.extend('{}: {}'.format(name, value) for name, value in headers)
+			self.wfile.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+			return
+		self.wfile.write('HTTP/1.0 {} Fake\r\nContent-Type: audio/mpeg\r\nicy-name: fake\r\n\r\n'.format(server.status).encode('latin-1'))
+		if server.status >= 300:
+			return
+		try:
+			while not server.stopped:
+				self.wfile.write(CHUNK)
+				time.sleep(CHUNK_INTERVAL)
+		except OSError:
+			pass
+		return
+
+
+class FakeStreamServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	"""
+	one fake mirror. Bind to port 0 to get a free one
+
+	:param delay = seconds before the answer
+	:param status = HTTP status of the answer
+	:param dead = accept connections but never answer
+	"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, bind_address = '127.0.0.1', port = 0, delay = 0.0, status = 200, dead = False):
+		self.delay = delay
+		self.status = status
+		self.dead = dead
+		self.requests = 0
+		self.files = {}
+		self.stopped = False
+		self.lock = threading.Lock()
+		socketserver.TCPServer.__init__(self, (bind_address, port), FakeStreamHandler)
+		return
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	def url(self, path = '/live'):
+		return 'http://127.0.0.1:{}{}'.format(self.port, path)
+
+	def add_file(self, path, body, content_type = 'text/plain', status = 200, headers = ()):
+		"""
+		answer requests for path with body instead of a stream
+		"""
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		self.files[path] = (status, [('Content-Type', content_type)] + list(headers), body)
+		return self.url(path)
+
+	def redirect(self, path, location, status = 302):
+		return self.add_file(path, b'', status=status, headers=[('Location', location)])
+
+	def start(self):
+		"""
+		serve from a background thread
+		"""
+		self.thread = threading.Thread(target=self.serve_forever, name='fakestream', daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped = True
+		self.shutdown()
+		self.server_close()
+		return
+
+
+if __name__ == '__main__':
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+	delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+	mode = sys.argv[3] if len(sys.argv) > 3 else '200'
+	if mode == 'dead':
+		server = FakeStreamServer('127.0.0.1', port, dead=True)
+	else:
+		server = FakeStreamServer('127.0.0.1', port, delay, int(mode))
+	print('fake stream listening on {}'.format(server.url()))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
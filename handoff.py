@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+"""
+Listening socket handoff
+
+A restart used to stop the daemon, wait and start it again, so for a few
+seconds nobody was listening on port 80. On a graceful restart the
+running daemon starts its successor instead and hands it the listening
+socket. The successor loads everything and then tells its predecessor
+to go away. Until then the old process keeps answering, and afterwards
+connections simply queue on the same socket for the new one.
+
+A socket passed in by the service manager (systemd socket activation)
+is picked up the same way.
+"""
+
+import os
+import sys
+import socket
+import subprocess
+
+# environment of the successor: listening socket and who to tell when we're ready
+LISTEN_FD = 'PARADIUM_LISTEN_FD'
+PREDECESSOR = 'PARADIUM_PREDECESSOR'
+# where systemd puts the first passed socket
+SD_LISTEN_FDS_START = 3
+# resolved now, the daemon changes to / before it could hand over
+SCRIPT = os.path.abspath(sys.argv[0])
+
+
+def inherited_socket():
+	"""
+	the listening socket handed to us by our predecessor or by
+	systemd, None if we have to bind one ourselves
+	"""
+	fd = os.environ.pop(LISTEN_FD, None)
+	listen_pid = os.environ.pop('LISTEN_PID', None)
+	listen_fds = os.environ.pop('LISTEN_FDS', None)
+	if fd is None and listen_pid == str(os.getpid()) and listen_fds and int(listen_fds) >= 1:
+		fd = SD_LISTEN_FDS_START
+	if fd is None:
+		return None
+	sock = socket.socket(fileno=int(fd))
+	# nobody we start by other means gets it
+	sock.set_inheritable(False)
+	return sock
+
+
+def predecessor():
+	"""
+	pid of the process that started us to take over, None if none did
+	"""
+	pid = os.environ.pop(PREDECESSOR, None)
+	return int(pid) if pid else None
+
+
+def spawn_successor(sock, args):
+	"""
+	start a new process of this script with args, handing it sock.
+	Its output goes nowhere, like a daemon's. Returns the Popen
+	"""
+	env = dict(os.environ)
+	env[LISTEN_FD] = str(sock.fileno())
+	env[PREDECESSOR] = str(os.getpid())
+	return subprocess.Popen([sys.executable, SCRIPT] + list(args),
+		env=env, pass_fds=(sock.fileno(),), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+		stderr=subprocess.DEVNULL, start_new_session=True)
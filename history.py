@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+
+"""
+Now playing history
+
+Every song the player changes to is kept with the time and the station
+it played on, so any device can look up what that track 20 minutes ago
+was. In memory the history is a ring buffer of the last HISTORY_SIZE
+songs, older ones are simply overwritten. Songs come in one by one,
+in order, so the buffer is sorted by time and a query for everything
+since some time is a binary search.
+
+On disk songs are appended to segment files as compact binary records,
+the newest SEGMENTS of them are kept. Like the data model we don't
+write every song right away, a flusher thread writes whatever came in
+FLUSH_INTERVAL seconds in one go, so an SD card sees a few small
+appends an hour. After a power cut we lose those minutes at most, a
+torn record at the end of a segment is cut off when we start.
+"""
+
+import os
+import time
+import struct
+import threading
+
+# songs kept in memory, a few days of radio
+HISTORY_SIZE = 1000
+# most songs a query returns
+HISTORY_LIMIT = 50
+HISTORY_LIMIT_MAX = 500
+# seconds songs wait for the flusher, unless FLUSH_BATCH of them wait already.
+# Losing that much history in a power cut is fine
+FLUSH_INTERVAL = 900.0
+FLUSH_BATCH = 20
+# bytes per segment file and how many of them we keep
+SEGMENT_SIZE = 64 * 1024
+SEGMENTS = 4
+# longer titles are cut, in bytes of UTF-8
+MAX_TITLE = 512
+
+# time in seconds since the epoch, station id, length of the title that follows
+RECORD = struct.Struct('<IiH')
+SEGMENT_PREFIX = 'history-'
+SEGMENT_SUFFIX = '.seg'
+
+
+class Entry():
+
+	__slots__ = ('time', 'station', 'title')
+
+	def __init__(self, time, station, title):
+		self.time = time
+		self.station = station
+		self.title = title
+
+	def encode(self):
+		title = self.title.encode('utf-8')
+		return RECORD.pack(self.time, self.station, len(title)) + title
+
+	def as_dict(self):
+		return {'time': self.time, 'station': self.station, 'title': self.title}
+
+
+def decode(data):
+	"""
+	entries of a segment and how many bytes of it were whole records
+	"""
+	entries = []
+	offset = 0
+	while offset + RECORD.size <= len(data):
+		when, station, length = RECORD.unpack_from(data, offset)
+		end = offset + RECORD.size + length
+		if end > len(data):
+			break
+		entries.append(Entry(when, station, data[offset + RECORD.size:end].decode('utf-8', 'replace')))
+		offset = end
+	return entries, offset
+
+
+class History():
+	"""
+	the last songs played, see above
+
+	:param directory = where the segment files go
+	:param restore = read the segments right away. Otherwise call
+		restore() before anybody asks for the history
+	"""
+
+	def __init__(self, logger, directory, size = HISTORY_SIZE, restore = True):
+		self.logger = logger
+		self.directory = directory
+		self.size = size
+
+		# ring buffer, head is where the next entry goes
+		self.entries = [None] * size
+		self.head = 0
+		self.count = 0
+
+		# write batching
+		self.lock = threading.Condition()
+		self.pending = []
+		self.pending_since = None
+		self.flusher = None
+		# set by stop(), songs are kept in memory only
+		self.stopped = False
+		self.segment = None
+		self.segment_length = 0
+		self.songs = 0
+		self.writes = 0
+		self.last_write = None
+
+		if restore:
+			self.restore()
+		return
+
+	def segments(self):
+		"""
+		(number, path) of our segment files, oldest first
+		"""
+		try:
+			names = os.listdir(self.directory)
+		except OSError:
+			return []
+		segments = []
+		for name in names:
+			number = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+			if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX) and number.isdigit():
+				segments.append((int(number), os.path.join(self.directory, name)))
+		return sorted(segments)
+
+	def restore(self):
+		"""
+		read the segments back. Songs recorded before that are kept
+		as the newest ones
+		"""
+		loaded = []
+		segments = self.segments()
+		for number, path in segments:
+			try:
+				with open(path, 'rb') as f:
+					data = f.read()
+			except OSError as e:
+				self.logger.error('couldn\'t read history segment {}: {}'.format(path, e))
+				continue
+			entries, length = decode(data)
+			if length < len(data):
+				self.logger.warning('cutting {} bytes of a torn record off {}'.format(len(data) - length, path))
+				try:
+					os.truncate(path, length)
+				except OSError as e:
+					self.logger.error('couldn\'t truncate {}: {}'.format(path, e))
+			loaded.extend(entries)
+
+		with self.lock:
+			recorded = self.newest(self.count)
+			recorded.reverse()
+			self.head = 0
+			self.count = 0
+			for entry in loaded[-self.size:] + recorded:
+				self.append(entry)
+			if segments:
+				self.segment = segments[-1][1]
+				self.segment_length = os.path.getsize(self.segment) if os.path.exists(self.segment) else 0
+		self.logger.info('restored {} songs of history from {} segments'.format(len(loaded), len(segments)))
+		return
+
+	def append(self, entry):
+		"""
+		put entry into the ring buffer. Call with self.lock held
+		"""
+		self.entries[self.head] = entry
+		self.head = (self.head + 1) % self.size
+		self.count = min(self.count + 1, self.size)
+		return
+
+	def at(self, i):
+		"""
+		i-th entry counted from the oldest one. Call with self.lock held
+		"""
+		return self.entries[(self.head - self.count + i) % self.size]
+
+	def newest(self, n):
+		"""
+		the n newest entries, newest first. Call with self.lock held
+		"""
+		return [self.at(i) for i in range(self.count - 1, self.count - 1 - min(n, self.count), -1)]
+
+	def record(self, station, title, when = None):
+		"""
+		note that title started playing on station. The same song on the
+		same station again, e.g. after a pause, is not a new one.
+		Returns whether it was recorded
+		"""
+		if when is None:
+			when = time.time()
+		title = title.encode('utf-8')[:MAX_TITLE].decode('utf-8', 'ignore')
+		with self.lock:
+			last = self.at(self.count - 1) if self.count else None
+			if last is not None and last.station == station and last.title == title:
+				return False
+			# a clock set back must not unsort the buffer
+			entry = Entry(max(int(when), last.time if last is not None else 0), station, title)
+			self.append(entry)
+			self.pending.append(entry)
+			self.songs += 1
+			if self.pending_since is None:
+				self.pending_since = time.monotonic()
+			if not self.stopped:
+				self.start()
+			self.lock.notify()
+		return True
+
+	def query(self, since = None, station = None, limit = HISTORY_LIMIT):
+		"""
+		songs played at or after since, on station if given, newest first
+		"""
+		with self.lock:
+			# first entry not older than since
+			lo, hi = 0, self.count
+			if since is not None:
+				while lo < hi:
+					mid = (lo + hi) // 2
+					if self.at(mid).time < since:
+						lo = mid + 1
+					else:
+						hi = mid
+			found = []
+			for i in range(self.count - 1, lo - 1, -1):
+				entry = self.at(i)
+				if station is None or entry.station == station:
+					found.append(entry)
+					if len(found) >= limit:
+						break
+		return found
+
+	def start(self):
+		"""
+		start the flusher thread unless it's running. Done lazily
+		so we don't lose it when the daemon forks
+		"""
+		with self.lock:
+			self.stopped = False
+			if self.flusher is None or not self.flusher.is_alive():
+				self.flusher = threading.Thread(target=self.flush_loop, name='history-flush', daemon=True)
+				self.flusher.start()
+		return
+
+	def stop(self):
+		"""
+		write out pending songs and stop the flusher, e.g. before a
+		successor takes over the segments. Later songs aren't written
+		until start() is called again
+		"""
+		with self.lock:
+			if self.pending:
+				self.write()
+			self.stopped = True
+			self.lock.notify()
+		return
+
+	def flush_loop(self):
+		with self.lock:
+			while not self.stopped:
+				if not self.pending:
+					self.lock.wait()
+					continue
+				now = time.monotonic()
+				due = self.pending_since + FLUSH_INTERVAL
+				if now < due and len(self.pending) < FLUSH_BATCH:
+					self.lock.wait(due - now)
+					continue
+				self.write()
+
+	def write(self):
+		"""
+		append the pending songs to the current segment, starting a new
+		one if it would grow beyond SEGMENT_SIZE. Call with self.lock held
+		"""
+		data = b''.join(entry.encode() for entry in self.pending)
+		try:
+			if self.segment is None or self.segment_length + len(data) > SEGMENT_SIZE:
+				self.rotate()
+			fd = os.open(self.segment, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+			try:
+				os.write(fd, data)
+			finally:
+				os.close(fd)
+			self.segment_length += len(data)
+			self.writes += 1
+			self.last_write = time.time()
+		except OSError as e:
+			self.logger.error('couldn\'t write history: {}'.format(e))
+		# they're still in memory, on disk we'd rather lose them than retry forever
+		self.pending = []
+		self.pending_since = None
+		return
+
+	def rotate(self):
+		"""
+		start a new segment and drop the oldest ones beyond SEGMENTS
+		"""
+		segments = self.segments()
+		number = segments[-1][0] + 1 if segments else 0
+		self.segment = os.path.join(self.directory, '{}{:06d}{}'.format(SEGMENT_PREFIX, number, SEGMENT_SUFFIX))
+		self.segment_length = 0
+		for number, path in segments[:max(0, len(segments) + 1 - SEGMENTS)]:
+			os.remove(path)
+		return
+
+	def persist(self):
+		"""
+		write out pending songs now, e.g. before we exit
+		"""
+		with self.lock:
+			if self.pending:
+				self.write()
+		return
+
+	def stats(self):
+		return {
+			'songs': self.songs,
+			'kept': self.count,
+			'writes': self.writes,
+			'pending': len(self.pending),
+			'segments': len(self.segments()),
+			'last_write': self.last_write
+		}
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+
+"""
+Bulk station importer
+
+Converts station directory dumps into a stations.xml the daemon can
+load. Input is read one station at a time and written out right away,
+so memory stays flat no matter how big the dump is.
+
+	importer.py [--format xml|json|csv|tsv] [--first-id N] input [output]
+
+JSON may be one big array of objects or one object per line, CSV and
+TSV need a header line. Fields are picked up by their usual names in community
+directories: name, url / url_resolved / urls, website / homepage, id.
+Entries are validated by the same rules the daemon applies to
+stations.xml, invalid ones are skipped and counted. Entries without a
+numeric id, or with one that is taken already, get the next free id
+counting from --first-id. Fields have to be text or numbers, and text
+XML can't hold, like control characters, makes the entry invalid too.
+"""
+
+import sys, os
+import csv
+import json
+import time
+import re
+import argparse
+from xml.etree.ElementTree import Element, SubElement, tostring
+
+from stations import validate_station, iter_stations, StationError
+
+# bytes read at once when scanning JSON
+JSON_CHUNK = 64 * 1024
+
+# between the objects of an array or JSON lines
+SEPARATORS = re.compile(r'[\s,\[\]]*')
+
+# characters XML 1.0 doesn't allow, not even escaped
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+# field names we accept for each station property, first match wins
+NAME_FIELDS = ('name', 'title')
+URL_FIELDS = ('url_resolved', 'url', 'stream', 'urls')
+WEBSITE_FIELDS = ('website', 'homepage')
+
+
+def iter_json(f):
+	"""
+	yield the objects of a JSON array or of JSON lines one by one
+	without loading the whole document
+	"""
+	decoder = json.JSONDecoder()
+	buf = ''
+	pos = 0
+	eof = False
+	while True:
+		# skip whatever separates the objects
+		pos = SEPARATORS.match(buf, pos).end()
+		if pos < len(buf):
+			try:
+				obj, pos = decoder.raw_decode(buf, pos)
+				yield obj
+				continue
+			except ValueError:
+				# most likely cut off at the end of the buffer
+				if eof:
+					raise
+		elif eof:
+			return
+
+		chunk = f.read(JSON_CHUNK)
+		eof = not chunk
+		buf = buf[pos:] + chunk
+		pos = 0
+
+
+def first_field(record, names):
+	for name in names:
+		value = record.get(name)
+		if value:
+			return value
+	return None
+
+
+class IdAllocator():
+	"""
+	hands out station ids so that no two stations share one
+	"""
+
+	def __init__(self, first_id):
+		self.used = set()
+		self.next_id = first_id
+		return
+
+	def assign(self, id = None):
+		"""
+		id if it's still free, the next free one otherwise
+		"""
+		if id is None or id in self.used:
+			while self.next_id in self.used:
+				self.next_id += 1
+			id = self.next_id
+		self.used.add(id)
+		return id
+
+
+def record_id(record):
+	"""
+	the id a directory record brings along, None unless it's a number
+	"""
+	# directories tend to use uuids, we need numbers
+	id = str(record.get('id', ''))
+	return int(id) if id.isdigit() else None
+
+
+def field_text(value, id, tag):
+	"""
+	a record field as text for the tag of station id. Numbers are
+	written as they are, anything else but a string raises StationError
+	"""
+	if value is None:
+		return None
+	if isinstance(value, (int, float)) and not isinstance(value, bool):
+		value = str(value)
+	elif not isinstance(value, str):
+		raise StationError('station {}: <{}> is {}, not text'.format(id, tag, type(value).__name__))
+	if XML_ILLEGAL.search(value):
+		raise StationError('station {}: <{}> has characters XML can\'t hold'.format(id, tag))
+	return value
+
+
+def station_element(record, id):
+	"""
+	turn a directory record (dict) into a 'station' element with id.
+	Raises StationError for fields we can't write
+	"""
+	elem = Element('station', id=str(id))
+	SubElement(elem, 'name').text = field_text(first_field(record, NAME_FIELDS), id, 'name')
+
+	urls = first_field(record, URL_FIELDS)
+	if isinstance(urls, list):
+		for url in urls:
+			if not isinstance(url, str):
+				raise StationError('station {}: <url> is {}, not text'.format(id, type(url).__name__))
+	else:
+		# several mirrors in one CSV column
+		urls = (field_text(urls, id, 'url') or '').replace('|', ' ').split()
+	for url in urls:
+		SubElement(elem, 'url').text = field_text(url, id, 'url')
+
+	website = field_text(first_field(record, WEBSITE_FIELDS), id, 'website')
+	if website:
+		SubElement(elem, 'website').text = website
+	return elem
+
+
+def iter_elements(f, format, first_id):
+	"""
+	yield (station element, error) for every entry of the input
+	"""
+	ids = IdAllocator(first_id)
+	if format == 'xml':
+		errors = []
+		for station in iter_stations(f, errors):
+			while errors:
+				yield None, errors.pop()
+			elem = Element('station', id=str(ids.assign(station.id)))
+			SubElement(elem, 'name').text = station.name
+			for url in station.urls:
+				SubElement(elem, 'url').text = url
+			if station.website:
+				SubElement(elem, 'website').text = station.website
+			yield elem, None
+		while errors:
+			yield None, errors.pop()
+		return
+
+	if format == 'json':
+		records = iter_json(f)
+	else:
+		records = csv.DictReader(f, delimiter='\t' if format == 'tsv' else ',')
+	for i, record in enumerate(records, first_id):
+		if not isinstance(record, dict):
+			yield None, StationError('entry {} is not an object'.format(i))
+			continue
+		id = record_id(record)
+		try:
+			# numbered by entry until it's valid and gets its id
+			elem = station_element(record, i if id is None else id)
+			validate_station(elem)
+		except StationError as e:
+			yield None, e
+			continue
+		elem.set('id', str(ids.assign(id)))
+		yield elem, None
+
+
+def import_stations(source, dest, format, first_id = 1, log = None):
+	"""
+	stream stations from source into dest as stations.xml
+
+	:returns dict with counts and timing
+	"""
+	start = time.perf_counter()
+	imported = 0
+	skipped = 0
+
+	dest.write('<?xml version="1.0" standalone="no" ?>\n<!DOCTYPE stations SYSTEM "stations.dtd">\n\n<stations>\n')
+	for elem, error in iter_elements(source, format, first_id):
+		if error is not None:
+			skipped += 1
+			if log:
+				log('skipping: {}'.format(error))
+			continue
+		dest.write('\t')
+		dest.write(tostring(elem, encoding='unicode'))
+		dest.write('\n')
+		imported += 1
+	dest.write('</stations>\n')
+
+	elapsed = time.perf_counter() - start
+	return {
+		'imported': imported,
+		'skipped': skipped,
+		'seconds': round(elapsed, 3),
+		'per_second': round(imported / elapsed) if elapsed else 0
+	}
+
+
+def guess_format(filename):
+	ext = os.path.splitext(filename)[1].lower()
+	if ext in ('.json', '.jsonl', '.ndjson'):
+		return 'json'
+	if ext == '.csv':
+		return 'csv'
+	if ext == '.tsv':
+		return 'tsv'
+	return 'xml'
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='import a station directory dump into stations.xml')
+	parser.add_argument('input', help='xml, json, csv or tsv dump')
+	parser.add_argument('output', nargs='?', help='stations.xml to write, default stdout')
+	parser.add_argument('--format', choices=('xml', 'json', 'csv', 'tsv'), help='default: guessed from the file name')
+	parser.add_argument('--first-id', type=int, default=1, help='id of the first entry without one')
+	parser.add_argument('--quiet', action='store_true', help='don\'t list skipped entries')
+	args = parser.parse_args()
+
+	format = args.format or guess_format(args.input)
+	log = None if args.quiet else lambda msg: sys.stderr.write(msg + '\n')
+
+	if format == 'xml':
+		source = open(args.input, 'rb')
+	else:
+		source = open(args.input, 'r', encoding='utf-8', newline='')
+
+	with source:
+		if args.output:
+			# write next to the target and move it in place when done
+			tmp = args.output + '.tmp'
+			with open(tmp, 'w', encoding='utf-8') as dest:
+				result = import_stations(source, dest, format, args.first_id, log)
+			os.replace(tmp, args.output)
+		else:
+			result = import_stations(source, sys.stdout, format, args.first_id, log)
+
+	sys.stderr.write('{imported} stations imported, {skipped} skipped in {seconds}s ({per_second}/s)\n'.format(**result))
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+"""
+Background command execution
+
+Commands from the web interface used to run on the request thread, so
+the browser waited for MPD or for /sbin/halt. JobQueue runs them on a
+worker thread one after the other instead, in the order they came in.
+A request only queues its command and gets a job id back to ask about
+it later. The queue is bounded, a full queue is reported right away
+instead of piling up taps nobody waits for anymore.
+"""
+
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+from mpdconnection import CommandStats
+
+# commands waiting at most
+QUEUE_SIZE = 32
+# finished jobs we can still tell about
+JOB_HISTORY = 100
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+	"""
+	raised by submit() when too many commands are waiting
+	"""
+	pass
+
+
+class Job():
+	"""
+	one queued command
+	"""
+
+	__slots__ = ('id', 'command', 'query', 'state', 'error', 'created', 'started', 'finished')
+
+	def __init__(self, id, command, query):
+		self.id = id
+		self.command = command
+		self.query = query
+		self.state = QUEUED
+		self.error = None
+		self.created = time.time()
+		self.started = None
+		self.finished = None
+
+	def as_dict(self):
+		return {
+			'id': self.id,
+			'command': self.command,
+			'state': self.state,
+			'error': self.error,
+			'created': self.created,
+			'started': self.started,
+			'finished': self.finished
+		}
+
+
+class JobQueue():
+	"""
+	runs commands of a CommandRegistry on a worker thread
+
+	:param commands = CommandRegistry the jobs are looked up in
+	:param observer = callable(command, wait, elapsed, failed) told
+		about every finished job, for metrics
+	"""
+
+	def __init__(self, commands, logger, size = QUEUE_SIZE, history = JOB_HISTORY, observer = None):
+		self.commands = commands
+		self.logger = logger
+		self.observer = observer
+		self.history = history
+		self.queue = queue.Queue(size)
+		self.lock = threading.Lock()
+		self.jobs = OrderedDict()
+		self.next_id = 1
+		self.thread = None
+
+		self.submitted = 0
+		self.rejected = 0
+		self.wait_stats = CommandStats()
+		self.run_stats = {}
+		return
+
+	def start(self):
+		"""
+		start the worker thread unless it's running already
+		"""
+		with self.lock:
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.worker, name='jobs', daemon=True)
+				self.thread.start()
+		return
+
+	def submit(self, command, query = None):
+		"""
+		queue a command and return its Job.
+		Raises QueueFull if there's no room for it
+		"""
+		self.start()
+		with self.lock:
+			job = Job(self.next_id, command, query or {})
+			try:
+				self.queue.put_nowait(job)
+			except queue.Full:
+				self.rejected += 1
+				raise QueueFull('{} commands waiting already'.format(self.queue.qsize()))
+			self.next_id += 1
+			self.submitted += 1
+			self.jobs[job.id] = job
+			# forget the oldest, queued jobs are always among the newest
+			while len(self.jobs) > self.history + self.queue.maxsize:
+				self.jobs.popitem(last=False)
+		return job
+
+	def get(self, id):
+		with self.lock:
+			return self.jobs.get(id)
+
+	def worker(self):
+		while True:
+			job = self.queue.get()
+			job.started = time.time()
+			job.state = RUNNING
+			start = time.perf_counter()
+			error = None
+			try:
+				if not self.commands.execute(job.command, job.query):
+					raise ValueError('unknown command {}'.format(job.command))
+			except Exception as e:
+				error = str(e) or e.__class__.__name__
+				self.logger.warning('command {} failed: {}'.format(job.command, error))
+			failed = error is not None
+			# state last, a job reported finished has everything else set
+			job.finished = time.time()
+			job.error = error
+			job.state = FAILED if failed else DONE
+
+			elapsed = time.perf_counter() - start
+			wait = job.started - job.created
+
+			with self.lock:
+				self.wait_stats.add(wait, False)
+				stats = self.run_stats.get(job.command)
+				if stats is None:
+					stats = self.run_stats[job.command] = CommandStats()
+				stats.add(elapsed, failed)
+			if self.observer is not None:
+				self.observer(job.command, wait, elapsed, failed)
+
+	def stats(self):
+		with self.lock:
+			return {
+				'depth': self.queue.qsize(),
+				'capacity': self.queue.maxsize,
+				'submitted': self.submitted,
+				'rejected': self.rejected,
+				'wait': self.wait_stats.as_dict(),
+				'commands': {c: s.as_dict() for c, s in self.run_stats.items()}
+			}
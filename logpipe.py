@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+"""
+Logging off the request path
+
+Writing a log line means formatting it and a write() to the SD card,
+and with a handler on the root logger that happened on whatever thread
+logged, request handlers included. LogPipeline puts a queue handler on
+the root logger instead and leaves formatting and writing to a
+listener thread. SamplingFilter keeps the endless polling of open
+browser tabs from filling the log: records logged with a sample_key
+are let through at most a few times per interval per key. Keys should
+come from a fixed set like the routing table, still the filter only
+tracks MAX_SAMPLE_KEYS of them.
+"""
+
+import os
+import time
+import queue
+import atexit
+import threading
+import logging
+import logging.handlers
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+# records waiting for the listener at most, beyond that they are dropped
+MAX_QUEUED = 10000
+# records per sample key and interval we let through by default
+SAMPLE_LIMIT = 10
+SAMPLE_INTERVAL = 60.0
+# sample keys tracked at most, idle ones are forgotten beyond that
+MAX_SAMPLE_KEYS = 1024
+
+
+class SamplingFilter(logging.Filter):
+	"""
+	rate limits records by their sample_key attribute, as in
+	logger.info(msg, extra={'sample_key': path}). Records without
+	one always pass. The first record after a quiet interval says how
+	many were suppressed
+
+	:param limits = dict of sample key to records per interval, keys
+		not in it get limit
+	"""
+
+	def __init__(self, limit = SAMPLE_LIMIT, interval = SAMPLE_INTERVAL, limits = None):
+		logging.Filter.__init__(self)
+		self.limit = limit
+		self.interval = interval
+		self.limits = limits or {}
+		self.lock = threading.Lock()
+		# key -> [window start, records in window, suppressed]
+		self.windows = {}
+		self.suppressed = 0
+		return
+
+	def filter(self, record):
+		key = getattr(record, 'sample_key', None)
+		if key is None:
+			return True
+		now = time.monotonic()
+		with self.lock:
+			window = self.windows.get(key)
+			if window is None and len(self.windows) >= MAX_SAMPLE_KEYS:
+				self.prune(now)
+			if window is None or now - window[0] >= self.interval:
+				skipped = window[2] if window is not None else 0
+				window = self.windows[key] = [now, 0, 0]
+				if skipped:
+					record.msg = '{} ({} similar suppressed)'.format(record.msg, skipped)
+			if window[1] >= self.limits.get(key, self.limit):
+				window[2] += 1
+				self.suppressed += 1
+				return False
+			window[1] += 1
+		return True
+
+	def prune(self, now):
+		"""
+		forget the windows whose interval is over, all of them if that
+		doesn't free half. Call with self.lock held
+		"""
+		self.windows = {key: window for key, window in self.windows.items() if now - window[0] < self.interval}
+		if len(self.windows) >= MAX_SAMPLE_KEYS // 2:
+			self.windows = {}
+		return
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+	"""
+	queue handler for a listener in the same process. Records are
+	queued as they are, the listener's handlers format them
+	"""
+
+	def __init__(self, queue):
+		logging.handlers.QueueHandler.__init__(self, queue)
+		self.dropped = 0
+		return
+
+	def prepare(self, record):
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+		return
+
+
+class LogPipeline():
+	"""
+	root logger setup: one queue handler, one listener thread
+	writing to a rotating log file
+
+	The listener is a thread, so start() it only after the daemon
+	forked. Until then records wait in the queue, and whatever is left
+	at exit is written out then. A forked child forgets what was queued
+	before the fork, the parent writes that on its way out.
+	"""
+
+	def __init__(self, filename, level = logging.DEBUG, sampling = None):
+		self.queue = queue.Queue(MAX_QUEUED)
+		self.handler = LocalQueueHandler(self.queue)
+		if sampling is not None:
+			self.handler.addFilter(sampling)
+		self.sampling = sampling
+
+		self.filehandler = logging.handlers.TimedRotatingFileHandler(filename, when='midnight', interval=1, backupCount=10, delay=True)
+		self.filehandler.setFormatter(logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATEFMT))
+		self.listener = logging.handlers.QueueListener(self.queue, self.filehandler)
+		self.started = False
+
+		# whoever attached handlers before us would write every record again
+		root = logging.getLogger()
+		for handler in list(root.handlers):
+			root.removeHandler(handler)
+		root.addHandler(self.handler)
+		root.setLevel(level)
+		atexit.register(self.stop)
+		os.register_at_fork(after_in_child=self.forget)
+		return
+
+	def forget(self):
+		while True:
+			try:
+				self.queue.get_nowait()
+			except queue.Empty:
+				break
+		return
+
+	def start(self):
+		if not self.started:
+			self.listener.start()
+			self.started = True
+		return
+
+	def stop(self):
+		"""
+		write out everything queued so far
+		"""
+		if self.started:
+			self.listener.stop()
+			self.started = False
+			return
+		while True:
+			try:
+				self.filehandler.handle(self.queue.get_nowait())
+			except queue.Empty:
+				break
+		return
+
+	def stats(self):
+		return {
+			'queued': self.queue.qsize(),
+			'dropped': self.handler.dropped,
+			'suppressed': self.sampling.suppressed if self.sampling is not None else 0,
+			'sample_keys': len(self.sampling.windows) if self.sampling is not None else 0
+		}
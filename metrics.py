@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+"""
+Metrics in Prometheus text format
+
+Just enough of a metrics library for /metrics: counters, gauges read
+from a function when scraped, and histograms with fixed buckets.
+Observing a value is a bisect and two additions under a lock, cheap
+enough for every request and every MPD call.
+"""
+
+import os
+import time
+import threading
+from bisect import bisect_left
+
+# seconds, good for anything from a cached page to an MPD timeout
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra = ''):
+	labels = ','.join('{}="{}"'.format(name, escape(value)) for name, value in zip(names, values))
+	if extra:
+		labels = labels + ',' + extra if labels else extra
+	return '{' + labels + '}' if labels else ''
+
+
+def format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value)
+
+
+class Counter():
+
+	__slots__ = ('value', 'lock')
+
+	def __init__(self):
+		self.value = 0
+		self.lock = threading.Lock()
+
+	def inc(self, amount = 1):
+		with self.lock:
+			self.value += amount
+
+	def samples(self, name, labels):
+		yield name + '_total' + labels, self.value
+
+
+class Histogram():
+	"""
+	counts per bucket, cumulated only when rendered
+
+	:param buckets = sorted upper bounds, +Inf is implied
+	"""
+
+	__slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.lock = threading.Lock()
+
+	def observe(self, value):
+		i = bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[i] += 1
+			self.sum += value
+
+	def samples(self, name, labels):
+		with self.lock:
+			counts = list(self.counts)
+			total = self.sum
+		# le goes last, after the metric's own labels
+		inner = labels[1:-1]
+		cumulated = 0
+		for bound, count in zip(self.buckets + (float('inf'),), counts):
+			cumulated += count
+			le = 'le="{}"'.format(format_value(bound))
+			yield '{}_bucket{{{}}}'.format(name, inner + ',' + le if inner else le), cumulated
+		yield name + '_sum' + labels, total
+		yield name + '_count' + labels, cumulated
+
+
+class Family():
+	"""
+	one metric with all its label combinations
+	"""
+
+	def __init__(self, name, help, kind, labelnames, factory):
+		self.name = name
+		self.help = help
+		self.kind = kind
+		self.labelnames = tuple(labelnames)
+		self.factory = factory
+		self.children = {}
+		self.lock = threading.Lock()
+		return
+
+	def labels(self, *values):
+		child = self.children.get(values)
+		if child is None:
+			with self.lock:
+				child = self.children.setdefault(values, self.factory())
+		return child
+
+	def render(self):
+		lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+		for values, child in sorted(self.children.items()):
+			for sample, value in child.samples(self.name, format_labels(self.labelnames, values)):
+				lines.append('{} {}'.format(sample, format_value(value)))
+		return lines
+
+
+class GaugeFunction():
+	"""
+	gauge read from a callable whenever we are scraped. With kind
+	'counter' for totals somebody else keeps, like CPU time
+	"""
+
+	def __init__(self, name, help, read, kind = 'gauge'):
+		self.name = name
+		self.help = help
+		self.read = read
+		self.kind = kind
+		return
+
+	def render(self):
+		try:
+			value = self.read()
+		except Exception:
+			# whatever it reads from isn't there (yet)
+			return []
+		return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind),
+			'{} {}'.format(self.name, format_value(value))]
+
+
+class Registry():
+	"""
+	all metrics of the process, rendered in registration order
+	"""
+
+	def __init__(self):
+		self.metrics = []
+		return
+
+	def counter(self, name, help, labelnames = ()):
+		return self.add(Family(name, help, 'counter', labelnames, Counter))
+
+	def histogram(self, name, help, labelnames = (), buckets = DEFAULT_BUCKETS):
+		return self.add(Family(name, help, 'histogram', labelnames, lambda: Histogram(buckets)))
+
+	def gauge(self, name, help, read, kind = 'gauge'):
+		return self.add(GaugeFunction(name, help, read, kind))
+
+	def add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def add_process_metrics(self):
+		"""
+		the usual process_* gauges, read from /proc
+		"""
+		page_size = os.sysconf('SC_PAGE_SIZE')
+
+		def rss():
+			with open('/proc/self/statm') as f:
+				return int(f.read().split()[1]) * page_size
+
+		def cpu():
+			t = os.times()
+			return t.user + t.system
+
+		started = time.time()
+		self.gauge('process_resident_memory_bytes', 'Resident memory size in bytes.', rss)
+		self.gauge('process_cpu_seconds_total', 'Total user and system CPU time spent in seconds.', cpu, 'counter')
+		self.gauge('process_open_fds', 'Number of open file descriptors.', lambda: len(os.listdir('/proc/self/fd')))
+		self.gauge('process_start_time_seconds', 'Start time of the process since unix epoch in seconds.', lambda: started)
+		return
+
+	def render(self):
+		lines = []
+		for metric in self.metrics:
+			lines.extend(metric.render())
+		return '\n'.join(lines) + '\n'
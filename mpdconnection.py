@@ -0,0 +1,323 @@
+#!/usr/bin/python3
+
+"""
+MPD access layer
+
+MPDClient is neither thread safe nor does it survive MPD dropping the
+connection, which MPD happily does to idle clients. MPDConnection owns
+one client and runs every command on a dedicated worker thread, so
+concurrent handlers are serialized. The worker pings MPD while idle
+to keep the connection open and reconnects with backoff when it is
+lost anyway.
+"""
+
+import time
+import queue
+import threading
+import functools
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from mpd import MPDClient, MPDError, CommandError
+
+# seconds of inactivity after which the worker pings MPD. MPD's
+# own connection_timeout defaults to 60
+KEEPALIVE_INTERVAL = 30.0
+# reconnect backoff, doubling from min to max seconds
+BACKOFF_MIN = 0.1
+BACKOFF_MAX = 10.0
+# queued in place of a command name for command lists
+COMMAND_LIST = 'command_list'
+
+
+class MPDUnavailable(Exception):
+	"""
+	raised when MPD cannot be reached or doesn't answer in time
+	"""
+	pass
+
+
+class CommandListError(Exception):
+	"""
+	a command of a command list failed. MPD stops at that point, so
+	everything before step was executed, nothing after it
+	"""
+
+	def __init__(self, step, command, message):
+		Exception.__init__(self, 'step {} ({}): {}'.format(step, command, message))
+		self.step = step
+		self.command = command
+		self.message = message
+
+
+class CommandStats():
+	"""
+	latency and error counters of one MPD command
+	"""
+
+	__slots__ = ('calls', 'errors', 'total', 'max')
+
+	def __init__(self):
+		self.calls = 0
+		self.errors = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, elapsed, failed):
+		self.calls += 1
+		if failed:
+			self.errors += 1
+		self.total += elapsed
+		if elapsed > self.max:
+			self.max = elapsed
+
+	def as_dict(self):
+		return {
+			'calls': self.calls,
+			'errors': self.errors,
+			'avg_ms': round(self.total / self.calls * 1000, 3) if self.calls else 0.0,
+			'max_ms': round(self.max * 1000, 3)
+		}
+
+
+class MPDConnection():
+	"""
+	Thread safe, self healing MPD client
+
+	Commands are called just like on MPDClient (conn.currentsong()) and
+	block the caller until the worker has an answer. submit() returns a
+	Future instead.
+
+	The worker is started by start() or the first command. Don't start it
+	before the daemon forks, threads don't survive that.
+
+	:param host = host name or unix socket path of MPD
+	:param port = MPD port, ignored for unix sockets
+	:param timeout = seconds we wait for MPD to answer one command
+	:param observer = callable(name, command, elapsed, failed) told
+		about every command on top of our own stats, if any
+	"""
+
+	def __init__(self, host, port, logger, timeout = 5.0, name = 'mpd', observer = None):
+		self.host = host
+		self.port = port
+		self.logger = logger
+		self.timeout = timeout
+		self.name = name
+		self.observer = observer
+
+		self.client = None
+		self.backoff = BACKOFF_MIN
+		self.retry_at = 0.0
+
+		self.connects = 0
+		self.failed_connects = 0
+		self.stats_lock = threading.Lock()
+		self.command_stats = {}
+
+		self.queue = queue.Queue()
+		self.thread = None
+		self.thread_lock = threading.Lock()
+		return
+
+	def __getattr__(self, command):
+		if command.startswith('_'):
+			raise AttributeError(command)
+		return functools.partial(self.call, command)
+
+	def start(self):
+		"""
+		start the worker thread unless it's running already
+		"""
+		with self.thread_lock:
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self.worker, name=self.name, daemon=True)
+				self.thread.start()
+		return
+
+	def submit(self, command, *args):
+		"""
+		queue a command for the worker, returns a Future
+		"""
+		if self.thread is None or not self.thread.is_alive():
+			self.start()
+		future = Future()
+		self.queue.put((future, command, args))
+		return future
+
+	def call(self, command, *args, timeout = None):
+		"""
+		execute a command and wait for its result
+		"""
+		future = self.submit(command, *args)
+		try:
+			return future.result(timeout or self.timeout * 2)
+		except FutureTimeout:
+			future.cancel()
+			raise MPDUnavailable('MPD did not answer {} in time'.format(command))
+
+	def command_list(self, commands, timeout = None):
+		"""
+		execute several commands in one round trip and wait for the results
+
+		:param commands = list of (command, arg, ...) tuples
+		:returns list with the result of each command
+		:raises CommandListError naming the command MPD refused
+		"""
+		return self.call(COMMAND_LIST, *commands, timeout=timeout)
+
+	def close(self):
+		"""
+		stop the worker after everything queued so far is done
+		"""
+		self.queue.put(None)
+		return
+
+	def connected(self):
+		return self.client is not None
+
+	def connect(self):
+		"""
+		open a fresh connection unless we're still backing off
+		from the last failed attempt
+		"""
+		now = time.monotonic()
+		if now < self.retry_at:
+			raise MPDUnavailable('MPD unreachable, retrying in {:.1f}s'.format(self.retry_at - now))
+
+		client = MPDClient()
+		client.timeout = self.timeout
+		# idle waits for as long as it takes
+		client.idletimeout = None
+		try:
+			client.connect(self.host, self.port)
+		except (MPDError, OSError) as e:
+			self.failed_connects += 1
+			self.retry_at = now + self.backoff
+			self.logger.warning('{}: cannot connect to {}: {}, next attempt in {:.1f}s'.format(self.name, self.host, e, self.backoff))
+			self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+			raise MPDUnavailable(str(e))
+
+		if self.connects or self.failed_connects:
+			self.logger.info('{}: reconnected to {}'.format(self.name, self.host))
+		self.connects += 1
+		self.backoff = BACKOFF_MIN
+		self.retry_at = 0.0
+		self.client = client
+		return
+
+	def disconnect(self):
+		if self.client is None:
+			return
+		try:
+			self.client.disconnect()
+		except (MPDError, OSError):
+			pass
+		self.client = None
+		return
+
+	def execute(self, command, args):
+		"""
+		run one command on the worker thread. A command failing because
+		the connection is gone is retried once on a new connection
+		"""
+		for attempt in (0, 1):
+			if self.client is None:
+				self.connect()
+			try:
+				if command == COMMAND_LIST:
+					return self.execute_list(args)
+				return getattr(self.client, command)(*args)
+			except (CommandError, CommandListError):
+				raise
+			except (MPDError, OSError) as e:
+				self.logger.warning('{}: connection lost during {}: {}'.format(self.name, command, e))
+				self.disconnect()
+				if attempt:
+					raise MPDUnavailable(str(e))
+
+	def execute_list(self, commands):
+		"""
+		send commands as one command list and read all answers at once
+		"""
+		client = self.client
+		client.command_list_ok_begin()
+		try:
+			for command in commands:
+				getattr(client, command[0])(*command[1:])
+		except AttributeError:
+			# unknown command, and the client is stuck in the list
+			self.disconnect()
+			raise
+		try:
+			return client.command_list_end()
+		except CommandError as e:
+			step = e.offset if e.offset is not None else len(commands) - 1
+			raise CommandListError(step, commands[step][0], e.msg or str(e))
+
+	def worker(self):
+		# connect right away so the first request doesn't pay for it
+		self.keepalive()
+		while True:
+			try:
+				item = self.queue.get(timeout=KEEPALIVE_INTERVAL)
+			except queue.Empty:
+				self.keepalive()
+				continue
+
+			if item is None:
+				self.disconnect()
+				return
+
+			future, command, args = item
+			if not future.set_running_or_notify_cancel():
+				continue
+
+			start = time.perf_counter()
+			failed = False
+			try:
+				future.set_result(self.execute(command, args))
+			except Exception as e:
+				failed = True
+				future.set_exception(e)
+			self.record(command, time.perf_counter() - start, failed)
+
+	def keepalive(self):
+		"""
+		ping MPD so it doesn't drop us, or try to get
+		back a connection we lost
+		"""
+		try:
+			if self.client is None:
+				self.connect()
+			else:
+				self.client.ping()
+		except MPDUnavailable:
+			pass
+		except (MPDError, OSError) as e:
+			self.logger.warning('{}: keepalive failed: {}'.format(self.name, e))
+			self.disconnect()
+		return
+
+	def record(self, command, elapsed, failed):
+		with self.stats_lock:
+			s = self.command_stats.get(command)
+			if s is None:
+				s = self.command_stats[command] = CommandStats()
+			s.add(elapsed, failed)
+		if self.observer is not None:
+			self.observer(self.name, command, elapsed, failed)
+		return
+
+	def stats(self):
+		"""
+		connection state, latency and error counters as dict
+		"""
+		with self.stats_lock:
+			commands = {c: s.as_dict() for c, s in self.command_stats.items()}
+		return {
+			'connected': self.connected(),
+			'connects': self.connects,
+			'failed_connects': self.failed_connects,
+			'queue': self.queue.qsize(),
+			'commands': commands
+		}
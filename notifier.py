@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+"""
+Push notifications for the web interface
+
+PlayerWatcher sits in MPD's idle command on a connection of its own
+and reports player changes as they happen. Broadcaster fans events out
+to any number of subscribers, e.g. the Server-Sent Events streams of
+all open browser tabs.
+"""
+
+import time
+import threading
+
+from mpdconnection import MPDUnavailable
+
+# pause before we ask MPD for idle events again after a failure
+WATCH_RETRY = 1.0
+
+
+def format_event(name, data):
+	"""
+	encode one Server-Sent Event
+	"""
+	lines = ['event: ' + name]
+	for line in str(data).split('\n'):
+		lines.append('data: ' + line)
+	return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+class Broadcaster():
+	"""
+	fans named events out to subscribers
+
+	The last value of every event is kept so that new subscribers
+	can be brought up to date right away. Publishing the same value
+	twice in a row is a no-op.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.subscribers = []
+		self.last = {}
+		return
+
+	def subscribe(self, callback):
+		"""
+		callback(name, data) gets called for every event from
+		whatever thread publishes it. Returns a copy of the last values
+		"""
+		with self.lock:
+			self.subscribers.append(callback)
+			return dict(self.last)
+
+	def unsubscribe(self, callback):
+		with self.lock:
+			if callback in self.subscribers:
+				self.subscribers.remove(callback)
+		return
+
+	def publish(self, name, data):
+		with self.lock:
+			if self.last.get(name) == data:
+				return
+			self.last[name] = data
+			subscribers = list(self.subscribers)
+		for callback in subscribers:
+			callback(name, data)
+		return
+
+	def subscriber_count(self):
+		with self.lock:
+			return len(self.subscribers)
+
+
+class PlayerWatcher():
+	"""
+	calls back whenever MPD reports a change in one of the given subsystems
+
+	:param connection = MPDConnection used for nothing but idle as it is
+		blocked while waiting
+	:param callback = called with the list of changed subsystems, once
+		right after start as well
+	"""
+
+	def __init__(self, connection, callback, logger, subsystems = ('player',)):
+		self.connection = connection
+		self.callback = callback
+		self.logger = logger
+		self.subsystems = subsystems
+		self.thread = None
+		return
+
+	def start(self):
+		if self.thread is None or not self.thread.is_alive():
+			self.thread = threading.Thread(target=self.run, name='mpd-watcher', daemon=True)
+			self.thread.start()
+		return
+
+	def notify(self, changed):
+		try:
+			self.callback(changed)
+		except Exception:
+			self.logger.exception('player change callback failed')
+		return
+
+	def run(self):
+		self.notify(list(self.subsystems))
+		while True:
+			try:
+				changed = self.connection.submit('idle', *self.subsystems).result()
+			except MPDUnavailable:
+				time.sleep(WATCH_RETRY)
+				continue
+			except Exception as e:
+				self.logger.warning('waiting for MPD events failed: {}'.format(e))
+				time.sleep(WATCH_RETRY)
+				continue
+			self.notify(changed)
@@ -2,29 +2,61 @@
 
 import string,time
 import sys, os
+import signal
 from daemon import Daemon
 
 from http.server import HTTPServer, SimpleHTTPRequestHandler 
 import socketserver
+import threading
 import logging
-import logging.handlers
-from urllib.parse import urlparse, parse_qs, unquote
 from subprocess import call
+import json
+import html
+import collections
 from stations import Station, Stations
 from datamodel import DataModel
-from mpd import MPDClient
+from history import History, HISTORY_LIMIT, HISTORY_LIMIT_MAX
+from aioserver import AsyncHTTPServer, etag_matches, KEEPALIVE_TIMEOUT, MAX_CONNECTIONS, MAX_BODY, DRAIN_TIMEOUT
+from mpdconnection import MPDConnection, MPDUnavailable, CommandListError, COMMAND_LIST
+from rooms import Room, Rooms, GroupCommandError, parse_rooms
+from notifier import Broadcaster, PlayerWatcher
+from status import StatusSnapshot
+from search import StationIndex
+from staticcache import StaticCache
+from logpipe import LogPipeline, SamplingFilter
+from prober import StreamProber
+from resolver import StreamResolver
+from tuner import TuneScheduler
+from jobs import JobQueue, QueueFull
+from router import Router, CommandRegistry, PAGE, ACTION, STREAM, FILE
+from startup import StartupProfile
+import handoff
+import metrics
 
-# Setup logging
+# what startup takes, counted from the start of the interpreter
+startup = StartupProfile()
+startup.mark('imports')
+
+# Setup logging. One file, written by a thread of its own. What
+# open browser tabs poll is logged once a minute at most
+log_sampling = SamplingFilter(limits={'/current_song.html': 1, '/current_station.html': 1, '/status.json': 1, '/metrics': 1})
+log_pipeline = LogPipeline('/tmp/paradium.log', logging.DEBUG, log_sampling)
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-filehandler = logging.handlers.TimedRotatingFileHandler('/tmp/paradium.log', when='midnight', interval=1, backupCount=10)
-filehandler.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
-logger.addHandler(filehandler)
+# python-mpd2 logs every command at DEBUG
+logging.getLogger('mpd').setLevel(logging.INFO)
 
 # setup environment variable defaults
 PARADIUM_HOME     = '/opt/paradium/'
 PARADIUM_VHOME    = '/var/paradium/'
 PARADIUM_MPDHOST  = '/var/run/mpd/socket'
+PARADIUM_MPDPORT  = 6600
+PARADIUM_PORT     = 80
+PARADIUM_PIDFILE  = '/tmp/paradium-daemon.pid'
+# 'async' for the asyncio front end, 'blocking' for the plain HTTPServer
+PARADIUM_SERVER   = 'async'
+# name=host[:port],... for one MPD per room, see rooms.py. The first
+# room replaces PARADIUM_MPDHOST/PARADIUM_MPDPORT
+PARADIUM_ROOMS    = ''
 
 # and override with the actual environment
 if 'PARADIUM_HOME' in os.environ:
@@ -33,20 +65,73 @@ if 'PARADIUM_VHOME' in os.environ:
 	PARADIUM_VHOME = os.environ['PARADIUM_VHOME']
 if 'PARADIUM_MPDHOST' in os.environ:
 	PARADIUM_MPDHOST = os.environ['PARADIUM_MPDHOST']
+if 'PARADIUM_MPDPORT' in os.environ:
+	PARADIUM_MPDPORT = int(os.environ['PARADIUM_MPDPORT'])
+if 'PARADIUM_PORT' in os.environ:
+	PARADIUM_PORT = int(os.environ['PARADIUM_PORT'])
+if 'PARADIUM_PIDFILE' in os.environ:
+	PARADIUM_PIDFILE = os.environ['PARADIUM_PIDFILE']
+if 'PARADIUM_SERVER' in os.environ:
+	PARADIUM_SERVER = os.environ['PARADIUM_SERVER']
+if 'PARADIUM_ROOMS' in os.environ:
+	PARADIUM_ROOMS = os.environ['PARADIUM_ROOMS']
+
+# (name, host, port) of every room, the primary one first
+ROOM_CONFIG = parse_rooms(PARADIUM_ROOMS) or [('main', PARADIUM_MPDHOST, PARADIUM_MPDPORT)]
+
+# what /metrics tells the monitoring. Routes are labelled by the
+# table entry they matched, all static files share one label
+registry = metrics.Registry()
+request_duration = registry.histogram('paradium_http_request_duration_seconds',
+	'Time to answer a request, by route, method and status.', ('route', 'method', 'status'))
+mpd_duration = registry.histogram('paradium_mpd_command_duration_seconds',
+	'Time MPD commands took including the wait for the connection, by connection and command.', ('connection', 'command'))
+mpd_errors = registry.counter('paradium_mpd_command_errors',
+	'MPD commands that failed, by connection and command.', ('connection', 'command'))
+station_switches = registry.counter('paradium_station_switches',
+	'Stations tuned in.')
+registry.add_process_metrics()
+
+def observe_request(route, method, status, elapsed):
+	label = (route.pattern or 'static') if route is not None else 'none'
+	request_duration.labels(label, method, str(status)).observe(elapsed)
+	startup.request_served(route.path if route is not None else None)
+	return
+
+def observe_mpd(name, command, elapsed, failed):
+	mpd_duration.labels(name, command).observe(elapsed)
+	if failed:
+		mpd_errors.labels(name, command).inc()
+	return
 
-# setup global MPD client object
-client = MPDClient()
-client.connect(PARADIUM_MPDHOST, 6600)
+# setup global MPD client object. It connects in the background,
+# serializes commands from all handler threads and reconnects on its own.
+# Tuning goes out as one command list and is timed as command_list
+client = MPDConnection(ROOM_CONFIG[0][1], ROOM_CONFIG[0][2], logger, observer=observe_mpd)
 
-# modify this to add additional routes
+# idle blocks a connection so the watcher gets one of its own
+idle_client = MPDConnection(ROOM_CONFIG[0][1], ROOM_CONFIG[0][2], logger, name='mpd-idle')
+
+# modify this to add additional routes, the longest matching prefix wins
 ROUTES = (
     # [url_prefix ,  directory_path]
     ['/media', '/var/www/media'],
     ['', PARADIUM_HOME + '/htdocs']  # empty string for the 'default' match
 ) 
 
-# read radio stations file and make available
-stations = Stations(logger);
+# radio stations from stations.xml. Loaded once we listen, see initialize()
+stations = Stations(logger, load=False)
+
+# word index for station search, built by the first search of a catalog, see search_index()
+station_index = None
+station_index_lock = threading.Lock()
+
+# htdocs files we serve from memory
+static_cache = StaticCache()
+
+# page size of station listings and search results
+PAGE_LIMIT = 20
+PAGE_LIMIT_MAX = 100
 
 # Now here's the thing. A solid way to handle our data 
 # model would be to have it owned by the daemon and pass
@@ -56,46 +141,591 @@ stations = Stations(logger);
 # parameter at class creation as this is done by the underlying
 # http.server
 # So for now I have it global and see how I go
-dm = DataModel(logger)
+dm = DataModel(logger, restore=False)
+
+def make_room(name, host, port):
+	"""
+	a room besides the primary one, its state lives in rooms/<name>/
+	"""
+	connection = MPDConnection(host, port, logger, name='mpd-' + name, observer=observe_mpd)
+	return Room(name, connection, DataModel(logger, os.path.join(PARADIUM_VHOME, 'rooms', name), restore=False))
+
+# the primary room is the one the web interface controls
+rooms = Rooms([Room(ROOM_CONFIG[0][0], client, dm)] + [make_room(*config) for config in ROOM_CONFIG[1:]])
+
+# songs played in the primary room, segments under $PARADIUM_VHOME/history/
+history = History(logger, os.path.join(PARADIUM_VHOME, 'history'), restore=False)
+
+def stop_flushers():
+	"""
+	write out everything and stop writing state, see hand_over()
+	"""
+	for room in rooms:
+		room.dm.stop()
+	history.stop()
+	return
+
+def start_flushers():
+	for room in rooms:
+		room.dm.start()
+	history.start()
+	return
+
+def persist_state():
+	dm.persist()
+	history.persist()
+	# the other rooms get their directories while we start up
+	if startup.ready.is_set():
+		for room in rooms:
+			if room.dm is not dm:
+				room.dm.persist()
+	return
+
+# seconds a request waits for the catalog and the state while we start up
+STARTUP_WAIT = 5.0
+# print the startup profile once the first request was answered, see --profile-startup
+PROFILE_STARTUP = False
+
+class StartingUp(Exception):
+	"""
+	raised when a request needs what is still being loaded. Answered with 503
+	"""
+	pass
+
+def wait_ready():
+	"""
+	block until catalog and state are loaded
+	"""
+	if not startup.ready.wait(STARTUP_WAIT):
+		raise StartingUp('station catalog is still loading')
+	return
+
+# commands the web interface sends to /paradium.html
+commands = CommandRegistry()
+
+# stations tuned to lately, their mirrors are probed as well
+RECENT_STATIONS = 16
+recent_stations = collections.deque(maxlen=RECENT_STATIONS)
+
+def probe_urls():
+	"""
+	stream urls worth probing: of the station of every room, the ones
+	next and prev lead to and the ones tuned to lately, the primary
+	room's station first. Never the whole catalog
+	"""
+	ids = [room.dm.current_station() for room in rooms] + list(recent_stations)
+	urls = []
+	for id in dict.fromkeys(ids):
+		for s in (stations.get_station(id), stations.get_next(id), stations.get_prev(id)):
+			if s is not None:
+				urls.extend(s.urls)
+	return urls
+
+# checks mirrors in the background so we can try the fastest first
+prober = StreamProber(logger, probe_urls)
+
+# playlists and redirects expanded to streams, ahead of time for next/prev
+resolver = StreamResolver(logger)
+
+def prefetch_neighbours(id):
+	"""
+	resolve the stations a next or prev tap leads to
+	"""
+	urls = []
+	for s in (stations.get_next(id), stations.get_prev(id)):
+		if s is not None:
+			urls.extend(s.urls)
+	resolver.prefetch(urls)
+	return
+
+def tune_commands(s):
+	"""
+	command list switching MPD to station s, one round trip
+	"""
+	urls = resolver.resolve(prober.order(s.urls))
+	logger.debug('tuning to {} with {} urls'.format(s.id, len(urls)))
+	return [('stop',), ('clear',)] + [('add', url) for url in urls] + [('play',)]
 
 def play_current():
 	"""
 	try to play the station currently selected in our data model no matter what
 	"""
+	wait_ready()
 	s = stations.get_station(dm.current_station())
-	client.stop()
-	client.clear()
-	for url in s.urls:
-		print('adding ' + url)
-		client.add(url)
-	client.play()
+	if s is None:
+		# a reload removed it, MPD keeps playing what it has
+		logger.warning('not tuning, station {} is not in the catalog'.format(dm.current_station()))
+		return
+	try:
+		client.command_list(tune_commands(s))
+	except CommandListError as e:
+		logger.error('tuning to {} failed at {}'.format(s.id, e))
+		raise
+	station_switches.labels().inc()
+	return
+
+# the selection changes with every tap, MPD only hears
+# about it once the taps stopped. It plays whatever is
+# selected by then
+tuner = TuneScheduler(lambda id: play_current(), logger)
+
+def settle_tuner():
+	"""
+	tune right away if a tune is waiting for the taps to stop,
+	after the one MPD may be busy with
+	"""
+	if tuner.cancel():
+		tuner.wait_idle(client.timeout * 2)
+		play_current()
+	return
+
+def selected_rooms(query):
+	"""
+	rooms named by the room parameter of a command, 'all' or names
+	separated by commas. None without one, the command is for the
+	primary room then
+	"""
+	spec = (query or {}).get('room', [None])[0]
+	return rooms.select(spec) if spec else None
+
+def switch_rooms(targets, station_for):
+	"""
+	tune every room of targets to station_for(room) right away, all
+	rooms at once
+	"""
+	wait_ready()
+	if rooms.primary in targets:
+		# a pending tune would switch the primary room back
+		tuner.cancel()
+	calls = []
+	for room in targets:
+		s = station_for(room)
+		if s is None:
+			raise ValueError('no station for room {}'.format(room.name))
+		room.dm.set_current_station(s.id)
+		calls.append((room, COMMAND_LIST, tune_commands(s)))
+	rooms.run(calls)
+	station_switches.labels().inc(len(calls))
 	return
 
-def do_play():
-	client.play()
+@commands.register('play')
+def do_play(query = None):
+	targets = selected_rooms(query)
+	if targets is not None:
+		rooms.group(targets, 'play')
+	# a pending tune plays anyway, and the playlist is still the old one
+	elif not tuner.is_pending():
+		client.play()
 	return
 
-def do_prev():
+@commands.register('prev')
+def do_prev(query = None):
+	targets = selected_rooms(query)
+	if targets is not None:
+		switch_rooms(targets, lambda room: stations.get_prev(room.dm.current_station()))
+		return
+	wait_ready()
 	s = stations.get_prev(dm.current_station())
+	if s is None:
+		raise ValueError('no stations in the catalog')
 	dm.set_current_station(s.id)
-	play_current()
+	tuner.request(s.id)
 	return
 
-def do_next():
+@commands.register('next')
+def do_next(query = None):
+	targets = selected_rooms(query)
+	if targets is not None:
+		switch_rooms(targets, lambda room: stations.get_next(room.dm.current_station()))
+		return
+	wait_ready()
 	s = stations.get_next(dm.current_station())
+	if s is None:
+		raise ValueError('no stations in the catalog')
 	dm.set_current_station(s.id)
-	play_current()
+	tuner.request(s.id)
 	return
 
-def do_stop():
-	print ("they want me to stop playing")
-	client.stop()
+@commands.register('stop')
+def do_stop(query = None):
+	targets = selected_rooms(query)
+	if targets is None or rooms.primary in targets:
+		tuner.cancel()
+	if targets is not None:
+		rooms.group(targets, 'stop')
+	else:
+		client.stop()
 	return
 
-def do_shutdown():
+@commands.register('shutdown')
+def do_shutdown(query = None):
 	call("/sbin/halt")
 	return
 
+@commands.register('reload')
+def do_reload(query = None):
+	stations.reload()
+	return
+
+@commands.register('tune')
+def do_tune(query):
+	id = query.get('id', [''])[0]
+	wait_ready()
+	s = stations.get_station(id)
+	if s is None:
+		raise ValueError('no station {}'.format(id))
+	targets = selected_rooms(query)
+	if targets is not None:
+		switch_rooms(targets, lambda room: s)
+		return
+	dm.set_current_station(s.id)
+	tuner.request(s.id)
+	return
+
+# the queue as /metrics sees it, so a 503 for a full queue shows up
+# in the monitoring and not only in /api/jobs
+job_wait = registry.histogram('paradium_job_wait_seconds',
+	'Time commands waited in the queue before they ran.')
+job_duration = registry.histogram('paradium_job_duration_seconds',
+	'Time queued commands took to run, by command.', ('command',))
+job_errors = registry.counter('paradium_job_errors',
+	'Queued commands that failed, by command.', ('command',))
+
+def observe_job(command, wait, elapsed, failed):
+	job_wait.labels().observe(wait)
+	job_duration.labels(command).observe(elapsed)
+	if failed:
+		job_errors.labels(command).inc()
+	return
+
+# commands from the web interface run here, one after the other,
+# so no request waits for MPD or for halt
+jobs = JobQueue(commands, logger, observer=observe_job)
+registry.gauge('paradium_job_queue_depth', 'Commands waiting to run right now.', lambda: jobs.queue.qsize())
+registry.gauge('paradium_job_queue_capacity', 'Commands that may wait at most before submissions are refused.',
+	lambda: jobs.queue.maxsize)
+registry.gauge('paradium_jobs_submitted', 'Commands queued since start.', lambda: jobs.submitted, 'counter')
+registry.gauge('paradium_jobs_rejected', 'Commands refused with 503 because the queue was full.',
+	lambda: jobs.rejected, 'counter')
+
+def current_song():
+	"""
+	title of whatever MPD is playing right now
+	"""
+	title = client.currentsong().get('title')
+	if not title:
+		title = "none"
+	return title
+
+def current_station():
+	"""
+	html snippet describing the station selected in our data model
+	"""
+	wait_ready()
+	# get what's playing in dynamic data DataModel
+	cs = dm.current_station()
+
+	# the id would refer to an actual station
+	station = stations.get_station(cs)
+
+	if station is None:
+		desc = 'Not tuned in'
+	else:
+		# names and websites come from whatever catalog got imported
+		if station.website:
+			desc = '<a href=\"{0}\">{1}</a>'.format(html.escape(station.website), html.escape(station.name))
+		else:
+			desc = html.escape(station.name)
+	return desc
+
+def page_command(query):
+	command = query.get('command', [0])[0]
+	if command not in commands:
+		return (404, "text/html", "Unknown command: {}".format(command), ())
+	try:
+		job = jobs.submit(command, query)
+	except QueueFull as e:
+		return (503, "text/html", "Too busy: {}".format(e), ())
+	logger.info('paradium queued command {} as job {}'.format(command, job.id))
+	return (202, "application/json", json.dumps(job.as_dict()), [("Location", "/api/jobs/{}".format(job.id))])
+
+def page_job(id, query):
+	job = jobs.get(int(id))
+	if job is None:
+		return (404, "text/html", "No job {}".format(id), ())
+	return (200, "application/json", json.dumps(job.as_dict()), [("Cache-Control", "no-cache")])
+
+def page_jobs(query):
+	return (200, "application/json", json.dumps(jobs.stats()), ())
+
+# commands in one batch request we run at most
+BATCH_MAX = 10
+
+def action_batch(query, body):
+	"""
+	run several commands in one request, like
+	{"commands": [{"command": "tune", "id": 5}, {"command": "play"}]}.
+	Stops at the first command that fails
+	"""
+	try:
+		batch = json.loads(body.decode('utf-8'))['commands']
+	except (ValueError, KeyError, TypeError) as e:
+		return (400, "text/html", "Bad batch: {}".format(e), ())
+	if not isinstance(batch, list) or len(batch) > BATCH_MAX:
+		return (400, "text/html", "Bad batch: expected a list of at most {} commands".format(BATCH_MAX), ())
+
+	results = []
+	for step in batch:
+		if not isinstance(step, dict):
+			results.append({'command': None, 'ok': False, 'error': 'not an object'})
+			break
+		command = str(step.get('command'))
+		# same arguments as in a query string
+		query = {key: [str(value)] for key, value in step.items() if key != 'command'}
+		logger.info('paradium executing batched command: {}'.format(command))
+		result = {'command': command, 'ok': False}
+		results.append(result)
+		try:
+			result['ok'] = commands.execute(command, query)
+			if not result['ok']:
+				result['error'] = 'unknown command'
+			else:
+				# the result is what MPD did, not what it's going to do
+				settle_tuner()
+		except (ValueError, CommandListError, MPDUnavailable, StartingUp, GroupCommandError) as e:
+			result['error'] = str(e)
+		if not result['ok']:
+			break
+	return (200, "application/json", json.dumps({'results': results}), ())
+
+def page_current_song(query):
+	return (200, "text/html", current_song(), ())
+
+def page_current_station(query):
+	return (200, "text/html", current_station(), ())
+
+def page_mpd_stats(query):
+	return (200, "application/json", json.dumps(client.stats()), ())
+
+def paging(query):
+	"""
+	offset and limit parameters of a listing
+	"""
+	offset = max(0, int(query.get('offset', [0])[0]))
+	limit = min(PAGE_LIMIT_MAX, max(1, int(query.get('limit', [PAGE_LIMIT])[0])))
+	return offset, limit
+
+def station_listing(total, offset, limit, found, **extra):
+	listing = {
+		'total': total,
+		'offset': offset,
+		'limit': limit,
+		'stations': [s.as_dict() for s in found]
+	}
+	listing.update(extra)
+	return (200, "application/json", json.dumps(listing), ())
+
+def page_stations(query):
+	offset, limit = paging(query)
+	wait_ready()
+	catalog = stations.stations
+	return station_listing(len(catalog), offset, limit, catalog[offset:offset + limit])
+
+def page_search(query):
+	offset, limit = paging(query)
+	q = query.get('q', [''])[0]
+	wait_ready()
+	total, found = search_index().page(q, offset, limit)
+	return station_listing(total, offset, limit, found, query=q)
+
+def page_static(query):
+	return (200, "application/json", json.dumps(static_cache.stats()), ())
+
+def page_state(query):
+	return (200, "application/json", json.dumps(dm.stats()), ())
+
+def page_history(query):
+	"""
+	songs played since the since parameter, in seconds since the
+	epoch, on the station parameter if given. Newest first
+	"""
+	since = query.get('since', [None])[0]
+	station = query.get('station', [None])[0]
+	limit = min(HISTORY_LIMIT_MAX, max(1, int(query.get('limit', [HISTORY_LIMIT])[0])))
+	wait_ready()
+	found = history.query(float(since) if since else None, int(station) if station else None, limit)
+	songs = []
+	for entry in found:
+		song = entry.as_dict()
+		s = stations.get_station(entry.station)
+		song['station_name'] = s.name if s is not None else None
+		songs.append(song)
+	return (200, "application/json", json.dumps({'songs': songs, 'now': time.time()}), [("Cache-Control", "no-cache")])
+
+def page_tuner(query):
+	return (200, "application/json", json.dumps(tuner.stats()), ())
+
+def page_resolver(query):
+	return (200, "application/json", json.dumps(resolver.stats()), ())
+
+def page_logging(query):
+	return (200, "application/json", json.dumps(log_pipeline.stats()), ())
+
+def page_mirrors(query):
+	return (200, "application/json", json.dumps(prober.stats()), ())
+
+def page_catalog(query):
+	return (200, "application/json", json.dumps(stations.info()), ())
+
+def page_status(query):
+	body, etag = snapshot.get()
+	return (200, "application/json", body, [("ETag", etag), ("Cache-Control", "no-cache")])
+
+def page_rooms(query):
+	"""
+	station, player state and song of every room, asked all at once
+	"""
+	wait_ready()
+	calls = []
+	for room in rooms:
+		calls.append((room, 'status', ()))
+		calls.append((room, 'currentsong', ()))
+	results = iter(rooms.fan_out(calls))
+	listing = []
+	for room in rooms:
+		(status_ok, status), (song_ok, song) = next(results), next(results)
+		station = stations.get_station(room.dm.current_station())
+		listing.append({
+			'name': room.name,
+			'primary': room is rooms.primary,
+			'connected': room.client.connected(),
+			'station': {'id': station.id, 'name': station.name} if station is not None else None,
+			'state': status.get('state') if status_ok else None,
+			'song': song.get('title') if song_ok else None,
+			'error': None if status_ok and song_ok else (song if status_ok else status)
+		})
+	return (200, "application/json", json.dumps({'rooms': listing}), [("Cache-Control", "no-cache")])
+
+def page_startup(query):
+	return (200, "application/json", json.dumps(startup.as_dict()), ())
+
+def page_metrics(query):
+	return (200, metrics.CONTENT_TYPE, registry.render(), [("Cache-Control", "no-cache")])
+
+def build_status():
+	"""
+	everything the web interface shows about what's playing
+	"""
+	wait_ready()
+	station = stations.get_station(dm.current_station())
+	song = client.currentsong()
+	player = client.status()
+	return {
+		'station': station_info(station),
+		'song': song.get('title'),
+		'state': player.get('state')
+	}
+
+def station_info(station):
+	"""
+	the station as status.json and the event stream show it,
+	None if we're not tuned in
+	"""
+	if station is None:
+		return None
+	return {
+		'id': station.id,
+		'name': station.name,
+		'website': station.website
+	}
+
+# served as /status.json. Only rebuilt after the station or the player changed
+snapshot = StatusSnapshot(build_status)
+
+# now playing updates pushed to the web interface. One watcher
+# on MPD, any number of browsers listening
+events = Broadcaster()
+
+def on_player_change(changed):
+	snapshot.invalidate()
+	title = current_song()
+	events.publish('song', title)
+	# before the state is loaded we don't know the station it plays on
+	if title != "none" and startup.ready.is_set():
+		history.record(dm.current_station(), title)
+	return
+
+def on_station_change(id):
+	snapshot.invalidate()
+	events.publish('station', json.dumps(station_info(stations.get_station(dm.current_station()))))
+	prefetch_neighbours(id)
+	if id in recent_stations:
+		recent_stations.remove(id)
+	recent_stations.append(id)
+	prober.wake()
+	return
+
+def search_index():
+	"""
+	the search index of the current catalog. Built when it's first
+	needed, a catalog is mapped in no time but indexing it takes a while
+	"""
+	global station_index
+	with station_index_lock:
+		catalog = stations.stations
+		if station_index is None or station_index.stations is not catalog:
+			station_index = StationIndex(catalog)
+		return station_index
+
+def on_catalog_change():
+	global station_index
+	# the next search indexes the new catalog, the old index can go now
+	with station_index_lock:
+		station_index = None
+	# the current station may have been renamed or removed
+	on_station_change(dm.current_station())
+	return
+
+watcher = PlayerWatcher(idle_client, on_player_change, logger)
+dm.add_listener(on_station_change)
+
+# dynamic pages
+PAGES = {
+	'/paradium.html':        page_command,
+	'/current_song.html':    page_current_song,
+	'/current_station.html': page_current_station,
+	'/status.json':          page_status,
+	'/api/mpd':              page_mpd_stats,
+	'/api/catalog':          page_catalog,
+	'/api/mirrors':          page_mirrors,
+	'/api/logging':          page_logging,
+	'/api/resolver':         page_resolver,
+	'/api/tuner':            page_tuner,
+	'/api/jobs':             page_jobs,
+	'/api/jobs/':            page_job,
+	'/api/state':            page_state,
+	'/api/static':           page_static,
+	'/api/stations':         page_stations,
+	'/api/stations/search':  page_search,
+	'/api/startup':          page_startup,
+	'/api/rooms':            page_rooms,
+	'/api/history':          page_history,
+	'/metrics':              page_metrics
+}
+
+# POST endpoints
+ACTIONS = {
+	'/api/batch':            action_batch
+}
+
+# Server-Sent Events streams
+STREAMS = {
+	'/events': events
+}
+
+# everything a request can lead to, resolved once per request by both front ends
+router = Router(PAGES, STREAMS, ROUTES, actions=ACTIONS)
+
 
 class ParadiumHandler(SimpleHTTPRequestHandler):
 	"""
@@ -105,156 +735,372 @@ class ParadiumHandler(SimpleHTTPRequestHandler):
 	Not that an instance of this object is being created
 	every time a request comes in
 	"""
-		
-	def handle_current_song(self):
-		self.send_response(200)
-		self.send_header(b"Content-type", b"text/html")
-		self.end_headers()
-		title = client.currentsong().get('title')
-		if not title:
-			title = "none"
-		self.wfile.write(bytes(title, 'utf-8'))
-		return
 
-	def handle_current_station(self):
-		# get what's playing in dynamic data DataModel
-		cs = dm.current_station()
-		
-		# the id would refer to an actual station
-		station = stations.get_station(cs)
+	# keep connections open for the next poll
+	protocol_version = 'HTTP/1.1'
+	# and close them once they went idle
+	timeout = KEEPALIVE_TIMEOUT
+	# headers and body go out in separate writes, with Nagle the
+	# body waits for the client's delayed ACK on a reused connection
+	disable_nagle_algorithm = True
 
-		if station is None:
-			desc = 'Not tuned in'
-		else:
-			if station.website:
-				desc = '<a href=\"{0}\">{1}</a>'.format(station.website, station.name)
-			else:
-				desc = station.name
-			
-		self.send_response(200)
-		self.send_header(b"Content-type", b"text/html")
+	def send_page(self, page, head_only = False):
+		code, content_type, body, headers = page
+		if code >= 400:
+			self.send_error(code, body)
+			return
+		if isinstance(body, str):
+			body = bytes(body, 'utf-8')
+		if etag_matches(self.headers.get('If-None-Match'), dict(headers).get('ETag')):
+			code = 304
+		self.send_response(code)
+		self.send_header("Content-type", content_type)
+		if code != 304:
+			# without it a keep-alive client can't tell where the body ends
+			self.send_header("Content-Length", str(len(body)))
+		for name, value in headers:
+			self.send_header(name, value)
 		self.end_headers()
-		self.wfile.write(bytes(desc, 'utf-8'))
+		if code != 304 and not head_only:
+			self.wfile.write(body)
 		return
 
 	def do_GET(self):
+		self.dispatch()
+		return
+
+	def do_HEAD(self):
+		self.dispatch(head_only=True)
+		return
 
-		logger.info('GET received: {}'.format(self.path))
-		
+	def dispatch(self, head_only = False):
+		"""
+		answer a GET, or a HEAD with the same headers and no body
+		"""
+		start = time.perf_counter()
+		self.route = None
 		try:
-			# first parse the url
-			# returns a 6-tuple
-			url = urlparse(self.path) 
-			path = url[2]
+			self.route = route = router.resolve(self.path)
+			# sampled by table entry, static files and misses by path
+			logger.info('{} received: {}'.format(self.command, self.path), extra={'sample_key': route.pattern or route.path})
 
 			# now dispatch
-			if path == '/paradium.html':
-				query = parse_qs(url[4])
-				command = query.get('command', [0])[0]
-				logger.info('paradium executing command: {}'.format(command))
-				
-				if command == 'play':
-					do_play()
-				elif command == 'prev':
-					do_prev()
-				elif command == 'next':
-					do_next()
-				elif command == 'stop':
-					do_stop()
-				elif command == 'shutdown':
-					do_shutdown()
-				else:
-					self.send_error(404, b"Unknown command: %s" % command)
-					return
-
-				# After processing the command I just send an OK. It's gonna be ignored anyway
-				self.send_response(200)
-				self.send_header(b"Content-type", b"text/html")
-				self.end_headers()
-				self.wfile.write(b"<!DOCTYPE html><html><head>")
-				self.wfile.write(b"</head><body>done</body></html>")
-				return
-			elif path == '/current_song.html':
-				self.handle_current_song()
-				return
-			elif path == '/current_station.html':
-				self.handle_current_station()
-				return
+			if route.kind == PAGE:
+				self.send_page(route.handler(route.query), head_only)
+			elif route.kind == ACTION:
+				self.send_error(405, "Use POST for %s" % route.path)
+			elif route.kind == STREAM:
+				# would block every other client. The web interface
+				# falls back to polling when it gets an error here
+				self.send_error(503, "Event streams need PARADIUM_SERVER=async")
+			elif self.send_cached(head_only):
+				pass
+			elif head_only:
+				super(ParadiumHandler, self).do_HEAD()
 			else:
 				super(ParadiumHandler, self).do_GET()
-				return
-			return
 
+		except MPDUnavailable as e:
+			self.send_error(503, "MPD not available: %s" % e)
+		except StartingUp as e:
+			self.send_error(503, "Starting up: %s" % e)
 		except IOError:
-			self.send_error(404, b"File Not Found: %s" % self.path)
+			self.send_error(404, "File Not Found: %s" % self.path)
+		except ValueError:
+			self.send_error(403, "WTF is this?: %s" % self.path)
+		observe_request(self.route, self.command, self.status, time.perf_counter() - start)
+		return
+
+	def do_POST(self):
+
+		logger.info('POST received: {}'.format(self.path))
+
+		start = time.perf_counter()
+		self.route = None
+		length = self.headers.get('Content-Length') or '0'
+		if not length.isdigit() or int(length) > MAX_BODY:
+			self.send_error(413, "Request body too large")
+			self.close_connection = True
+			return
+		body = self.rfile.read(int(length))
+
+		try:
+			self.route = route = router.resolve(self.path)
+			if route.kind == ACTION:
+				self.send_page(route.handler(route.query, body))
+			else:
+				self.send_error(405, "Only GET for %s" % route.path)
+		except MPDUnavailable as e:
+			self.send_error(503, "MPD not available: %s" % e)
+		except StartingUp as e:
+			self.send_error(503, "Starting up: %s" % e)
 		except ValueError:
-			self.send_error(403, b"WTF is this?: %s" % self.path)
+			self.send_error(403, "WTF is this?: %s" % self.path)
+		observe_request(self.route, self.command, self.status, time.perf_counter() - start)
+		return
+
+	def send_cached(self, head_only = False):
+		"""
+		answer from the static file cache. False if the file
+		isn't cacheable and should be served the usual way
+		"""
+		path = self.translate_path(self.path)
+		if os.path.isdir(path):
+			# SimpleHTTPRequestHandler redirects and lists directories
+			if not self.route.path.endswith('/'):
+				return False
+			path = os.path.join(path, 'index.html')
+			if not os.path.exists(path):
+				return False
+
+		entry = static_cache.get(path)
+		if entry is None:
+			return False
+
+		code, headers, body = entry.respond(self.headers.get('If-None-Match'),
+			self.headers.get('If-Modified-Since'), self.headers.get('Accept-Encoding'))
+		self.send_response(code)
+		for name, value in headers:
+			self.send_header(name, value)
+		self.end_headers()
+		if not head_only:
+			self.wfile.write(body)
+		return True
+
+	def end_headers(self):
+		if self.server.draining and not self.close_connection:
+			# the client reconnects to whoever took over from us
+			self.send_header('Connection', 'close')
+		super(ParadiumHandler, self).end_headers()
+		return
+
+	def log_request(self, code = '-', size = '-'):
+		# do_GET logged it already, we only keep the code for the metrics
+		self.status = int(code)
+		return
+
+	def log_message(self, format, *args):
+		logger.warning('{} {}'.format(self.address_string(), format % args))
+		return
 
 	def translate_path(self, path):
-		"""translate path given routes"""
-
-		# set default root to cwd
-		root = os.getcwd()
-        
-		# look up routes and set root directory accordingly
-		for pattern, rootdir in ROUTES:
-			if path.startswith(pattern):
-				# found match!
-				path = path[len(pattern):]  # consume path up to pattern len
-				root = rootdir
-				break
-       
-		# first parse the url
-		# returns a 6-tuple
-		url = urlparse(self.path) 
-
-		# now dispatch
-		path = url[2]
-
-		# normalize path and prepend root directory
-		path = os.path.normpath(unquote(path))
-		words = path.split('/')
-		words = filter(None, words)
-        
-		path = root
-		for word in words:
-			drive, word = os.path.splitdrive(word)
-			head, word = os.path.split(word)
-			if word in (os.curdir, os.pardir):
-				continue
-			path = os.path.join(path, word)
-
-		return path
-
-
-
-class ParadiumServer(HTTPServer):
+		# do_GET resolved it already
+		route = getattr(self, 'route', None)
+		if route is not None and route.kind == FILE and route.target == path:
+			return route.handler
+		return router.translate_path(path)
+
+
+
+class ParadiumServer(socketserver.ThreadingMixIn, HTTPServer):
 	"""
 	TCP server overload to reuse address and stuff
+
+	Every connection gets its own thread, otherwise one idle
+	keep-alive connection would hold up everybody else.
 	"""
-	
-	def __init__(self, bind_address = "", port = 80):
+
+	daemon_threads = True
+
+	def __init__(self, bind_address = "", port = 80, sock = None):
 	
 		# Initialize server itself
 		self.allow_reuse_address = True
-		HTTPServer.__init__(self, (bind_address, port), ParadiumHandler)
+		self.connections = 0
+		self.connections_lock = threading.Lock()
+		self.draining = False
+		self.drain_deadline = 0.0
+		HTTPServer.__init__(self, (bind_address, port), ParadiumHandler, bind_and_activate=sock is None)
+		if sock is not None:
+			# handed over, bound and listening already
+			self.socket.close()
+			self.socket = sock
+			self.server_address = sock.getsockname()
+			self.server_name, self.server_port = self.server_address[:2]
+		# shared with a predecessor or successor, another process may
+		# accept the connection we were woken up for
+		self.socket.setblocking(False)
+
+		return
+
+	def serve_forever(self):
+		HTTPServer.serve_forever(self)
+		# after drain() open connections finish their requests
+		while self.connections and time.monotonic() < self.drain_deadline:
+			time.sleep(0.05)
+		return
+
+	def drain(self, timeout = DRAIN_TIMEOUT):
+		"""
+		stop accepting connections and let serve_forever() return
+		once the open ones are done, after timeout seconds at the latest
+		"""
+		self.drain_deadline = time.monotonic() + timeout
+		self.draining = True
+		self.shutdown()
+		return
 
+	def process_request(self, request, client_address):
+		with self.connections_lock:
+			full = self.connections >= MAX_CONNECTIONS
+			if not full:
+				self.connections += 1
+		if full:
+			# a thread per connection, we can't take any number of them
+			try:
+				request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nConnection: close\r\nContent-Length: 0\r\n\r\n')
+			except OSError:
+				pass
+			self.shutdown_request(request)
+			return
+		socketserver.ThreadingMixIn.process_request(self, request, client_address)
+		return
+
+	def process_request_thread(self, request, client_address):
+		try:
+			socketserver.ThreadingMixIn.process_request_thread(self, request, client_address)
+		finally:
+			with self.connections_lock:
+				self.connections -= 1
 		return
 
 	def stop(self):
 		logger.info('ParadiumServer exiting...')
-		dm.persist()
+		if not self.draining:
+			# a successor took over our state already
+			persist_state()
+		return
+
+
+class AsyncParadiumServer(AsyncHTTPServer):
+	"""
+	asyncio front end serving the same routes as ParadiumServer
+	but many connections at once
+	"""
+
+	unavailable_errors = (MPDUnavailable, StartingUp)
+
+	def __init__(self, bind_address = "", port = 80, sock = None):
+		AsyncHTTPServer.__init__(self, (bind_address, port), router, logger, static_cache, sock)
 		return
 
+	def observe(self, route, method, status, elapsed):
+		observe_request(route, method, status, elapsed)
+		return
+
+	def stop(self):
+		logger.info('AsyncParadiumServer exiting...')
+		if not self.draining:
+			# a successor took over our state already
+			persist_state()
+		return
+
+
+def connect_mpd():
+	with startup.phase('mpd'):
+		for room in rooms:
+			room.client.start()
+		watcher.start()
+		client.ping()
+	return
+
+def warm_static_cache():
+	"""
+	read and compress what the web interface loads first
+	"""
+	htdocs = os.path.join(PARADIUM_HOME, 'htdocs')
+	with startup.phase('static'):
+		for name in sorted(os.listdir(htdocs)):
+			path = os.path.join(htdocs, name)
+			if os.path.isfile(path):
+				static_cache.get(path)
+	return
+
+def initialize():
+	"""
+	everything beyond static files, loaded once we listen. MPD
+	connects meanwhile, requests needing the catalog wait for it
+	"""
+	threading.Thread(target=connect_mpd, name='startup-mpd', daemon=True).start()
+	try:
+		with startup.phase('state'):
+			for room in rooms:
+				if room.dm is not dm:
+					os.makedirs(os.path.dirname(room.dm.filename), exist_ok=True)
+				room.dm.restore()
+				room.dm.start()
+			os.makedirs(history.directory, exist_ok=True)
+			history.restore()
+		with startup.phase('catalog'):
+			stations.load()
+	except Exception:
+		logger.exception('loading catalog and state failed')
+	# nobody waits forever, an empty catalog is what we had before as well
+	startup.set_ready()
+
+	with startup.phase('workers'):
+		prober.start()
+		resolver.start()
+		jobs.start()
+		# every catalog from now on is announced
+		stations.add_listener(on_catalog_change)
+		on_station_change(dm.current_station())
+		# pick up changes to stations.xml on our own
+		stations.watch()
+	try:
+		warm_static_cache()
+	except OSError as e:
+		logger.warning('couldn\'t warm static cache: {}'.format(e))
+	return
+
+def report_startup():
+	startup.served.wait()
+	for line in startup.report():
+		print(line)
+		logger.info(line)
+	return
+
 
 class ParadiumDaemon(Daemon):
 	"""
 	daemon wrapper
+
+	SIGUSR2 starts a successor and hands it the listening socket, it
+	sends us SIGQUIT once it's ready to serve. We then drain and exit
 	"""
 
 	def run(self):
 		try:
-			self.tmp_server = ParadiumServer("")
+			startup.mark('daemonize')
+			# only now that we are forked off
+			log_pipeline.start()
+			self.successor = None
+			# listen first, the web interface itself needs nothing else
+			with startup.phase('bind'):
+				sock = handoff.inherited_socket()
+				if PARADIUM_SERVER == 'blocking':
+					self.tmp_server = ParadiumServer("", PARADIUM_PORT, sock)
+				else:
+					self.tmp_server = AsyncParadiumServer("", PARADIUM_PORT, sock)
+			server = self.tmp_server
+			registry.gauge('paradium_open_connections', 'HTTP connections open right now.', lambda: server.connections)
+			predecessor = handoff.predecessor()
+			if predecessor is None:
+				threading.Thread(target=initialize, name='startup', daemon=True).start()
+			else:
+				# the old process keeps answering until we are warmed up
+				initialize()
+				self.writepid()
+				logger.info('taking over from PID {}'.format(predecessor))
+				try:
+					os.kill(predecessor, signal.SIGQUIT)
+				except ProcessLookupError:
+					pass
+			if PROFILE_STARTUP:
+				threading.Thread(target=report_startup, name='startup-report', daemon=True).start()
+			signal.signal(signal.SIGHUP, lambda signum, frame: stations.reload_async())
+			signal.signal(signal.SIGUSR2, lambda signum, frame: self.hand_over())
+			signal.signal(signal.SIGQUIT, lambda signum, frame: self.drain())
 			print('started httpserver, listening...')
 			self.tmp_server.serve_forever()
 			print('loop done...')
@@ -263,13 +1109,47 @@ class ParadiumDaemon(Daemon):
 	
 		except KeyboardInterrupt:
 			self.tmp_server.shutdown()
-			self.tmp_server.socket.close()
+			self.tmp_server.server_close()
 			self.tmp_server.stop()
 		return
 
+	def hand_over(self):
+		"""
+		start a successor with our listening socket
+		"""
+		if self.successor is not None and self.successor.poll() is None:
+			logger.warning('successor {} is starting already'.format(self.successor.pid))
+			return
+
+		def run():
+			# the successor starts from our state, we don't touch it anymore
+			stop_flushers()
+			self.successor = handoff.spawn_successor(self.tmp_server.socket, ['takeover'])
+			logger.info('started successor PID {}'.format(self.successor.pid))
+			code = self.successor.wait()
+			if not self.tmp_server.draining:
+				logger.error('successor exited with {} before taking over, still serving'.format(code))
+				start_flushers()
+
+		threading.Thread(target=run, name='handoff', daemon=True).start()
+		return
+
+	def drain(self):
+		"""
+		our successor is serving, finish open requests and exit
+		"""
+		logger.info('successor took over, draining')
+		threading.Thread(target=self.tmp_server.drain, name='drain', daemon=True).start()
+		return
+
+
+startup.mark('module')
 
 if __name__ == '__main__':
-	daemon = ParadiumDaemon('/tmp/paradium-daemon.pid')
+	daemon = ParadiumDaemon(PARADIUM_PIDFILE)
+	if '--profile-startup' in sys.argv:
+		PROFILE_STARTUP = True
+		sys.argv.remove('--profile-startup')
 	if len(sys.argv) == 2:
 		logger.info('{} {}'.format(sys.argv[0],sys.argv[1]))
  
@@ -279,8 +1159,14 @@ if __name__ == '__main__':
 			daemon.stop()
 		elif 'restart' == sys.argv[1]:
 			daemon.restart()
+		elif 'reload' == sys.argv[1]:
+			daemon.reload()
 		elif 'status' == sys.argv[1]:
 			daemon.status()
+		elif 'graceful' == sys.argv[1]:
+			daemon.graceful()
+		elif 'takeover' == sys.argv[1]:
+			daemon.take_over()
 		elif 'foreground' == sys.argv[1]:
 			daemon.run()
 		else:
@@ -289,6 +1175,6 @@ if __name__ == '__main__':
 		sys.exit(0)
 	else:
 		logger.warning('show cmd daemon usage')
-		print ("Usage: {} start|stop|foreground|restart".format(sys.argv[0]))
+		print ("Usage: {} start|stop|foreground|restart|graceful|reload [--profile-startup]".format(sys.argv[0]))
 		sys.exit(2)
  
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+"""
+Stream mirror health
+
+Stations list several mirrors and MPD tries them in the order we add
+them, so a dead first mirror costs the listener MPD's whole connect
+timeout. StreamProber checks the URLs of the stations likely to be
+tuned to next in the background, a few at a time, and remembers how
+long it took to connect and to get the first byte. order() puts the
+fastest healthy mirror of a station first.
+
+Which URLs those are is up to the caller, a catalog can be far too big
+to probe as a whole. Health is only kept for the URLs of the latest
+round, and wake() has URLs nobody probed yet probed right away.
+"""
+
+import ssl
+import time
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+# seconds between two probe rounds over all URLs
+PROBE_INTERVAL = 600.0
+# URLs probed at the same time
+PROBE_CONCURRENCY = 8
+# seconds one probe may take from connect to first byte
+PROBE_TIMEOUT = 5.0
+# weight of the newest sample in the latency averages
+SMOOTHING = 0.5
+
+
+class MirrorHealth():
+	"""
+	probe results of one URL
+	"""
+
+	__slots__ = ('url', 'probes', 'failures', 'connect', 'first_byte', 'healthy', 'error', 'probed_at')
+
+	def __init__(self, url):
+		self.url = url
+		self.probes = 0
+		self.failures = 0
+		# smoothed latencies in seconds, None until the first success
+		self.connect = None
+		self.first_byte = None
+		self.healthy = None
+		self.error = None
+		self.probed_at = None
+
+	def success(self, connect, first_byte):
+		self.probes += 1
+		self.healthy = True
+		self.error = None
+		self.connect = connect if self.connect is None else self.connect + SMOOTHING * (connect - self.connect)
+		self.first_byte = first_byte if self.first_byte is None else self.first_byte + SMOOTHING * (first_byte - self.first_byte)
+		self.probed_at = time.time()
+
+	def failure(self, error):
+		self.probes += 1
+		self.failures += 1
+		self.healthy = False
+		self.error = error
+		self.probed_at = time.time()
+
+	def rank(self):
+		"""
+		sort key: healthy by first byte latency, then not yet probed, then failing
+		"""
+		if self.healthy:
+			return (0, self.first_byte)
+		if self.healthy is None:
+			return (1, 0.0)
+		return (2, 0.0)
+
+	def as_dict(self):
+		return {
+			'url': self.url,
+			'healthy': self.healthy,
+			'probes': self.probes,
+			'success_rate': round(1.0 - self.failures / self.probes, 3) if self.probes else None,
+			'connect_ms': round(self.connect * 1000, 1) if self.connect is not None else None,
+			'first_byte_ms': round(self.first_byte * 1000, 1) if self.first_byte is not None else None,
+			'error': self.error,
+			'probed_at': self.probed_at
+		}
+
+
+class StreamProber():
+	"""
+	probes stream URLs on a thread with its own event loop
+
+	:param urls = callable returning the URLs to probe, called once per round.
+		Should be a few, not a catalog
+	"""
+
+	def __init__(self, logger, urls, interval = PROBE_INTERVAL, concurrency = PROBE_CONCURRENCY, timeout = PROBE_TIMEOUT):
+		self.logger = logger
+		self.urls = urls
+		self.interval = interval
+		self.concurrency = concurrency
+		self.timeout = timeout
+		self.health = {}
+		self.rounds = 0
+		self.last_round = None
+		self.thread = None
+		# set from other threads by wake(), once run() made them
+		self.loop = None
+		self.wakeup = None
+		return
+
+	def start(self):
+		"""
+		start probing in the background. Only call this after the daemon forked
+		"""
+		if self.thread is None:
+			self.thread = threading.Thread(target=asyncio.run, args=(self.run(),), name='prober', daemon=True)
+			self.thread.start()
+		return
+
+	def wake(self):
+		"""
+		probe the URLs we know nothing about yet now rather than with
+		the next round, e.g. after a station change. Safe to call from
+		any thread
+		"""
+		if self.loop is not None:
+			try:
+				self.loop.call_soon_threadsafe(self.wakeup.set)
+			except RuntimeError:
+				# loop already gone
+				pass
+		return
+
+	async def run(self):
+		self.wakeup = asyncio.Event()
+		self.loop = asyncio.get_running_loop()
+		next_round = 0.0
+		while True:
+			try:
+				if time.monotonic() >= next_round:
+					next_round = time.monotonic() + self.interval
+					await self.probe_all(self.urls())
+				else:
+					await self.probe_new(self.urls())
+			except Exception:
+				self.logger.exception('probing stream mirrors failed')
+			self.wakeup.clear()
+			try:
+				await asyncio.wait_for(self.wakeup.wait(), max(0.0, next_round - time.monotonic()))
+			except asyncio.TimeoutError:
+				pass
+
+	async def probe_each(self, urls):
+		"""
+		probe urls, at most concurrency at a time
+		"""
+		# a few workers taking turns, not a task per URL
+		pending = iter(urls)
+
+		async def worker():
+			for url in pending:
+				await self.probe(url)
+
+		await asyncio.gather(*[worker() for i in range(self.concurrency)])
+		return
+
+	def forget(self, urls):
+		"""
+		drop the health of everything but urls. Replaced as a whole so
+		readers on other threads never see it change
+		"""
+		keep = set(urls)
+		self.health = {url: h for url, h in self.health.items() if url in keep}
+		return
+
+	async def probe_new(self, urls):
+		"""
+		probe the URLs that have no health yet
+		"""
+		urls = list(dict.fromkeys(urls))
+		self.forget(urls)
+		await self.probe_each([url for url in urls if url not in self.health])
+		return
+
+	async def probe_all(self, urls):
+		"""
+		probe every URL once, at most concurrency at a time
+		"""
+		urls = list(dict.fromkeys(urls))
+		start = time.perf_counter()
+		await self.probe_each(urls)
+
+		# forget about mirrors nobody asked for anymore
+		self.forget(urls)
+		self.rounds += 1
+		self.last_round = {
+			'urls': len(urls),
+			'healthy': sum(1 for url in urls if self.health[url].healthy),
+			'seconds': round(time.perf_counter() - start, 3),
+			'finished_at': time.time()
+		}
+		self.logger.info('probed {urls} stream urls, {healthy} healthy in {seconds}s'.format(**self.last_round))
+		return
+
+	async def probe(self, url):
+		health = self.health.get(url)
+		if health is None:
+			health = self.health[url] = MirrorHealth(url)
+		try:
+			connect, first_byte = await asyncio.wait_for(self.fetch(url), self.timeout)
+		except asyncio.TimeoutError:
+			health.failure('timeout')
+		except (OSError, ValueError) as e:
+			health.failure(str(e) or e.__class__.__name__)
+		else:
+			health.success(connect, first_byte)
+		return
+
+	async def fetch(self, url):
+		"""
+		request url and wait for the first byte of the stream.
+		Returns (connect, first byte) latency in seconds
+		"""
+		parts = urlsplit(url)
+		if parts.scheme not in ('http', 'https'):
+			raise ValueError('cannot probe {} urls'.format(parts.scheme))
+		secure = parts.scheme == 'https'
+		port = parts.port or (443 if secure else 80)
+
+		start = time.perf_counter()
+		reader, writer = await asyncio.open_connection(parts.hostname, port,
+			ssl=ssl.create_default_context() if secure else None)
+		try:
+			connect = time.perf_counter() - start
+			path = parts.path or '/'
+			if parts.query:
+				path += '?' + parts.query
+			writer.write('GET {} HTTP/1.0\r\nHost: {}\r\nUser-Agent: Paradium\r\nIcy-MetaData: 0\r\n\r\n'.format(path, parts.netloc).encode('latin-1'))
+			await writer.drain()
+
+			line = await reader.readline()
+			words = line.decode('latin-1').split()
+			# shoutcast answers "ICY 200 OK"
+			if len(words) < 2 or not words[1].isdigit():
+				raise ValueError('no HTTP response')
+			code = int(words[1])
+			if code >= 400:
+				raise ValueError('HTTP {}'.format(code))
+			while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+				pass
+			# a redirect is as far as we get, MPD follows it itself
+			if code < 300 and not await reader.read(1):
+				raise ValueError('no data')
+			return connect, time.perf_counter() - start
+		finally:
+			writer.close()
+
+	def order(self, urls):
+		"""
+		urls with the fastest healthy mirror first. Mirrors we know
+		nothing about keep their order
+		"""
+		health = self.health
+		unknown = (1, 0.0)
+		return sorted(urls, key=lambda url: health[url].rank() if url in health else unknown)
+
+	def stats(self):
+		return {
+			'rounds': self.rounds,
+			'last_round': self.last_round,
+			'interval': self.interval,
+			# the prober thread adds to it, list() copies it in one go
+			'mirrors': [h.as_dict() for h in list(self.health.values())]
+		}
@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+
+"""
+Playlist and redirect resolution
+
+Directory stations often point at a .pls or .m3u playlist or at a URL
+that redirects somewhere else instead of at the stream itself. MPD
+copes with that, but fetches the playlist on every tune before any
+audio arrives. StreamResolver expands such URLs to the streams behind
+them and keeps the answer for a while. Failures are kept too, for a
+shorter while, so a dead playlist server doesn't cost a timeout on
+every tap. prefetch() resolves in the background, which we use for the
+stations next to the current one.
+
+A tune doesn't wait for more than it has to. Only URLs that look like
+playlists are resolved right away, all of them at once and for at most
+TUNE_BUDGET seconds. Everything else, and playlists that take longer,
+goes to MPD as it is and is resolved in the background for next time.
+"""
+
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import http.client
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urljoin, urlsplit
+
+# seconds we trust a resolved URL
+RESOLVE_TTL = 3600.0
+# seconds we remember that resolving failed
+NEGATIVE_TTL = 300.0
+# URLs we keep the answer for
+CACHE_SIZE = 512
+# seconds one fetch may take
+RESOLVE_TIMEOUT = 3.0
+# seconds a tune waits for its playlists to be resolved
+TUNE_BUDGET = 1.0
+# playlists of one tune resolved at the same time
+RESOLVE_WORKERS = 4
+# playlists bigger than that aren't playlists
+MAX_PLAYLIST = 64 * 1024
+
+PLAYLIST_TYPES = ('audio/x-scpls', 'audio/scpls', 'audio/x-mpegurl', 'audio/mpegurl', 'application/pls+xml')
+PLAYLIST_EXTENSIONS = ('.pls', '.m3u')
+
+
+def parse_playlist(text):
+	"""
+	stream URLs of a .pls or .m3u playlist
+	"""
+	urls = []
+	for line in text.splitlines():
+		line = line.strip()
+		if not line or line.startswith('#') or line.startswith('['):
+			continue
+		key, sep, value = line.partition('=')
+		if sep and key.lower().startswith('file'):
+			# pls: File1=http://...
+			urls.append(value.strip())
+		elif not sep or '://' in key:
+			# m3u: one URL per line, which may have a query string
+			urls.append(line)
+	return urls
+
+
+def is_playlist(url, content_type):
+	if content_type and content_type.split(';')[0].strip().lower() in PLAYLIST_TYPES:
+		return True
+	return urlsplit(url).path.lower().endswith(PLAYLIST_EXTENSIONS)
+
+
+class StreamResolver():
+	"""
+	expands playlist and redirect URLs with an LRU cache
+
+	:param fetch = callable taking a URL and returning the stream URLs
+		behind it, raising OSError or ValueError on failure. Defaults to
+		fetching it over HTTP
+	"""
+
+	def __init__(self, logger, ttl = RESOLVE_TTL, negative_ttl = NEGATIVE_TTL, size = CACHE_SIZE, fetch = None):
+		self.logger = logger
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.size = size
+		self.fetch = fetch or self.fetch_urls
+
+		self.lock = threading.Lock()
+		# url -> (expires, urls or None if resolving failed)
+		self.cache = OrderedDict()
+		self.pending = queue.Queue()
+		self.thread = None
+		# threads are only started on the first tune, after the daemon forked
+		self.executor = ThreadPoolExecutor(RESOLVE_WORKERS, thread_name_prefix='resolver-tune')
+
+		self.hits = 0
+		self.negative_hits = 0
+		self.misses = 0
+		self.prefetched = 0
+		# time spent resolving on misses, to tell what the hits saved
+		self.resolve_time = 0.0
+		return
+
+	def start(self):
+		"""
+		start the prefetch thread. Only call this after the daemon forked
+		"""
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.worker, name='resolver', daemon=True)
+			self.thread.start()
+		return
+
+	def cached(self, url):
+		"""
+		(found, urls) from the cache, urls is None for a cached failure
+		"""
+		with self.lock:
+			entry = self.cache.get(url)
+			if entry is None:
+				return False, None
+			if entry[0] < time.monotonic():
+				del self.cache[url]
+				return False, None
+			self.cache.move_to_end(url)
+			return True, entry[1]
+
+	def store(self, url, urls):
+		ttl = self.ttl if urls is not None else self.negative_ttl
+		with self.lock:
+			self.cache[url] = (time.monotonic() + ttl, urls)
+			self.cache.move_to_end(url)
+			while len(self.cache) > self.size:
+				self.cache.popitem(last=False)
+		return
+
+	def lookup(self, url, prefetch = False):
+		"""
+		stream URLs behind url, from the cache or resolved now.
+		If resolving fails the URL is returned as is, MPD may
+		still make sense of it
+		"""
+		found, urls = self.cached(url)
+		if found:
+			if not prefetch:
+				with self.lock:
+					if urls is None:
+						self.negative_hits += 1
+					else:
+						self.hits += 1
+			return urls if urls is not None else [url]
+
+		start = time.perf_counter()
+		try:
+			urls = self.fetch(url) or None
+		except (OSError, ValueError, http.client.HTTPException) as e:
+			self.logger.info('cannot resolve {}: {}'.format(url, e))
+			urls = None
+		elapsed = time.perf_counter() - start
+		self.store(url, urls)
+		with self.lock:
+			if prefetch:
+				self.prefetched += 1
+			else:
+				self.misses += 1
+			self.resolve_time += elapsed
+		return urls if urls is not None else [url]
+
+	def resolve(self, urls, budget = TUNE_BUDGET):
+		"""
+		expand a station's URLs for a tune, keeping their order and
+		dropping duplicates. Waits budget seconds at most, see above
+		"""
+		expanded = {}
+		resolving = {}
+		for url in urls:
+			if self.cached(url)[0]:
+				expanded[url] = self.lookup(url)
+			elif is_playlist(url, None):
+				resolving[url] = self.executor.submit(self.lookup, url)
+			else:
+				self.prefetch([url])
+		if resolving:
+			wait(resolving.values(), timeout=budget)
+		for url, future in resolving.items():
+			# one that isn't done is cached once it is, for the next tune
+			if future.done():
+				expanded[url] = future.result()
+
+		resolved = []
+		for url in urls:
+			resolved.extend(expanded.get(url, [url]))
+		return list(OrderedDict.fromkeys(resolved))
+
+	def prefetch(self, urls):
+		"""
+		resolve urls in the background unless they are cached already
+		"""
+		for url in urls:
+			if not self.cached(url)[0]:
+				self.pending.put(url)
+		return
+
+	def worker(self):
+		while True:
+			url = self.pending.get()
+			# may have been queued twice
+			if self.cached(url)[0]:
+				continue
+			try:
+				self.lookup(url, prefetch=True)
+			except Exception:
+				self.logger.exception('prefetching {} failed'.format(url))
+
+	def fetch_urls(self, url, depth = 0):
+		"""
+		follow redirects and expand playlists, one level of nesting deep
+		"""
+		if not url.startswith(('http://', 'https://')):
+			return [url]
+		request = urllib.request.Request(url, headers={'User-Agent': 'Paradium', 'Icy-MetaData': '0'})
+		try:
+			response = urllib.request.urlopen(request, timeout=RESOLVE_TIMEOUT)
+		except http.client.BadStatusLine as e:
+			# shoutcast's "ICY 200 OK", that's a stream
+			if str(e).startswith('ICY'):
+				return [url]
+			raise
+		with response:
+			final = response.geturl()
+			if not is_playlist(final, response.headers.get('Content-Type')):
+				return [final]
+			body = response.read(MAX_PLAYLIST + 1)
+		if len(body) > MAX_PLAYLIST:
+			raise ValueError('playlist too big')
+
+		urls = []
+		for entry in parse_playlist(body.decode('utf-8', 'replace')):
+			entry = urljoin(final, entry)
+			if depth == 0 and is_playlist(entry, None):
+				urls.extend(self.fetch_urls(entry, depth + 1))
+			else:
+				urls.append(entry)
+		if not urls:
+			raise ValueError('empty playlist')
+		return urls
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.negative_hits + self.misses
+			fetches = self.misses + self.prefetched
+			avg = self.resolve_time / fetches if fetches else 0.0
+			return {
+				'cached': len(self.cache),
+				'hits': self.hits,
+				'negative_hits': self.negative_hits,
+				'misses': self.misses,
+				'prefetched': self.prefetched,
+				'hit_rate': round((self.hits + self.negative_hits) / lookups, 3) if lookups else None,
+				'avg_resolve_ms': round(avg * 1000, 1),
+				# every hit would have cost an average resolve
+				'saved_ms': round(self.hits * avg * 1000, 1)
+			}
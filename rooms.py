@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+"""
+Rooms
+
+An install may have an MPD in every room. A Room is one of them with a
+station of its own. Rooms keeps them by name, the first one is the
+primary room the web interface controls as before. Commands for
+several rooms are sent to all of them before we wait for any answer.
+Every MPDConnection has its own worker, so a group command takes as
+long as the slowest room and not as long as all of them together.
+
+Rooms are configured as name=host[:port] pairs separated by commas,
+the host may be the path of a unix socket:
+
+	PARADIUM_ROOMS=living=/var/run/mpd/socket,kitchen=10.0.0.7:6600
+"""
+
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+
+# where a group command is sent to every room
+ALL = 'all'
+
+
+class GroupCommandError(Exception):
+	"""
+	raised when a command failed in some of the rooms it was sent to
+
+	:param failures = dict of room name to error message
+	"""
+
+	def __init__(self, failures):
+		self.failures = failures
+		Exception.__init__(self, ', '.join('{}: {}'.format(name, error) for name, error in sorted(failures.items())))
+
+
+def parse_rooms(spec, default_port = 6600):
+	"""
+	(name, host, port) for every room of a PARADIUM_ROOMS value
+	"""
+	rooms = []
+	for entry in filter(None, (e.strip() for e in spec.split(','))):
+		name, sep, address = entry.partition('=')
+		name = name.strip()
+		if not sep or not name or not address or name == ALL:
+			raise ValueError('bad room {!r}, expected name=host[:port]'.format(entry))
+		host, sep, port = address.rpartition(':')
+		if sep and port.isdigit() and not address.startswith('/'):
+			rooms.append((name, host, int(port)))
+		else:
+			rooms.append((name, address, default_port))
+	if len(set(name for name, host, port in rooms)) != len(rooms):
+		raise ValueError('room names must be unique: {}'.format(spec))
+	return rooms
+
+
+class Room():
+	"""
+	one MPD and the station selected for it
+
+	:param client = MPDConnection of the room
+	:param dm = DataModel keeping the room's current station
+	"""
+
+	__slots__ = ('name', 'client', 'dm')
+
+	def __init__(self, name, client, dm):
+		self.name = name
+		self.client = client
+		self.dm = dm
+
+
+class Rooms():
+	"""
+	all rooms by name, in the order they were configured
+	"""
+
+	def __init__(self, rooms):
+		self.rooms = list(rooms)
+		self.by_name = {room.name: room for room in self.rooms}
+		return
+
+	@property
+	def primary(self):
+		return self.rooms[0]
+
+	def __iter__(self):
+		return iter(self.rooms)
+
+	def __len__(self):
+		return len(self.rooms)
+
+	def select(self, spec):
+		"""
+		rooms named by spec, 'all' or names separated by commas.
+		Raises ValueError for rooms we don't have
+		"""
+		if spec == ALL:
+			return list(self.rooms)
+		selected = []
+		for name in filter(None, (n.strip() for n in spec.split(','))):
+			room = self.by_name.get(name)
+			if room is None:
+				raise ValueError('no room {}'.format(name))
+			if room not in selected:
+				selected.append(room)
+		if not selected:
+			raise ValueError('no rooms in {!r}'.format(spec))
+		return selected
+
+	def fan_out(self, calls, timeout = None):
+		"""
+		send (room, command, args) calls to their rooms at once and wait
+		for all of them. Returns (ok, result or error message) per call,
+		in order. Nothing is raised, a room that doesn't answer in
+		timeout seconds is an error like any other
+		"""
+		futures = [(room, room.client.submit(command, *args)) for room, command, args in calls]
+		if timeout is None:
+			timeout = max(room.client.timeout for room, command, args in calls) * 2 if calls else 0
+		deadline = time.monotonic() + timeout
+
+		results = []
+		for room, future in futures:
+			try:
+				results.append((True, future.result(max(0.0, deadline - time.monotonic()))))
+			except FutureTimeout:
+				future.cancel()
+				results.append((False, 'MPD did not answer in time'))
+			except Exception as e:
+				results.append((False, str(e) or e.__class__.__name__))
+		return results
+
+	def run(self, calls):
+		"""
+		fan_out() calls and return their results. Raises GroupCommandError
+		naming the rooms that failed, once all of them answered
+		"""
+		results = self.fan_out(calls)
+		failures = {room.name: result for (room, command, args), (ok, result) in zip(calls, results) if not ok}
+		if failures:
+			raise GroupCommandError(failures)
+		return [result for ok, result in results]
+
+	def group(self, rooms, command, *args):
+		"""
+		run one command in every room of rooms, see run()
+		"""
+		return self.run([(room, command, args) for room in rooms])
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+"""
+Request routing
+
+Router is built once at startup from the page, action, stream and
+static mount tables and then resolves a request target to a Route: the
+URL is split once, pages, actions and streams are found with a dict
+lookup and static files by longest matching mount prefix. Both front ends dispatch on
+the Route, so a new endpoint only needs to be added to the tables.
+
+CommandRegistry does the same for the commands the web interface sends
+to /paradium.html?command=...
+"""
+
+import os
+import functools
+from urllib.parse import urlsplit, parse_qs, unquote
+
+# what a route leads to
+PAGE = 'page'
+ACTION = 'action'
+STREAM = 'stream'
+FILE = 'file'
+
+
+class Route():
+	"""
+	one resolved request target
+
+	:param kind = PAGE, ACTION, STREAM or FILE
+	:param handler = the page or action callable, the stream's
+		broadcaster or the file name for FILE
+	:param pattern = the table entry that matched, the prefix for
+		pages taking everything below a path and None for FILE
+	"""
+
+	__slots__ = ('kind', 'target', 'path', 'handler', 'query', 'pattern')
+
+	def __init__(self, kind, target, path, handler, query, pattern = None):
+		self.kind = kind
+		self.target = target
+		self.path = path
+		self.handler = handler
+		self.query = query
+		self.pattern = pattern
+		return
+
+
+class Router():
+	"""
+	maps request targets to pages, actions, event streams and static files
+
+	:param pages = dict mapping a path to a page callable. A path ending
+		in '/' takes everything below it, the page is called with the
+		rest of the path first, page(rest, query)
+	:param streams = dict mapping a path to a Broadcaster
+	:param mounts = (url_prefix, directory) pairs. '' is the default
+		mount, a prefix only matches whole path segments
+	:param root = directory for paths no mount matches
+	:param actions = dict mapping a path to a callable taking POST
+		requests. It gets the parsed query and the request body and
+		returns what a page returns
+	"""
+
+	def __init__(self, pages = None, streams = None, mounts = (), root = None, actions = None):
+		self.pages = {}
+		self.prefixes = []
+		for path, page in (pages or {}).items():
+			self.add_page(path, page)
+		self.actions = dict(actions or {})
+		self.streams = dict(streams or {})
+		self.mounts = []
+		self.root = root or os.getcwd()
+		for prefix, directory in mounts:
+			self.add_mount(prefix, directory)
+		return
+
+	def add_page(self, path, page):
+		if path.endswith('/'):
+			self.prefixes.append((path, page))
+			self.prefixes.sort(key=lambda prefix: len(prefix[0]), reverse=True)
+		else:
+			self.pages[path] = page
+		return
+
+	def page(self, path):
+		"""
+		decorator registering a page function under path
+		"""
+		def register(page):
+			self.add_page(path, page)
+			return page
+		return register
+
+	def add_action(self, path, action):
+		self.actions[path] = action
+		return
+
+	def add_stream(self, path, broadcaster):
+		self.streams[path] = broadcaster
+		return
+
+	def add_mount(self, prefix, directory):
+		self.mounts.append((prefix.rstrip('/'), directory))
+		# longest prefix first, the first match wins
+		self.mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+		return
+
+	def resolve(self, target):
+		"""
+		the Route for a request target like '/api/stations?offset=20'
+		"""
+		url = urlsplit(target)
+		path = url.path
+		page = self.pages.get(path)
+		if page is not None:
+			return Route(PAGE, target, path, page, parse_qs(url.query), path)
+		action = self.actions.get(path)
+		if action is not None:
+			return Route(ACTION, target, path, action, parse_qs(url.query), path)
+		stream = self.streams.get(path)
+		if stream is not None:
+			return Route(STREAM, target, path, stream, None, path)
+		for prefix, page in self.prefixes:
+			if path.startswith(prefix) and len(path) > len(prefix):
+				return Route(PAGE, target, path, functools.partial(page, unquote(path[len(prefix):])), parse_qs(url.query), prefix)
+		return Route(FILE, target, path, self.file_name(path), None)
+
+	def translate_path(self, target):
+		"""
+		file name for a request target, with query and fragment
+		"""
+		return self.file_name(urlsplit(target).path)
+
+	def file_name(self, path):
+		"""
+		file name for the path of a request, never outside the mount's directory
+		"""
+		root = self.root
+		for prefix, directory in self.mounts:
+			if path.startswith(prefix) and path[len(prefix):len(prefix) + 1] in ('', '/'):
+				root = directory
+				path = path[len(prefix):]
+				break
+
+		# normalize path and prepend root directory
+		path = os.path.normpath(unquote(path))
+		for word in filter(None, path.split('/')):
+			drive, word = os.path.splitdrive(word)
+			head, word = os.path.split(word)
+			if word in (os.curdir, os.pardir):
+				continue
+			root = os.path.join(root, word)
+		return root
+
+
+class CommandRegistry():
+	"""
+	commands by name. A command is called with the parsed query
+	of the request and raises ValueError for bad arguments
+	"""
+
+	def __init__(self):
+		self.commands = {}
+		return
+
+	def register(self, name):
+		"""
+		decorator adding a command under name
+		"""
+		def register(command):
+			self.commands[name] = command
+			return command
+		return register
+
+	def execute(self, name, query = None):
+		"""
+		run a command. Returns False if we don't know it
+		"""
+		command = self.commands.get(name)
+		if command is None:
+			return False
+		command(query or {})
+		return True
+
+	def __contains__(self, name):
+		return name in self.commands
+
+	def names(self):
+		return sorted(self.commands)
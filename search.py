@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+"""
+Station search
+
+StationIndex maps every word of a station's name and website host to
+the stations containing it. Words are kept sorted so a query term
+matches all words it is a prefix of with two binary searches, which
+is what makes search-as-you-type work on big catalogs.
+"""
+
+import re
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+WORD = re.compile(r'\w+')
+# host name parts that say nothing about a station
+HOST_NOISE = frozenset(('www', 'com', 'org', 'net', 'de', 'uk', 'fm', 'http', 'https'))
+# queries we keep the results of
+CACHE_SIZE = 128
+
+
+def tokenize(text):
+	if not text:
+		return []
+	return WORD.findall(text.lower())
+
+
+def station_words(station):
+	words = set(tokenize(station.name))
+	website = station.website
+	if website:
+		host = urlparse(website).hostname or ''
+		words.update(w for w in tokenize(host) if w not in HOST_NOISE)
+	return words
+
+
+class SearchResult():
+	"""
+	ranked positions of the stations matching one query. The tail of
+	weak matches is only sorted once somebody pages that far
+	"""
+
+	def __init__(self, head, tail):
+		self.head = head
+		self.tail = tail
+		self.total = len(head) + len(tail)
+		return
+
+	def slice(self, offset, limit):
+		end = offset + limit
+		if end > len(self.head) and self.tail:
+			# set -> list in one assignment, safe to race
+			self.head = self.head + sorted(self.tail)
+			self.tail = ()
+		return self.head[offset:end]
+
+
+class StationIndex():
+	"""
+	prefix index over one station list. The list must not change,
+	build a new index for a new catalog instead.
+
+	Results are ranked: name starts with the query, then all terms
+	matched as whole words, then the rest. Catalog order within that.
+	"""
+
+	def __init__(self, stations):
+		self.stations = stations
+
+		postings = {}
+		names = []
+		for i, s in enumerate(stations):
+			for word in station_words(s):
+				postings.setdefault(word, []).append(i)
+			names.append((' '.join(tokenize(s.name)), i))
+		self.postings = {word: frozenset(p) for word, p in postings.items()}
+		self.words = sorted(postings)
+		# normalized names in order, for the names-starting-with tier
+		self.names = sorted(names)
+		self.cache = OrderedDict()
+		self.cache_lock = threading.Lock()
+		return
+
+	def matches(self, term):
+		"""
+		positions of all stations having a word starting with term
+		"""
+		lo = bisect_left(self.words, term)
+		hi = bisect_left(self.words, term + '\uffff', lo)
+		if hi - lo == 1:
+			return self.postings[self.words[lo]]
+		return frozenset().union(*[self.postings[word] for word in self.words[lo:hi]])
+
+	def rank(self, query, terms, found):
+		lo = bisect_left(self.names, (query,))
+		hi = bisect_left(self.names, (query + '\uffff',), lo)
+		first = sorted(i for name, i in self.names[lo:hi] if i in found)
+
+		exact = found
+		for t in terms:
+			exact = exact.intersection(self.postings.get(t, ()))
+		taken = set(first)
+		second = sorted(exact - taken)
+		taken.update(second)
+		return SearchResult(first + second, found - taken)
+
+	def search(self, query):
+		"""
+		all stations matching every word of the query as SearchResult
+		"""
+		query = ' '.join(tokenize(query))
+		with self.cache_lock:
+			cached = self.cache.get(query)
+			if cached is not None:
+				self.cache.move_to_end(query)
+				return cached
+
+		# "bmir.org" should find bmir even though we don't index "org"
+		terms = [t for t in query.split() if t not in HOST_NOISE or t in self.postings]
+		if not terms:
+			return SearchResult([], ())
+
+		# start with the rarest term, it narrows things down most
+		sets = sorted((self.matches(t) for t in terms), key=len)
+		found = sets[0]
+		for s in sets[1:]:
+			found = found.intersection(s)
+			if not found:
+				break
+
+		result = self.rank(query, terms, found)
+		with self.cache_lock:
+			self.cache[query] = result
+			if len(self.cache) > CACHE_SIZE:
+				self.cache.popitem(last=False)
+		return result
+
+	def page(self, query, offset, limit):
+		"""
+		(total, stations) for one page of search results
+		"""
+		result = self.search(query)
+		return result.total, [self.stations[i] for i in result.slice(offset, limit)]
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+"""
+Startup profile
+
+The daemon listens first and loads the catalog, its state and the MPD
+connection on background threads afterwards. StartupProfile keeps track
+of how long each of these phases took and when, counted from the start
+of the process, and when the first request was answered. That is what
+a phone waiting for the web interface after a cold boot sees.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+def process_age():
+	"""
+	seconds since the process was started, 0.0 if /proc can't tell
+	"""
+	try:
+		with open('/proc/self/stat') as f:
+			# the command name may contain anything, count from its end
+			fields = f.read().rpartition(')')[2].split()
+		with open('/proc/uptime') as f:
+			uptime = float(f.read().split()[0])
+		return max(0.0, uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK'))
+	except (OSError, ValueError, IndexError):
+		return 0.0
+
+
+class Phase():
+
+	__slots__ = ('name', 'start', 'seconds', 'thread', 'error')
+
+	def __init__(self, name, start, thread):
+		self.name = name
+		self.start = start
+		self.seconds = None
+		self.thread = thread
+		self.error = None
+
+	def as_dict(self):
+		return {
+			'name': self.name,
+			'start': round(self.start, 4),
+			'seconds': round(self.seconds, 4) if self.seconds is not None else None,
+			'thread': self.thread,
+			'error': self.error
+		}
+
+
+class StartupProfile():
+	"""
+	startup phases and the first request, in seconds since the process
+	started. Create it as early as possible, it takes the time the
+	interpreter needed before as given
+	"""
+
+	def __init__(self):
+		self.origin = time.monotonic() - process_age()
+		self.lock = threading.Lock()
+		self.phases = []
+		self.checkpoint = 0.0
+		self.first_request = None
+		self.ready_at = None
+		self.served = threading.Event()
+		self.ready = threading.Event()
+		return
+
+	def now(self):
+		return time.monotonic() - self.origin
+
+	def mark(self, name):
+		"""
+		record a phase from the last mark, or the start of the process,
+		until now. For the sequential part of startup
+		"""
+		now = self.now()
+		with self.lock:
+			phase = Phase(name, self.checkpoint, threading.current_thread().name)
+			phase.seconds = now - self.checkpoint
+			self.checkpoint = now
+			self.phases.append(phase)
+		return
+
+	@contextmanager
+	def phase(self, name):
+		"""
+		record the time the with block takes. Exceptions are
+		noted and passed on
+		"""
+		phase = Phase(name, self.now(), threading.current_thread().name)
+		with self.lock:
+			self.phases.append(phase)
+		try:
+			yield phase
+		except Exception as e:
+			phase.error = str(e) or e.__class__.__name__
+			raise
+		finally:
+			phase.seconds = self.now() - phase.start
+
+	def request_served(self, path):
+		"""
+		called after every request, only the first one is kept
+		"""
+		if self.first_request is None:
+			with self.lock:
+				if self.first_request is None:
+					self.first_request = (self.now(), path)
+					self.served.set()
+		return
+
+	def set_ready(self):
+		"""
+		everything requests wait for is loaded
+		"""
+		self.ready_at = self.now()
+		self.ready.set()
+		return
+
+	def as_dict(self):
+		with self.lock:
+			phases = [p.as_dict() for p in self.phases]
+		first = None
+		if self.first_request is not None:
+			first = {'at': round(self.first_request[0], 4), 'path': self.first_request[1]}
+		return {
+			'phases': phases,
+			'ready': round(self.ready_at, 4) if self.ready_at is not None else None,
+			'first_request': first
+		}
+
+	def report(self):
+		"""
+		the profile as lines of text
+		"""
+		profile = self.as_dict()
+		lines = ['startup profile, seconds since process start:']
+		for p in profile['phases']:
+			if p['seconds'] is None:
+				took = 'running'
+			else:
+				took = '{:.3f}s'.format(p['seconds'])
+			lines.append('  {:>8.3f}  {:<12} {:>9}  [{}]{}'.format(p['start'], p['name'], took, p['thread'],
+				'  failed: ' + p['error'] if p['error'] else ''))
+		if profile['ready'] is not None:
+			lines.append('  {:>8.3f}  ready'.format(profile['ready']))
+		if profile['first_request'] is not None:
+			lines.append('  {:>8.3f}  first request answered: {}'.format(profile['first_request']['at'], profile['first_request']['path']))
+		return lines
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+"""
+In-memory cache for the files under htdocs
+
+The web interface loads a few hundred KB of jQuery on every visit.
+Instead of opening and reading those files for every request we keep
+them in memory, together with a gzipped variant for clients that take
+it, and hand out validators so browsers can revalidate with a 304.
+Entries are checked against the file's mtime and size on every use.
+"""
+
+import os
+import gzip
+import threading
+import mimetypes
+import email.utils
+from collections import OrderedDict
+
+from aioserver import etag_matches
+
+# bytes of file content (plain and gzipped) we keep at most
+CACHE_BUDGET = 8 * 1024 * 1024
+# bigger files are not cached but streamed as before
+MAX_FILE_SIZE = 1024 * 1024
+# content types worth compressing
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+# max-age for anything but html, which is always revalidated
+MAX_AGE = 3600
+
+
+def accepts_gzip(accept_encoding):
+	"""
+	True if an Accept-Encoding header value allows gzip
+	"""
+	if not accept_encoding:
+		return False
+	for coding in accept_encoding.split(','):
+		name, _, params = coding.partition(';')
+		if name.strip().lower() not in ('gzip', '*'):
+			continue
+		q = 1.0
+		for param in params.split(';'):
+			key, _, value = param.partition('=')
+			if key.strip().lower() == 'q':
+				try:
+					q = float(value)
+				except ValueError:
+					q = 0.0
+		return q > 0
+	return False
+
+
+def not_modified_since(if_modified_since, mtime):
+	if not if_modified_since:
+		return False
+	try:
+		since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+	except (TypeError, ValueError, IndexError):
+		return False
+	return int(mtime) <= since
+
+
+class StaticFile():
+	"""
+	one cached file
+	"""
+
+	__slots__ = ('path', 'stat', 'body', 'gzipped', 'etag', 'last_modified', 'content_type', 'cache_control')
+
+	def __init__(self, path, stat, body):
+		self.path = path
+		self.stat = stat
+		self.body = body
+		self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+		self.etag = '"{:x}-{:x}"'.format(stat[0], stat[1])
+		self.last_modified = email.utils.formatdate(stat[0] / 1e9, usegmt=True)
+		if self.content_type == 'text/html':
+			self.cache_control = 'no-cache'
+		else:
+			self.cache_control = 'max-age={}'.format(MAX_AGE)
+
+		self.gzipped = None
+		if self.content_type.startswith(COMPRESSIBLE):
+			packed = gzip.compress(body, 9, mtime=0)
+			if len(packed) < len(body):
+				self.gzipped = packed
+		return
+
+	def size(self):
+		return len(self.body) + (len(self.gzipped) if self.gzipped else 0)
+
+	def respond(self, if_none_match, if_modified_since, accept_encoding):
+		"""
+		pick the response for a request with the given header values.
+		Returns (code, headers, body)
+		"""
+		use_gzip = self.gzipped is not None and accepts_gzip(accept_encoding)
+		# the gzipped bytes differ, so does their strong ETag
+		etag = self.etag[:-1] + '-gz"' if use_gzip else self.etag
+
+		headers = [
+			('ETag', etag),
+			('Last-Modified', self.last_modified),
+			('Cache-Control', self.cache_control)
+		]
+		if self.gzipped is not None:
+			headers.append(('Vary', 'Accept-Encoding'))
+
+		if if_none_match:
+			if etag_matches(if_none_match, etag):
+				return 304, headers, b''
+		elif not_modified_since(if_modified_since, self.stat[0] / 1e9):
+			return 304, headers, b''
+
+		body = self.gzipped if use_gzip else self.body
+		headers.append(('Content-type', self.content_type))
+		headers.append(('Content-Length', str(len(body))))
+		if use_gzip:
+			headers.append(('Content-Encoding', 'gzip'))
+		return 200, headers, body
+
+
+class StaticCache():
+	"""
+	LRU cache of StaticFile objects within a byte budget
+	"""
+
+	def __init__(self, budget = CACHE_BUDGET, max_file_size = MAX_FILE_SIZE):
+		self.budget = budget
+		self.max_file_size = max_file_size
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		return
+
+	def get(self, path):
+		"""
+		the StaticFile for path, read from disk if it's not cached or
+		changed. None if it is too big to cache. Raises OSError like open()
+		"""
+		st = os.stat(path)
+		stat = (st.st_mtime_ns, st.st_size)
+
+		with self.lock:
+			entry = self.entries.get(path)
+			if entry is not None and entry.stat == stat:
+				self.entries.move_to_end(path)
+				self.hits += 1
+				return entry
+
+		if st.st_size > self.max_file_size:
+			return None
+
+		with open(path, 'rb') as f:
+			body = f.read()
+		entry = StaticFile(path, stat, body)
+
+		with self.lock:
+			self.misses += 1
+			old = self.entries.pop(path, None)
+			if old is not None:
+				self.used -= old.size()
+			self.entries[path] = entry
+			self.used += entry.size()
+			while self.used > self.budget and len(self.entries) > 1:
+				path, evicted = self.entries.popitem(last=False)
+				self.used -= evicted.size()
+		return entry
+
+	def stats(self):
+		with self.lock:
+			return {
+				'files': len(self.entries),
+				'bytes': self.used,
+				'budget': self.budget,
+				'hits': self.hits,
+				'misses': self.misses
+			}
@@ -1,14 +1,19 @@
 #!/usr/bin/python3
 
 import sys,os
+import time
+import struct
+import threading
 
-import xml.dom
-from xml.etree.ElementTree import Element, ElementTree, fromstring
+from xml.etree.ElementTree import iterparse, ParseError
 # from xmlvalidator import validate_dtd
 
 import logging
 import logging.handlers
 
+from datamodel import write_atomic
+from catalog import CompiledCatalog, open_catalog, compile_catalog, source_key, CACHE_SUFFIX
+
 # setup environment variable defaults
 PARADIUM_HOME     = '/opt/paradium/'
 PARADIUM_VHOME    = '/var/paradium/'
@@ -17,35 +22,140 @@ PARADIUM_MPDHOST  = '127.0.0.1'
 # and override with the actual environment
 if 'PARADIUM_HOME' in os.environ:
 	PARADIUM_HOME = os.environ['PARADIUM_HOME']
+if 'PARADIUM_VHOME' in os.environ:
+	PARADIUM_VHOME = os.environ['PARADIUM_VHOME']
 if 'PARADIUM_MPDHOST' in os.environ:
 	PARADIUM_MPDHOST = os.environ['PARADIUM_MPDHOST']
 
 
+# seconds between checks of stations.xml for changes
+WATCH_INTERVAL = 5.0
+# station ids are stored as int32, in the compiled catalog and the history
+STATION_ID_MIN = -2**31
+STATION_ID_MAX = 2**31 - 1
+
+
+class StationError(ValueError):
+	"""
+	a station entry that doesn't follow the rules of stations.dtd
+	"""
+	pass
+
+
+def validate_station(elem):
+	"""
+	check a 'station' element against stations.dtd, that is a numeric
+	id attribute and (name, url+, website?) as children, none of them empty.
+	Raises StationError
+	"""
+	id = elem.get('id')
+	if id is None:
+		raise StationError('station without id')
+	try:
+		number = int(id)
+	except ValueError:
+		raise StationError('station id "{}" is not a number'.format(id))
+	if not STATION_ID_MIN <= number <= STATION_ID_MAX:
+		raise StationError('station id {} is out of range'.format(id))
+
+	tags = [child.tag for child in elem]
+	if not tags or tags[0] != 'name':
+		raise StationError('station {} has no name'.format(id))
+	i = 1
+	while i < len(tags) and tags[i] == 'url':
+		i += 1
+	if i == 1:
+		raise StationError('station {} has no url'.format(id))
+	if i < len(tags) and tags[i] == 'website':
+		i += 1
+	if i != len(tags):
+		raise StationError('station {}: unexpected <{}>'.format(id, tags[i]))
+
+	for child in elem:
+		if child.text is None or not child.text.strip():
+			raise StationError('station {}: empty <{}>'.format(id, child.tag))
+	return
+
+
+def iter_stations(source, errors = None):
+	"""
+	parse a stations.xml file incrementally, yielding a Station for each
+	valid entry. Elements are dropped as soon as they are processed so
+	memory use doesn't grow with the size of the file.
+
+	:param source = file name or file object
+	:param errors = list invalid entries get appended to as StationError
+	"""
+	root = None
+	for event, elem in iterparse(source, events=('start', 'end')):
+		if event == 'start':
+			if root is None:
+				root = elem
+			continue
+		if elem.tag != 'station':
+			continue
+
+		try:
+			validate_station(elem)
+			yield parse_station(elem)
+		except StationError as e:
+			if errors is not None:
+				errors.append(e)
+
+		# throw away what we've seen so far
+		elem.clear()
+		root.clear()
+	return
+
+
+def parse_station(elem):
+	"""
+	create a Station out of a valid 'station' typed XML element
+	"""
+	name = None
+	website = None
+	urls = []
+	for child in list(elem):
+		if child.tag == 'name':
+			name = child.text
+		elif child.tag == 'website':
+			website = child.text
+		elif child.tag == 'url':
+			urls.append(child.text)
+	return Station(int(elem.get('id')), name, urls, website)
+
+
 class Station():
 	"""
-	represents one radio station
+	represents one radio station. Stations of a compiled catalog are
+	made whenever somebody asks for one, so they're kept small
+
+	:param website = None if the station has none
 	"""
 
-	def __init__(self, elem):
+	__slots__ = ('id', 'name', 'urls', 'website')
+
+	def __init__(self, id, name, urls, website = None):
+		self.id = id
+		self.name = name
+		self.urls = urls
+		self.website = website
+
+	def as_dict(self):
 		"""
-		create a Station out of a 'station' typed XML element
+		the station as served by the JSON API
 		"""
-		self.id = int(elem.get('id'))
-		self.urls = []
-
-		for child in list(elem):
-			if child.tag == 'name':
-				self.name = child.text
-			elif child.tag == 'website':
-				self.website = child.text
-			elif child.tag == 'url':
-				self.urls.append(child.text)
-		return
+		return {
+			'id': self.id,
+			'name': self.name,
+			'urls': self.urls,
+			'website': self.website
+		}
 
 	def __str__(self):
-		retstr = '{} ({})'.format(self.name, self.website)
-		assert isinstance(retstr, str)
-		return retstr
+		if self.website is None:
+			return self.name
+		return '{} ({})'.format(self.name, self.website)
 
 
 class Stations():
@@ -54,73 +164,212 @@ class Stations():
 
 	I treat them as a list, implying that they are ordered
 	by nothing but the way they happen to be in the XML.
-	"""
 
-	stations = []
+	Next to the list there's an index mapping each id to its position
+	so lookups and prev/next don't have to walk the list. Both are
+	replaced in one go when a catalog is loaded so readers never see
+	a list that doesn't match the index.
+
+	stations.xml is only parsed when its compiled catalog is missing or
+	out of date, see catalog.py. The one of the stations.xml we serve
+	goes to PARADIUM_VHOME, anybody else's next to their file. The list is a CompiledCatalog then,
+	making stations as they are asked for, and the index looks ids up
+	in its id tables.
+	"""
 
-	def __init__(self, logger):
+	def __init__(self, logger, filename = None, load = True, compiled = None):
 		
+		# better kepe the logger for Ron
+		self.logger = logger
+
+		# (list of stations, dict id -> position in that list)
+		self.catalog = ([], {})
+
+		if filename is None:
+			filename = PARADIUM_HOME + '/htdocs/stations.xml'
+			if compiled is None:
+				# htdocs is public, nobody needs to download it
+				compiled = os.path.join(PARADIUM_VHOME, 'stations.xml' + CACHE_SUFFIX)
+		self.filename = filename
+		self.compiled = compiled or filename + CACHE_SUFFIX
+
+		# (mtime, size) of the file as we last read it. Kept for failed
+		# loads as well so a broken file isn't retried until it changes
+		self.source = None
+		# outcome of the last load, see load()
+		self.last_load = None
+		# called without arguments after a new catalog was swapped in
+		self.listeners = []
+		self.reload_lock = threading.Lock()
+		self.watcher = None
+
+		# with load False the catalog stays empty until load() is called
+		if load:
+			self.load()
+		return
+
+	@property
+	def stations(self):
+		return self.catalog[0]
+
+	def add_listener(self, listener):
+		self.listeners.append(listener)
+		return
+
+	def stat(self):
+		st = os.stat(self.filename)
+		return (st.st_mtime_ns, st.st_size)
+
+	def load(self):
+		"""
+		read and parse the stations.xml file in which 
+		all the available radio stations are stored.
+
+		The new catalog replaces the current one only if the file
+		could be parsed completely. Returns True if it did
+		"""
+		start = time.perf_counter()
+		result = {'time': time.time(), 'file': self.filename, 'ok': False}
 		try:
-			# better kepe the logger for Ron
-			self.logger = logger
-			
-			# read and parse our stations.xml file in which 
-			# all the available radio stations are stored
-			self.logger.info('parsing stations.xml')
-			xmlfile = open(PARADIUM_HOME + '/htdocs/stations.xml', 'r')
-			# validate_dtd(xmlfile)
-			xml = xmlfile.read()
-			xmlfile.close()
-
-			# get the DOM	
-			dom = fromstring(xml)
-
-			# and traverse all stations in the root node
-			i = dom.iter('station')
-			for s in i:
-				new_station = Station(s)
-				logger.info('inserting station {}'.format(new_station.name))
-				self.stations.append(Station(s))
-				new_station
-		
+			# stat first so changes made while we parse are seen next time
+			self.source = self.stat()
+
+			compiled = open_catalog(self.filename, self.compiled, Station, self.source)
+			# whether the compiled catalog was up to date
+			result['cached'] = compiled is not None
+			if compiled is None:
+				compiled = self.compile()
+
+			self.catalog = (compiled, compiled.index)
+			elapsed = time.perf_counter() - start
+			result.update(ok=True, stations=len(compiled), skipped=compiled.skipped, seconds=round(elapsed, 3))
+			self.last_load = result
+			self.logger.info('{} stations loaded, {} skipped in {:.3f}s'.format(len(compiled), compiled.skipped, elapsed))
 			print('Stations created')
 
-		except IOError:
+		except IOError as e:
 			self.logger.error('couldn\'t read stations.xml')
+			result['error'] = str(e)
+			self.last_load = result
+			return False
+		except ParseError as e:
+			self.logger.error('couldn\'t parse stations.xml: {}'.format(e))
+			result['error'] = str(e)
+			self.last_load = result
+			return False
+		except (struct.error, ValueError) as e:
+			self.logger.error('couldn\'t compile stations.xml: {}'.format(e))
+			result['error'] = str(e)
+			self.last_load = result
+			return False
+
+		for listener in self.listeners:
+			listener()
+		return True
+
+	def compile(self):
+		"""
+		parse stations.xml and compile it, see catalog.py. Raises
+		IOError, ParseError and struct.error like load()
+		"""
+		self.logger.info('parsing stations.xml')
+		# hashed before we parse, a change meanwhile makes the key stale
+		key = source_key(self.filename)
+
+		# stream through the stations in the root node rather
+		# than building the DOM of a possibly huge file
+		errors = []
+		stations = list(iter_stations(self.filename, errors))
+
+		for e in errors:
+			self.logger.warning('skipping invalid station: {}'.format(e))
+
+		data = compile_catalog(stations, key, len(errors))
+		try:
+			write_atomic(self.compiled, data)
+		except OSError as e:
+			self.logger.warning('couldn\'t write the compiled catalog, using it from memory: {}'.format(e))
+			return CompiledCatalog(data, Station)
+		return open_catalog(self.filename, self.compiled, Station) or CompiledCatalog(data, Station)
+
+	def reload(self):
+		"""
+		load the file again. The current catalog keeps serving
+		until the new one is complete. Concurrent calls are skipped
+		"""
+		if not self.reload_lock.acquire(blocking=False):
+			return False
+		try:
+			return self.load()
+		finally:
+			self.reload_lock.release()
+
+	def reload_async(self):
+		"""
+		reload in a thread of its own, e.g. from a signal handler
+		"""
+		threading.Thread(target=self.reload, name='stations-reload', daemon=True).start()
+		return
 
+	def changed(self):
+		"""
+		True if the file differs from what we loaded last
+		"""
+		try:
+			return self.stat() != self.source
+		except OSError:
+			# gone or being replaced, keep what we have
+			return False
+
+	def watch(self, interval = WATCH_INTERVAL):
+		"""
+		check the file every interval seconds and reload it
+		when it changed
+		"""
+		def run():
+			while True:
+				time.sleep(interval)
+				if self.changed():
+					self.logger.info('stations.xml changed, reloading')
+					self.reload()
+
+		if self.watcher is None or not self.watcher.is_alive():
+			self.watcher = threading.Thread(target=run, name='stations-watch', daemon=True)
+			self.watcher.start()
 		return
 
+	def info(self):
+		"""
+		catalog size and the outcome of the last load
+		"""
+		return {
+			'stations': len(self.catalog[0]),
+			'file': self.filename,
+			'compiled_file': self.compiled,
+			'last_load': self.last_load
+		}
+
 	def get_station(self, id):
 		"""
 		find a station by id
 		:type id = int
 		"""
-		for s in self.stations:
-			if isinstance(id, str):
-				if s.id == int(id):
-					return s
-			elif s.id == id:
-				return s
-		return None
+		stations, index = self.catalog
+		if isinstance(id, str):
+			id = int(id)
+		i = index.get(id)
+		if i is None:
+			return None
+		return stations[i]
 
 	def get_next(self, id):
 		"""
 		get the next station in our list in order to switch to it.
-		If we are already at the beginning of the list we switch to the last
+		If we are already at the end of the list we switch to the first
 
 		:param id = the station to start from (current)
 		"""
-
-		# first find the current station
-		for i, val in enumerate(self.stations, 0):
-			if val.id == id:
-				if i == len(self.stations) - 1:
-					return self.stations[0]
-				else:
-					return self.stations[i + 1]
-
-		# If for some reason things go south I default back to the first station
-		return self.stations[0]
+		return self.get_neighbour(id, 1)
 
 	def get_prev(self, id):
 		"""
@@ -129,17 +378,23 @@ class Stations():
 
 		:param id = the station to start from (current)
 		"""
+		return self.get_neighbour(id, -1)
 
-		# first find the current station
-		for i, val in enumerate(self.stations, 0):
-			if val.id == id:
-				if i == 0:
-					return self.stations[len(self.stations) - 1]
-				else:
-					return self.stations[i - 1]
+	def get_neighbour(self, id, offset):
+		"""
+		station offset positions away from id, wrapping around at both ends
+		"""
+		stations, index = self.catalog
+		if not stations:
+			return None
+		if isinstance(id, str):
+			id = int(id)
+		i = index.get(id)
 
 		# If for some reason things go south I default back to the first station
-		return self.stations[0]
+		if i is None:
+			return stations[0]
+		return stations[(i + offset) % len(stations)]
 
 if __name__ == '__main__':
 
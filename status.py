@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+"""
+Cached status snapshot
+
+Everything the web interface shows about what is playing, rendered
+to JSON once and served from memory until something changes.
+"""
+
+import json
+import hashlib
+import threading
+
+
+class StatusSnapshot():
+	"""
+	JSON rendering of whatever build() returns, with a strong ETag
+
+	:param build = callable returning the status as dict. It is only
+		called again after invalidate()
+	"""
+
+	def __init__(self, build):
+		self.build = build
+		self.lock = threading.Lock()
+		self.generation = 0
+		# (body, etag) or None, replaced as a whole so readers need no lock
+		self.current = None
+		self.builds = 0
+		return
+
+	def invalidate(self):
+		"""
+		drop the snapshot, the next get() rebuilds it
+		"""
+		with self.lock:
+			self.generation += 1
+			self.current = None
+		return
+
+	def get(self):
+		"""
+		returns (body, etag) with body as utf-8 encoded JSON
+		"""
+		current = self.current
+		if current is not None:
+			return current
+
+		with self.lock:
+			generation = self.generation
+
+		# build outside the lock, it talks to MPD
+		body = json.dumps(self.build(), sort_keys=True).encode('utf-8')
+		etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+
+		with self.lock:
+			self.builds += 1
+			# don't store it if it got invalidated while we were building
+			if generation == self.generation:
+				self.current = (body, etag)
+		return body, etag
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+"""
+Debounced tuning
+
+Somebody tapping "next" five times in a row wants the fifth station,
+not four stream connections that are abandoned right away. The
+selection itself changes with every tap, so the web interface follows
+along, but TuneScheduler only starts playback once the taps have
+stopped for a moment. Only one tune is sent to MPD at a time; taps
+arriving meanwhile just replace the one that is waiting.
+"""
+
+import time
+import threading
+
+# seconds without a tap before we actually tune in
+TUNE_DELAY = 0.4
+
+
+class TuneScheduler():
+	"""
+	runs play(id) for the last requested station once requests
+	have been quiet for delay seconds
+
+	:param play = callable starting playback of a station id. It runs on
+		the scheduler's thread, exceptions are logged
+	"""
+
+	def __init__(self, play, logger, delay = TUNE_DELAY):
+		self.play = play
+		self.logger = logger
+		self.delay = delay
+
+		self.cond = threading.Condition()
+		self.pending = None
+		self.deadline = 0.0
+		self.busy = False
+		self.thread = None
+
+		self.requests = 0
+		self.plays = 0
+		self.superseded = 0
+		self.failures = 0
+		return
+
+	def start(self):
+		"""
+		start the worker thread unless it's running already
+		"""
+		with self.cond:
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.worker, name='tuner', daemon=True)
+				self.thread.start()
+		return
+
+	def request(self, id):
+		"""
+		tune to id once nothing else is requested for delay seconds
+		"""
+		self.start()
+		with self.cond:
+			if self.pending is not None:
+				self.superseded += 1
+			self.pending = id
+			self.deadline = time.monotonic() + self.delay
+			self.requests += 1
+			self.cond.notify_all()
+		return
+
+	def cancel(self):
+		"""
+		forget a tune that didn't start yet. True if there was one
+		"""
+		with self.cond:
+			if self.pending is None:
+				return False
+			self.pending = None
+			self.superseded += 1
+			self.cond.notify_all()
+		return True
+
+	def is_pending(self):
+		with self.cond:
+			return self.pending is not None
+
+	def wait_idle(self, timeout = None):
+		"""
+		block until nothing is waiting or playing. False on timeout
+		"""
+		with self.cond:
+			return self.cond.wait_for(lambda: self.pending is None and not self.busy, timeout)
+
+	def worker(self):
+		while True:
+			with self.cond:
+				while True:
+					if self.pending is None:
+						self.cond.wait()
+						continue
+					wait = self.deadline - time.monotonic()
+					if wait <= 0:
+						break
+					self.cond.wait(wait)
+				id = self.pending
+				self.pending = None
+				self.busy = True
+
+			failed = False
+			try:
+				self.play(id)
+			except Exception:
+				failed = True
+				self.logger.exception('tuning to {} failed'.format(id))
+			with self.cond:
+				self.busy = False
+				self.plays += 1
+				if failed:
+					self.failures += 1
+				self.cond.notify_all()
+
+	def stats(self):
+		with self.cond:
+			return {
+				'delay': self.delay,
+				'requests': self.requests,
+				'plays': self.plays,
+				'superseded': self.superseded,
+				'failures': self.failures,
+				'pending': self.pending,
+				'busy': self.busy
+			}